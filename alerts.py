@@ -0,0 +1,279 @@
+""" Уведомления о погоде по правилам (заморозок, сильный дождь, порывы ветра и т.д.).
+    Новые строки WeatherData читаются по водяному знаку id, поэтому проверка занимает время, пропорциональное
+    количеству новых показаний, а не длине истории. Показания, записанные транзакциями не в порядке id, могут
+    появиться ниже водяного знака, поэтому последние ALERT_OVERLAP_IDS id перечитываются при каждой проверке,
+    а уже проверенные строки пропускаются.
+
+    Правила задаются списком ALERT_RULES в settings.py (по умолчанию - DEFAULT_RULES). Правило - словарь:
+        name - название правила (латиницей), title - текст уведомления, field - показание
+        (temperature, humidity, barometer, rain, windspeed, windgust), op - '>=' или '<=', value - порог,
+        kind - вид правила:
+            threshold - значение показания
+            sum - сумма показаний за последние window секунд (например, осадки за час)
+            change - изменение показания за последние window секунд (например, падение температуры)
+        cooldown - наименьшее время в секундах между уведомлениями по одной метеостанции,
+        agro, stations - необязательные списки Агро и метеостанций, к которым применяется правило,
+        users - необязательный список получателей (по умолчанию - подписчики уведомления weather,
+        см. subscriptions.py).
+
+    Окна sum и change разбиты на WINDOW_SLOTS интервалов, поэтому состояние правила по метеостанции
+    имеет постоянный размер
+"""
+import operator
+from datetime import datetime, timedelta
+
+import dboperator as db
+import settings
+
+# Поля строки db.get_weather_data_after_id
+FIELDS = ('id', 'weatherstationid', 'datetime', 'temperature', 'humidity', 'barometer', 'rain', 'windspeed',
+          'windgust')
+UNITS = {'temperature': '°', 'humidity': '%', 'barometer': ' мм', 'rain': ' мм', 'windspeed': ' м/с',
+         'windgust': ' м/с'}
+OPERATORS = {'>=': operator.ge, '<=': operator.le}
+
+# Количество интервалов, на которые делится окно правил sum и change
+WINDOW_SLOTS = 12
+# Наибольшее количество строк WeatherData, читаемых за один запрос
+BATCH = 5000
+# Количество id ниже водяного знака, которые перечитываются при каждой проверке (как ROLLUP_OVERLAP_IDS в rollup.py)
+OVERLAP_IDS = getattr(settings, 'ALERT_OVERLAP_IDS', 1000)
+# Наибольшая длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+DEFAULT_RULES = [
+    {'name': 'frost', 'title': 'Заморозок', 'kind': 'threshold', 'field': 'temperature', 'op': '<=', 'value': 0,
+     'cooldown': 6 * 3600},
+    {'name': 'heavy_rain', 'title': 'Сильный дождь (осадки за час)', 'kind': 'sum', 'field': 'rain', 'op': '>=',
+     'value': 10, 'window': 3600, 'cooldown': 3 * 3600},
+    {'name': 'wind_gust', 'title': 'Сильные порывы ветра', 'kind': 'threshold', 'field': 'windgust', 'op': '>=',
+     'value': 15, 'cooldown': 3 * 3600},
+    {'name': 'cooling', 'title': 'Резкое похолодание (за 3 часа)', 'kind': 'change', 'field': 'temperature',
+     'op': '<=', 'value': -8, 'window': 3 * 3600, 'cooldown': 6 * 3600},
+]
+
+
+class RollingWindow:
+    """ Сумма и изменение показания за последние window секунд. Окно разбито на slots интервалов:
+        для каждого хранится сумма и первое значение, устаревшие интервалы обнуляются при сдвиге окна
+    """
+
+    def __init__(self, window: float, slots: int = WINDOW_SLOTS):
+        self.slot_seconds = window / slots
+        self.sums = [0.0] * slots
+        self.firsts = [None] * slots
+        self.slot = None
+        self.total = 0.0
+        self.last = None
+
+    def add(self, moment: datetime, value: float) -> None:
+        """ Добавляет показание. Показания, пришедшие позже более новых, учитываются в текущем интервале"""
+        slot = max(int(moment.timestamp() // self.slot_seconds), self.slot or 0)
+        if self.slot is None or slot - self.slot >= len(self.sums):
+            self.sums = [0.0] * len(self.sums)
+            self.firsts = [None] * len(self.firsts)
+            self.total = 0.0
+        else:
+            for expired in range(self.slot + 1, slot + 1):
+                position = expired % len(self.sums)
+                self.total -= self.sums[position]
+                self.sums[position] = 0.0
+                self.firsts[position] = None
+        self.slot = slot
+        position = slot % len(self.sums)
+        self.sums[position] += value
+        self.total += value
+        if self.firsts[position] is None:
+            self.firsts[position] = value
+        self.last = value
+
+    def change(self) -> float:
+        """ Изменение от первого показания в окне до последнего"""
+        for offset in range(1, len(self.firsts) + 1):
+            first = self.firsts[(self.slot + offset) % len(self.firsts)]
+            if first is not None:
+                return self.last - first
+        return 0.0
+
+
+class Rule:
+    """ Правило уведомления (см. описание модуля)"""
+
+    def __init__(self, config: dict):
+        self.name = config['name']
+        self.title = config.get('title', config['name'])
+        self.kind = config.get('kind', 'threshold')
+        self.field = config['field']
+        self.position = FIELDS.index(self.field)
+        self.compare = OPERATORS[config.get('op', '>=')]
+        self.value = config['value']
+        self.window = config.get('window', 3600)
+        self.cooldown = timedelta(seconds=config.get('cooldown', 3600))
+        self.agro = set(config['agro']) if config.get('agro') else None
+        self.stations = set(config['stations']) if config.get('stations') else None
+        self.users = config.get('users')
+
+    def applies(self, station_id: int, agro: set) -> bool:
+        """ Применяется ли правило к метеостанции, которая относится к Агро agro"""
+        if self.stations is not None and station_id not in self.stations:
+            return False
+        return self.agro is None or bool(self.agro & agro)
+
+
+class AlertEngine:
+    """ Проверка правил по новым показаниям. Состояние хранится по паре (правило, метеостанция)
+
+    :param rules:
+        Список правил (словари, см. описание модуля)
+    :param station_agro:
+        Пары (id метеостанции, номер Агро) из db.get_station_agro. None - загрузить из базы данных
+        при первой проверке (см. load_station_agro)
+    """
+
+    def __init__(self, rules: list, station_agro: list = None):
+        self.rules = [Rule(config) for config in rules]
+        self.station_agro = {}
+        self.station_agro_loaded = False
+        if station_agro is not None:
+            self.set_station_agro(station_agro)
+        self.windows = {}
+        self.alerted_at = {}
+        self.last_id = None
+        # id проверенных строк в пределах перекрытия и id, ниже которого строки не перечитываются (начальная загрузка)
+        self.seen = set()
+        self.floor_id = 0
+
+    def set_station_agro(self, station_agro: list) -> None:
+        self.station_agro = {}
+        for station_id, agro_id in station_agro:
+            self.station_agro.setdefault(station_id, set()).add(agro_id)
+        self.station_agro_loaded = True
+
+    def load_station_agro(self) -> bool:
+        """ Загружает привязку метеостанций к Агро из базы данных
+
+        :return:
+            False, если привязку получить не удалось
+        """
+        station_agro = db.get_station_agro()
+        if station_agro is None:
+            return False
+        self.set_station_agro(station_agro)
+        return True
+
+    def rules_for(self, station_id: int) -> list:
+        agro = self.station_agro.get(station_id, set())
+        return [rule for rule in self.rules if rule.applies(station_id, agro)]
+
+    def evaluate(self, rule: Rule, station_id: int, moment: datetime, value: float) -> float or None:
+        """ Значение, которое сравнивается с порогом правила"""
+        if rule.kind == 'threshold':
+            return value
+        window = self.windows.get((rule.name, station_id))
+        if window is None:
+            window = self.windows[(rule.name, station_id)] = RollingWindow(rule.window)
+        window.add(moment, value)
+        return window.total if rule.kind == 'sum' else window.change()
+
+    def process(self, rows: list, emit: bool = True) -> list:
+        """ Проверяет правила по новым показаниям
+
+        :param rows:
+            Строки db.get_weather_data_after_id по возрастанию id. Уже проверенные строки пропускаются
+        :param emit:
+            False - только накопить окна (начальная загрузка), без уведомлений
+        :return:
+            Список уведомлений (правило, id метеостанции, дата и время, значение)
+        """
+        alerts = []
+        for row in rows:
+            if row[0] in self.seen:
+                continue
+            self.seen.add(row[0])
+            station_id, moment = row[1], row[2]
+            self.last_id = max(self.last_id or 0, row[0])
+            if moment is None:
+                continue
+            for rule in self.rules_for(station_id):
+                value = row[rule.position]
+                if value is None:
+                    continue
+                result = self.evaluate(rule, station_id, moment, float(value))
+                if not emit or not rule.compare(result, rule.value):
+                    continue
+                alerted_at = self.alerted_at.get((rule.name, station_id))
+                if alerted_at is not None and moment - alerted_at < rule.cooldown:
+                    continue
+                self.alerted_at[(rule.name, station_id)] = moment
+                alerts.append((rule, station_id, moment, result))
+        return alerts
+
+    def start(self) -> bool:
+        """ Начальная загрузка: окна заполняются показаниями за наибольшее окно правил, уведомления по ним
+            не отправляются. Дальше проверяются только строки с id больше последнего загруженного
+        """
+        longest = max([rule.window for rule in self.rules if rule.kind != 'threshold'] or [0])
+        rows = db.get_weather_data_since(datetime.now() - timedelta(seconds=longest))
+        if rows is None:
+            return False
+        self.process(rows, emit=False)
+        if self.last_id is None:
+            # Показаний за окно нет: проверка начинается с последней записи. Если её id получить не удалось,
+            # начальная загрузка повторяется при следующей проверке, а не с начала истории
+            self.last_id = db.get_last_weather_data_id()
+        # Строки до начальной загрузки не перечитываются, иначе по ним пришли бы уведомления за прошлое
+        self.floor_id = self.last_id or 0
+        return self.last_id is not None
+
+    def poll(self) -> list:
+        """ Проверяет правила по всем показаниям, пришедшим с прошлой проверки
+
+        :return:
+            Список уведомлений (см. process)
+        """
+        # Без привязки к Агро правила с agro не применялись бы к прочитанным показаниям, поэтому проверка
+        # откладывается до её загрузки
+        if not self.station_agro_loaded and not self.load_station_agro():
+            return []
+        if self.last_id is None and not self.start():
+            return []
+        alerts = []
+        after = max(self.last_id - OVERLAP_IDS, self.floor_id)
+        while True:
+            rows = db.get_weather_data_after_id(after, BATCH)
+            if not rows:
+                break
+            alerts.extend(self.process(rows))
+            if len(rows) < BATCH:
+                break
+            after = rows[-1][0]
+        self.seen = {row_id for row_id in self.seen if row_id > self.last_id - OVERLAP_IDS}
+        return alerts
+
+
+def create_engine() -> AlertEngine:
+    """ Правила из settings.py (ALERT_RULES) и привязка метеостанций к Агро из базы данных"""
+    return AlertEngine(getattr(settings, 'ALERT_RULES', DEFAULT_RULES))
+
+
+def alert_text(alert: tuple, station_name: str) -> str:
+    """ Строка уведомления"""
+    rule, station_id, moment, value = alert
+    return f'{rule.title} на метеостанции {station_name or station_id}: ' \
+           f'{round(value, 1)}{UNITS.get(rule.field, "")} ({moment:%d.%m.%Y %H:%M})'
+
+
+def split_messages(header: str, lines: list, limit: int = MESSAGE_LIMIT) -> list:
+    """ Тексты сообщений из заголовка и строк уведомлений, каждый не длиннее limit символов"""
+    room = limit - len(header)
+    messages, chunk, size = [], [], 0
+    for line in lines:
+        line = line[:room - 1]
+        if chunk and size + len(line) + 1 > room:
+            messages.append(header + '\n'.join(chunk))
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        messages.append(header + '\n'.join(chunk))
+    return messages
@@ -0,0 +1,175 @@
+""" Архив погоды за произвольный период: календарь выбора дат, выбор шага агрегации по длине периода
+    (по часам, по дням или по неделям) и разбиение длинного ответа на страницы.
+    Агрегаты считаются одним запросом к базе данных (см. db.get_weather_archive_period)
+"""
+import calendar
+from datetime import date, datetime, timedelta
+
+import telebot
+from telebot import types
+
+import charts
+import settings
+
+MONTHS = ('Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь', 'Июль', 'Август', 'Сентябрь', 'Октябрь',
+          'Ноябрь', 'Декабрь')
+WEEKDAYS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+
+# Количество строк архива на одной странице для каждого шага агрегации
+PAGE_SIZE = {'hour': 24, 'day': 31, 'week': 26}
+STEP_NAMES = {'hour': 'по часам', 'day': 'по дням', 'week': 'по неделям'}
+
+
+def granularity(date_start: date, date_end: date) -> str:
+    """ Шаг агрегации по длине периода (date_end не включительно): до 3 дней - по часам, до 2 месяцев - по дням,
+        длиннее - по неделям. Так количество строк ответа остаётся небольшим при любой длине периода
+    """
+    days = (date_end - date_start).days
+    if days <= 3:
+        return 'hour'
+    if days <= 62:
+        return 'day'
+    return 'week'
+
+
+def max_days() -> int:
+    """ Наибольшая длина периода архива в днях"""
+    return getattr(settings, 'ARCHIVE_MAX_DAYS', 366)
+
+
+class ArchiveError(Exception):
+    """ Неверный период архива, текст ошибки можно показать пользователю"""
+
+
+def check_period(date_start: date, date_end: date) -> None:
+    """ Проверяет период архива: конец позже начала, длина не больше max_days() дней
+
+    :param date_end:
+        День после последнего дня периода
+    """
+    if date_end <= date_start:
+        raise ArchiveError('Неверный период архива')
+    if (date_end - date_start).days > max_days():
+        raise ArchiveError(f'Период архива не может быть больше {max_days()} дней')
+
+
+def parse_period(start_key: str, end_key: str) -> tuple:
+    """ Период архива из данных кнопки. Данные кнопки приходят от клиента, поэтому период проверяется
+        так же, как при выборе в календаре
+
+    :return:
+        Кортеж (начало, конец не включительно)
+    """
+    try:
+        date_start, date_end = from_key(start_key), from_key(end_key)
+    except (TypeError, ValueError):
+        raise ArchiveError('Неверный период архива')
+    check_period(date_start, date_end)
+    return date_start, date_end
+
+
+def to_key(day: date) -> str:
+    """ Дата в данных кнопки (ГГГГММДД), чтобы callback_data не превышала 64 байта"""
+    return f'{day:%Y%m%d}'
+
+
+def from_key(key: str) -> date:
+    return datetime.strptime(key, '%Y%m%d').date()
+
+
+def week_period(week: int) -> tuple:
+    """ Период кнопки "Архив N недели назад": восемь дней, последний из которых - N-1 недель назад
+
+    :return:
+        Кортеж (начало, конец не включительно)
+    """
+    date_end = date.today() - timedelta(days=7 * (week - 1)) + timedelta(days=1)
+    return date_end - timedelta(days=8), date_end
+
+
+def calendar_keyboard(month: date, station_id: int, agro_id: int,
+                      first_day: date = None) -> telebot.types.InlineKeyboardMarkup:
+    """ Клавиатура-календарь на месяц для выбора начала и конца периода архива
+
+    :param month:
+        Любой день показываемого месяца
+    :param first_day:
+        Уже выбранное начало периода. Если передано - следующим нажатием выбирается конец периода
+    """
+    today = date.today()
+    suffix = f',s:{station_id},a:{agro_id}' + (f',f:{to_key(first_day)}' if first_day else '')
+    previous_month = (month.replace(day=1) - timedelta(days=1)).replace(day=1)
+    next_month = (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+    keyboard = types.InlineKeyboardMarkup(row_width=7)
+    navigation = [types.InlineKeyboardButton(text='‹', callback_data=f'button:arc_cal,m:{to_key(previous_month)}'
+                                                                      f'{suffix}'),
+                  types.InlineKeyboardButton(text=f'{MONTHS[month.month - 1]} {month.year}',
+                                             callback_data='button:noop')]
+    if next_month <= today:
+        navigation.append(types.InlineKeyboardButton(text='›', callback_data=f'button:arc_cal,m:{to_key(next_month)}'
+                                                                              f'{suffix}'))
+    else:
+        navigation.append(types.InlineKeyboardButton(text=' ', callback_data='button:noop'))
+    keyboard.row(*navigation)
+    keyboard.row(*(types.InlineKeyboardButton(text=name, callback_data='button:noop') for name in WEEKDAYS))
+
+    for week in calendar.monthcalendar(month.year, month.month):
+        row = []
+        for number in week:
+            day = month.replace(day=number) if number else None
+            if day is None or day > today:
+                row.append(types.InlineKeyboardButton(text=str(number) if number else ' ', callback_data='button:noop'))
+            else:
+                text = f'•{number}' if day == first_day else str(number)
+                row.append(types.InlineKeyboardButton(text=text, callback_data=f'button:arc_day,d:{to_key(day)}'
+                                                                               f'{suffix}'))
+        keyboard.row(*row)
+    return keyboard
+
+
+def format_bucket(moment: datetime, step: str, date_start: date, date_end: date) -> str:
+    """ Подпись строки архива. Неделя, попавшая в период не целиком, подписывается только днями периода"""
+    if step == 'hour':
+        return f'{moment:%d.%m %H:%M}'
+    if step == 'day':
+        return f'{moment:%d.%m.%Y}'
+    first_day = max(moment.date(), date_start)
+    last_day = min(moment.date() + timedelta(days=6), date_end - timedelta(days=1))
+    return f'{first_day:%d.%m}-{last_day:%d.%m.%Y}'
+
+
+def format_value(value, unit: str = '°') -> str:
+    return f'{round(value, 1)}{unit}' if value is not None else '-'
+
+
+def archive_lines(rows: list, step: str, date_start: date, date_end: date) -> list:
+    """ Строки архива: подпись интервала, максимальная / минимальная / средняя температура и сумма осадков"""
+    return [f'`{format_bucket(moment, step, date_start, date_end)}` {format_value(maximum)} / '
+            f'{format_value(minimum)} / {format_value(average)}, {format_value(rain or 0, " мм")}'
+            for moment, maximum, minimum, average, rain in rows]
+
+
+def paginate(lines: list, step: str) -> list:
+    """ Разбивает строки архива на страницы"""
+    size = PAGE_SIZE[step]
+    return [lines[start:start + size] for start in range(0, len(lines), size)] or [[]]
+
+
+def page_keyboard(date_start: date, date_end: date, page: int, pages: int, station_id: int, agro_id: int,
+                  menu: telebot.types.InlineKeyboardMarkup) -> telebot.types.InlineKeyboardMarkup:
+    """ Клавиатура листания страниц архива и кнопка графика, над кнопками меню menu"""
+    data = f'button:arc_page,f:{to_key(date_start)},t:{to_key(date_end)},s:{station_id},a:{agro_id}'
+    navigation = []
+    if page > 1:
+        navigation.append(types.InlineKeyboardButton(text=f'« Стр. {page - 1}', callback_data=f'{data},p:{page - 1}'))
+    if page < pages:
+        navigation.append(types.InlineKeyboardButton(text=f'Стр. {page + 1} »', callback_data=f'{data},p:{page + 1}'))
+    keyboard = types.InlineKeyboardMarkup()
+    if navigation:
+        keyboard.row(*navigation)
+    if charts.available():
+        keyboard.add(types.InlineKeyboardButton(text='Показать график',
+                                                callback_data=data.replace('arc_page', 'arc_chart')))
+    keyboard.keyboard.extend(menu.keyboard)
+    return keyboard
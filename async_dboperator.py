@@ -0,0 +1,403 @@
+""" Асинхронная работа с базой данных.
+    Те же запросы, что и в dboperator (пользователи, текущая погода, архив, прогноз, устройства, снимки), но без
+    блокировки потока: запросы выполняются через асинхронные соединения psycopg2 из общего пула, поэтому несколько
+    запросов можно выполнять одновременно через gather. Тексты запросов общие с dboperator, синхронные функции
+    dboperator продолжают работать как раньше. Изменяющие запросы (регистрация) выполняются только синхронно
+
+    Пример: текущая погода по всем Агро одновременно
+        >>> await get_weather_data_from_agros([1, 3, 4, 5, 6])
+        {1: [...], 3: [...], ...}
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from time import perf_counter
+from typing import Any
+
+import psycopg2
+import psycopg2.extensions
+import pythonping
+
+import dboperator as db
+import settings
+
+logger = logging.getLogger('__name__')
+
+
+async def wait(conn) -> None:
+    """ Ожидает завершения операции асинхронного соединения, не блокируя цикл событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+
+        def ready() -> None:
+            if not future.done():
+                future.set_result(None)
+
+        fileno = conn.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fileno, ready)
+            remove = loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fileno, ready)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f'Неожиданное состояние соединения: {state}')
+        try:
+            await future
+        finally:
+            remove(fileno)
+
+
+class AsyncCursor:
+    """ Курсор асинхронного соединения. Время запросов и количество строк учитываются в db.db_stats"""
+
+    def __init__(self, conn, name: str) -> None:
+        self._conn = conn
+        self._cursor = conn.cursor()
+        self._name = name
+
+    async def execute(self, sql: str, params=None) -> None:
+        """ Выполняет запрос и записывает его в статистику"""
+        start = perf_counter()
+        error = False
+        try:
+            self._cursor.execute(sql, params)
+            await wait(self._conn)
+        except psycopg2.Error:
+            error = True
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            db.db_stats.record_execute(self._name, elapsed, error=error)
+            if elapsed > db.slow_query_seconds:
+                logger.warning(f'Медленный запрос в {self._name}: {elapsed:.3f} с. '
+                               f'SQL: {sql} Параметры: {db.redact_params(params)}')
+
+    def fetchall(self) -> list:
+        """ Все строки результата (уже получены при выполнении запроса)"""
+        rows = self._cursor.fetchall()
+        db.db_stats.record_rows(self._name, len(rows))
+        return rows
+
+    def close(self) -> None:
+        self._cursor.close()
+
+
+class AsyncPool:
+    """ Пул асинхронных соединений psycopg2. Соединения создаются по мере необходимости, но не больше size.
+        Асинхронные соединения psycopg2 работают в режиме autocommit
+
+    :param config_dict:
+        Параметры подключения. Если None - используется db.db_config на момент подключения
+    :param size:
+        Максимальное количество одновременно открытых соединений
+    """
+
+    def __init__(self, config_dict: dict = None, size: int = 5) -> None:
+        self.configuration = config_dict
+        self.size = size
+        self._idle = []
+        self._semaphore = None
+
+    async def _connect(self, name: str):
+        """ Открывает новое асинхронное соединение"""
+        start = perf_counter()
+        try:
+            conn = psycopg2.connect(**(self.configuration or db.db_config), async_=True)
+            await asyncio.wait_for(wait(conn), timeout=db.connect_timeout)
+        except asyncio.TimeoutError:
+            db.db_stats.record_connect(name, perf_counter() - start, error=True)
+            conn.close()
+            raise psycopg2.OperationalError(f'Превышено время ожидания подключения: {db.connect_timeout} с')
+        except psycopg2.Error as e:
+            db.db_stats.record_connect(name, perf_counter() - start, error=True)
+            raise db.MyPsycopg2Error(e)
+        db.db_stats.record_connect(name, perf_counter() - start)
+        return conn
+
+    @asynccontextmanager
+    async def cursor(self, name: str):
+        """ Курсор на свободном соединении из пула. Соединение с ошибкой связи закрывается и в пул не возвращается
+
+        :param name:
+            Имя функции для статистики запросов
+        """
+        db.circuit.before()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        async with self._semaphore:
+            start = perf_counter()
+            conn = None
+            while self._idle and conn is None:
+                conn = self._idle.pop()
+                if conn.closed:
+                    conn = None
+            if conn is None:
+                try:
+                    conn = await self._connect(name)
+                except psycopg2.Error:
+                    db.circuit.record(perf_counter() - start, failed=True)
+                    raise
+
+            cursor = AsyncCursor(conn, name)
+            broken = False
+            try:
+                yield cursor
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, asyncio.CancelledError):
+                broken = True
+                raise
+            finally:
+                cursor.close()
+                if broken or conn.closed:
+                    conn.close()
+                else:
+                    self._idle.append(conn)
+                db.circuit.record(perf_counter() - start, failed=broken)
+
+    def close(self) -> None:
+        """ Закрывает свободные соединения"""
+        while self._idle:
+            self._idle.pop().close()
+
+
+pool = AsyncPool(size=getattr(settings, 'ASYNC_DB_POOL_SIZE', 5))
+
+
+async def fetch(name: str, sql: str, params=None) -> list:
+    """ Выполняет запрос на соединении из пула и возвращает все строки результата"""
+    async with pool.cursor(name) as cur:
+        await cur.execute(sql, params)
+        return cur.fetchall()
+
+
+async def gather(*calls) -> list:
+    """ Одновременно выполняет несколько запросов. Ошибки отдельных запросов возвращаются как None"""
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.critical(f'Ошибка при одновременном выполнении запросов: {result}')
+    return [None if isinstance(result, BaseException) else result for result in results]
+
+
+async def check_user(telegram_id: int) -> bool:
+    """ Проверка наличия записи о пользователе (см. db.check_user)"""
+    try:
+        return bool(await fetch('check_user', db.SQL_CHECK_USER, (telegram_id,)))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно проверить пользователя. Ошибка: {e}')
+
+
+async def check_reg_status(telegram_id: int) -> bool or None:
+    """ Проверка статуса подтверждения регистрации (см. db.check_reg_status)"""
+    try:
+        return (await fetch('check_reg_status', db.SQL_REG_STATUS, (telegram_id,)))[0][0] is True
+    except IndexError:
+        return False
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно проверить статус регистрации пользователя. Ошибка: {e}')
+        return None
+
+
+async def get_role(telegram_id: int) -> int:
+    """ Роль пользователя (см. db.get_role)"""
+    try:
+        return (await fetch('get_role', db.SQL_ROLE, (telegram_id,)))[0][0]
+    except (psycopg2.Error, IndexError) as e:
+        logger.critical(f'Невозможно получить данные по роли и месту работы. Ошибка: {e}')
+
+
+async def get_confirmed_role(telegram_id: int) -> int or None:
+    """ Роль пользователя с подтверждённой регистрацией (см. db.get_confirmed_role)"""
+    try:
+        rows = await fetch('get_confirmed_role', db.SQL_CONFIRMED_ROLE, (telegram_id,))
+        return rows[0][0] if rows else None
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить роль пользователя. Ошибка: {e}')
+
+
+async def get_list_users() -> list:
+    """ Список всех пользователей (см. db.get_list_users)"""
+    try:
+        return await fetch('get_list_users', db.SQL_USERS)
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить список пользователей без регистрации. Ошибка: {e}')
+
+
+async def get_weather_station_id_from_agro(agro_id: int) -> list:
+    """ id метеостанций в Агро (см. db.get_weather_station_id_from_agro)"""
+    try:
+        return await fetch('get_weather_station_id_from_agro', db.SQL_WEATHER_STATION_ID_FROM_AGRO, (agro_id,))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить id метеостанций в Агро {agro_id}. Ошибка: {e}')
+
+
+async def get_last_weather_data_id() -> int:
+    """ id последней записи о погоде (см. db.get_last_weather_data_id)"""
+    try:
+        return (await fetch('get_last_weather_data_id', db.SQL_LAST_WEATHER_DATA_ID))[0][0]
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить id последней записи о погоде. Ошибка: {e}')
+
+
+async def get_weather_data_from_agro(agro_id: int) -> list:
+    """ Текущая погода по метеостанциям Агро (см. db.get_weather_data_from_agro)"""
+    try:
+        return await fetch('get_weather_data_from_agro', db.SQL_WEATHER_DATA_FROM_AGRO, (agro_id,))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить данные по текущей погоде для Агро {agro_id}. Ошибка: {e}')
+
+
+async def get_weather_data_from_agros(agro_list: list) -> dict:
+    """ Текущая погода по нескольким Агро, запросы выполняются одновременно
+
+    :return:
+        Словарь {номер Агро: данные о погоде}
+    """
+    return dict(zip(agro_list, await gather(*map(get_weather_data_from_agro, agro_list))))
+
+
+async def get_weather_station_name(weather_station_id: int) -> str:
+    """ Название метеостанции (см. db.get_weather_station_name)"""
+    try:
+        return (await fetch('get_weather_station_name', db.SQL_WEATHER_STATION_NAME, (weather_station_id,)))[0][0]
+    except (psycopg2.Error, IndexError) as e:
+        logger.critical(f'Невозможно получить информацию по названию. Ошибка: {e}')
+
+
+async def get_weather_station_names(weather_station_ids: list) -> dict:
+    """ Названия нескольких метеостанций, запросы выполняются одновременно
+
+    :return:
+        Словарь {id метеостанции: название}
+    """
+    weather_station_ids = list(dict.fromkeys(weather_station_ids))
+    return dict(zip(weather_station_ids, await gather(*map(get_weather_station_name, weather_station_ids))))
+
+
+async def get_amount_of_precipitation_for_the_last_day(weather_station_id: int) -> float:
+    """ Сумма осадков за прошедшие сутки (см. db.get_amount_of_precipitation_for_the_last_day)"""
+    try:
+        return (await fetch('get_amount_of_precipitation_for_the_last_day',
+                            *db.precipitation_query(weather_station_id)))[0][0]
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить сумму осадков. Ошибка: {e}')
+
+
+async def get_weather_archive_period(station_id: int, date_start: datetime.date, date_end: datetime.date,
+                                     step: str) -> list:
+    """ Архив температуры и осадков за период (см. db.get_weather_archive_period)"""
+    try:
+        return await fetch('get_weather_archive_period',
+                           *db.weather_archive_period_query(station_id, date_start, date_end, step))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить архивные данные о погоде за период. Ошибка запроса БД: {e}')
+
+
+async def get_zone_id_from_agro(agro_id: int) -> list:
+    """ Микрозоны Агро (см. db.get_zone_id_from_agro)"""
+    try:
+        return await fetch('get_zone_id_from_agro', *db.zone_query(agro_id))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить данные о микрозонах. Ошибка: {e}')
+
+
+async def get_forecast_data(zone_id: int) -> list:
+    """ Прогноз погоды по микрозоне (см. db.get_forecast_data)"""
+    try:
+        return await fetch('get_forecast_data', db.SQL_FORECAST_DATA, (zone_id,))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить данные о погоде в микрозонах. Ошибка: {e}')
+
+
+async def get_forecast_name(zone_id: int) -> str:
+    """ Название микрозоны (см. db.get_forecast_name)"""
+    try:
+        return (await fetch('get_forecast_name', db.SQL_FORECAST_NAME, (zone_id,)))[0][0]
+    except (psycopg2.Error, IndexError) as e:
+        logger.critical(f'Невозможно получить название микрозоны. Ошибка: {e}')
+
+
+async def get_forecast_dates(zone_id: int) -> list:
+    """ Даты прогноза по микрозоне (см. db.get_forecast_dates)"""
+    try:
+        return await fetch('get_forecast_dates', db.SQL_FORECAST_DATES, (zone_id,))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить даты прогноза. Ошибка: {e}')
+
+
+async def get_forecast_version() -> tuple:
+    """ Версия данных прогноза погоды (см. db.get_forecast_version)"""
+    try:
+        return (await fetch('get_forecast_version', db.SQL_FORECAST_VERSION))[0]
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить версию данных прогноза погоды. Ошибка: {e}')
+
+
+async def get_forecast_data_with_date(zone_id: int, forecast_date: datetime.date = None) -> tuple[Any, ...]:
+    """ Прогноз погоды по микрозоне на дату (см. db.get_forecast_data_with_date)"""
+    if not forecast_date:
+        return None
+    try:
+        date_start = datetime.strptime(str(forecast_date), '%Y-%m-%d')
+        forecast_data = await fetch('get_forecast_data_with_date', db.SQL_FORECAST_DATA_WITH_DATE,
+                                    (zone_id, date_start, date_start + timedelta(days=1)))
+        if forecast_data:
+            return forecast_data[0]
+    except (psycopg2.Error, ValueError) as e:
+        logger.critical(f'Невозможно получить данные о погоде в микрозонах. Ошибка: {e}')
+
+
+async def get_all_forecast_data() -> list:
+    """ Прогноз погоды по всем микрозонам (см. db.get_all_forecast_data)"""
+    try:
+        return await fetch('get_all_forecast_data', db.SQL_ALL_FORECAST_DATA)
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить прогноз погоды по всем микрозонам. Ошибка: {e}')
+
+
+async def not_responding(devices: list, ip_index: int, count: int) -> list:
+    """ Устройства, которые не отвечают на ping. Проверки выполняются одновременно в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(None, partial(pythonping.ping, device[ip_index],
+                                                                        count=count))
+                                     for device in devices))
+    return [device for device, result in zip(devices, results) if not result.success()]
+
+
+async def check_cameras() -> list:
+    """ Камеры, которые не отвечают на ping (см. db.check_cameras)"""
+    try:
+        return await not_responding(await fetch('check_cameras', db.SQL_CAMERAS), ip_index=2, count=1)
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить данные о статусе видеокамер. Ошибка: {e}')
+
+
+async def check_weatherstations() -> list:
+    """ Метеостанции, которые не отвечают на ping (см. db.check_weatherstations)"""
+    try:
+        return await not_responding(await fetch('check_weatherstations', db.SQL_WEATHER_STATIONS), ip_index=7,
+                                    count=2)
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить данные о статусе метеостанций. Ошибка: {e}')
+
+
+async def get_list_weather_stations_id() -> list:
+    """ Отсортированный список id метеостанций (см. db.get_list_weather_stations_id)"""
+    try:
+        return sorted(row[0] for row in await fetch('get_list_weather_stations_id', db.SQL_WEATHER_STATIONS_ID))
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить список метеостанций из базы данных. Ошибка: {e}')
+
+
+async def get_max_id_from_layer(agro_id: int) -> int:
+    """ Максимальный id спутникового снимка по Агро (см. db.get_max_id_from_layer)"""
+    try:
+        return (await fetch('get_max_id_from_layer', db.SQL_MAX_ID_FROM_LAYER, (agro_id, 'visual')))[0][0]
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить id последнего снимка. Ошибка: {e}')
@@ -0,0 +1,373 @@
+""" Асинхронный режим работы бота (RUNTIME=asyncio в .env).
+    Вместо отдельных потоков на опрос Telegram, уведомления, проверки метеостанций и камер и каждое расписание
+    всё работает в одном цикле событий asyncio. Уведомления и проверки обращаются к базе данных через
+    async_dboperator, остальные блокирующие запросы выполняются в пуле потоков ограниченного размера
+    (settings.ASYNC_WORKERS).
+
+    Частые экраны (текущая погода, батарейки, прогноз) обрабатываются сопрограммами: данные читаются через
+    async_dboperator одновременно (gather), готовые экраны берутся из общего с main.py кэша render_cache.
+    Остальные команды и кнопки передаются синхронным обработчикам из main.py, которые также выполняются в пуле
+"""
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+from functools import partial
+from typing import Callable
+
+import telebot
+from decouple import config
+from telebot.async_telebot import AsyncTeleBot
+
+import alerts
+import async_dboperator as adb
+import battery
+import dboperator as db
+import geo
+import settings
+from dedup import UpdateDeduplicator
+from metrics import measure, metrics
+from migrations import check_migrations
+from recorder import start_recorder
+from rollup import start_rollups
+from search import search_index
+from snapshot import start_snapshot
+from subscriptions import AGRO_LIST, subscription_index
+from utils import create_button, forecast_index, parse_query, render_cache, start_weather_version
+
+logger = logging.getLogger('__name__')
+
+
+class IntakeAsyncTeleBot(AsyncTeleBot):
+    """ AsyncTeleBot, который пропускает входящие обновления через функции приёма, как utils.IntakeTeleBot"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.intake = []
+
+    async def process_new_updates(self, updates: list) -> None:
+        """ Передаёт обновления функциям приёма, а затем обработчикам"""
+        for hook in self.intake:
+            updates = hook(updates)
+        if updates:
+            await super().process_new_updates(updates)
+
+
+class AsyncRuntime:
+    """ Асинхронный режим работы бота
+
+    :param legacy:
+        Модуль main с синхронными обработчиками и функциями построения экранов и уведомлений
+    :param workers:
+        Размер пула потоков для запросов к базе данных и синхронных обработчиков
+    """
+
+    # Кнопки, которые обрабатываются сопрограммами, если Агро уже выбрано
+    NATIVE_BUTTONS = ('weather', 'battery', 'forecast_zones_date')
+
+    def __init__(self, legacy, workers: int = 8, retries: int = 5) -> None:
+        self.legacy = legacy
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='async-worker')
+        self.bot = IntakeAsyncTeleBot(config('TOKEN', default=''))
+        self.bot.intake.append(UpdateDeduplicator(answer=self.answer_duplicate).filter_updates)
+        # Запись входящих обновлений (recorder.py). Обработчики main.py вызываются в обход функций приёма
+        # синхронного бота, поэтому запись подключается к асинхронному
+        start_recorder(self.bot)
+        # Экраны строятся сопрограммами с теми же названиями и версиями данных, что и в main.py
+        self.render_weather = render_cache.acached(legacy.render_weather.screen_name,
+                                                   legacy.render_weather.version)(self._render_weather)
+        self.render_weather_battery = render_cache.acached(legacy.render_weather_battery.screen_name,
+                                                           legacy.render_weather_battery.version)(
+            self._render_weather_battery)
+        self.render_forecast = render_cache.acached(legacy.Forecast.render_forecast.screen_name,
+                                                    legacy.Forecast.render_forecast.version)(self._render_forecast)
+        self._register_handlers()
+
+    async def blocking(self, func: Callable, *args, **kwargs):
+        """ Выполняет блокирующую функцию в пуле потоков"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def call_api(self, method: str, **kwargs):
+        """ Запрос к Telegram API с повторными попытками. При ответе 429 выдерживается пауза retry_after"""
+        for attempt in range(self.retries):
+            try:
+                with measure('bot_telegram_api_seconds', help_text='Время запросов к Telegram API', method=method):
+                    return await getattr(self.bot, method)(**kwargs)
+            except Exception as e:
+                metrics.inc('bot_telegram_api_retries_total', help_text='Повторные попытки отправки сообщений',
+                            function=method)
+                parameters = (getattr(e, 'result_json', None) or {}).get('parameters') or {}
+                await asyncio.sleep(parameters.get('retry_after', min(2 ** attempt, 30)))
+        logger.critical(f'Запрос {method} к Telegram API не выполнен за {self.retries} попыток')
+        return None
+
+    async def send(self, users: int or list, text: str, keyboard: telebot.types.InlineKeyboardMarkup = None,
+                   back: bool = False) -> None:
+        """ Отправляет сообщение пользователю или списку пользователей, как send_bot_message"""
+        for user in users if isinstance(users, list) else [users]:
+            await self.call_api('send_message', chat_id=user, text=text, parse_mode='Markdown', reply_markup=keyboard)
+            if back:
+                await self.back_message(user)
+
+    async def back_message(self, user: int) -> None:
+        """ Сообщение о возврате в основное меню (кроме пользователей с ролью 9999)"""
+        if await adb.get_role(telegram_id=user) != 9999:
+            await self.call_api('send_message', chat_id=user, text='Возврат в _основное меню_:',
+                                parse_mode='Markdown', reply_markup=create_button('menu'))
+
+    def answer_duplicate(self, query: telebot.types.CallbackQuery) -> None:
+        """ Ответ на отброшенное повторное нажатие кнопки. Вызывается из функции приёма, поэтому без ожидания"""
+        asyncio.create_task(self.call_api('answer_callback_query', callback_query_id=query.id))
+
+    async def delete_message(self, query: telebot.types.CallbackQuery) -> None:
+        """ Попытка удаления сообщения. В случае ошибки - сообщение будет оставлено"""
+        try:
+            await self.bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.id)
+        except Exception as e:
+            logger.critical(f'Ошибка при удалении сообщения: {e}')
+
+    def _register_handlers(self) -> None:
+        """ Регистрирует обработчики: частые экраны - сопрограммы, остальное - синхронные обработчики main.py"""
+
+        def is_native(query: telebot.types.CallbackQuery) -> bool:
+            data = parse_query(query=query)
+            return data.get('button') in self.NATIVE_BUTTONS and bool(data.get('agro'))
+
+        @self.bot.callback_query_handler(func=is_native)
+        async def native_button_handler(query: telebot.types.CallbackQuery) -> None:
+            data = parse_query(query=query)
+            with measure('bot_handler_seconds', help_text=self.legacy.HANDLER_HELP,
+                         route=f'callback:{data.get("button")}'):
+                await self.answer_screen(query=query, data=data)
+
+        @self.bot.callback_query_handler(func=lambda query: True)
+        async def legacy_button_handler(query: telebot.types.CallbackQuery) -> None:
+            await self.blocking(self.legacy.bot.process_new_callback_query, [query])
+
+        @self.bot.inline_handler(func=lambda query: True)
+        async def legacy_inline_handler(query: telebot.types.InlineQuery) -> None:
+            await self.blocking(self.legacy.bot.process_new_inline_query, [query])
+
+        @self.bot.message_handler(func=lambda message: True, content_types=telebot.util.content_type_media)
+        async def legacy_message_handler(message: telebot.types.Message) -> None:
+            await self.blocking(self.legacy.bot.process_new_messages, [message])
+
+    async def _render_weather(self, agro_id: int) -> tuple or None:
+        """ Экран текущей погоды (см. main.render_weather). Названия метеостанций запрашиваются одновременно"""
+        weather_data = await adb.get_weather_data_from_agro(agro_id)
+        if not weather_data:
+            return None
+        names = await adb.get_weather_station_names([weather[9] for weather in weather_data])
+        return self.legacy.weather_view(weather_data, names)
+
+    async def _render_weather_battery(self, agro_id: int) -> tuple or None:
+        """ Экран состояния батареек (см. main.render_weather_battery)"""
+        weather_data = await adb.get_weather_data_from_agro(agro_id)
+        if not weather_data:
+            return None
+        names = await adb.get_weather_station_names([weather[9] for weather in weather_data])
+        return self.legacy.weather_battery_view(weather_data, names, agro_id)
+
+    async def _render_forecast(self, zone_id: str, forecast_date: str, agro_id: str) -> tuple or None:
+        """ Экран прогноза погоды (см. main.Forecast.render_forecast). База данных используется, только если
+            индекс прогноза ещё не построен
+        """
+        zone = forecast_index.get_forecast(zone_id=zone_id, forecast_date=forecast_date)
+        zone_name = forecast_index.get_zone_name(zone_id=zone_id)
+        if not zone:
+            zone = await adb.get_forecast_data_with_date(zone_id, forecast_date)
+        if not zone:
+            return None
+        if not zone_name:
+            zone_name = await adb.get_forecast_name(zone_id)
+        return self.legacy.Forecast.forecast_view(zone, zone_name, zone_id=zone_id, agro_id=agro_id)
+
+    async def build_screen(self, data: dict) -> tuple:
+        """ Экран погоды, батареек или прогноза. Пока база данных недоступна, экран строится синхронной функцией
+            main.py, которая отдаёт экран из кэша или по локальному снимку с отметкой о времени данных
+        """
+        native = db.circuit.closed
+        if data.get('button') == 'weather':
+            agro_id = int(data.get('agro'))
+            if not native:
+                return await self.blocking(self.legacy.weather_screen, agro_id=agro_id)
+            return await self.render_weather(agro_id=agro_id) or self.legacy.weather_unavailable()
+        if data.get('button') == 'battery':
+            agro_id = int(data.get('agro'))
+            if not native:
+                return await self.blocking(self.legacy.weather_battery_screen, agro_id=agro_id)
+            return await self.render_weather_battery(agro_id=agro_id) or self.legacy.weather_battery_unavailable()
+
+        kwargs = {'zone_id': data.get('zone'), 'forecast_date': data.get('date'), 'agro_id': data.get('agro')}
+        if not native:
+            return await self.blocking(self.legacy.Forecast.forecast_screen, **kwargs)
+        return await self.render_forecast(**kwargs) or \
+            self.legacy.Forecast.forecast_unavailable(zone_id=kwargs['zone_id'], agro_id=kwargs['agro_id'])
+
+    async def answer_screen(self, query: telebot.types.CallbackQuery, data: dict) -> None:
+        """ Ответ экраном погоды, батареек или прогноза. Экран строится одновременно с ответом на нажатие кнопки
+            и удалением предыдущего сообщения
+        """
+        _, _, (text, keyboard) = await asyncio.gather(
+            self.call_api('answer_callback_query', callback_query_id=query.id),
+            self.delete_message(query),
+            self.build_screen(data))
+        await self.send(users=query.message.chat.id, text=text, keyboard=keyboard)
+
+    async def watch_sentinel(self, agro_list: list) -> None:
+        """ Уведомление о публикации нового спутникового снимка. Одна сопрограмма на все хозяйства"""
+        last_id = dict(zip(agro_list, await adb.gather(*map(adb.get_max_id_from_layer, agro_list))))
+        while True:
+            await asyncio.sleep(5)
+            current = await adb.gather(*map(adb.get_max_id_from_layer, agro_list))
+            for agro_id, current_id in zip(agro_list, current):
+                if current_id is None:
+                    continue
+                if last_id[agro_id] is not None and current_id > last_id[agro_id]:
+                    await self.send(users=subscription_index.recipients('sentinel', agro_id),
+                                    text=self.legacy.sentinel_alert_text(agro_id), back=True)
+                last_id[agro_id] = current_id
+
+    async def probe(self, check: Callable, notify: Callable) -> None:
+        """ Проверка состояния в рабочее время: о неполадке уведомляется, если она повторилась через минуту,
+            после уведомления следующая проверка - через 2 часа
+        """
+        while True:
+            await asyncio.sleep(1)
+            if not self.legacy.is_working_time():
+                continue
+            first = await check()
+            await asyncio.sleep(60)
+            second = await check()
+            if first and second:
+                await notify(second)
+                await asyncio.sleep(7200)
+
+    async def notify_weather_stations(self, weatherstations: list) -> None:
+        """ Уведомление о неработающих метеостанциях"""
+        text = self.legacy.weather_stations_alert_text(weatherstations)
+        if text:
+            await self.send(users=subscription_index.recipients('weather_stations'), text=text, back=True)
+
+    async def notify_cameras(self, cameras: list) -> None:
+        """ Уведомления о неработающих камерах с их местоположением"""
+        for msg, lat, lon in self.legacy.camera_alerts(cameras):
+            users = subscription_index.recipients('cameras')
+            await self.send(users=users, text=msg)
+            for user in users:
+                await self.call_api('send_location', chat_id=user, longitude=lon, latitude=lat)
+                await self.back_message(user)
+
+    async def daily(self, at: str, job: Callable) -> None:
+        """ Запускает блокирующую функцию в пуле потоков каждый день в указанное время (ЧЧ:ММ:СС)"""
+        start = time.fromisoformat(at)
+        while True:
+            now = datetime.now()
+            moment = datetime.combine(now.date(), start)
+            if moment <= now:
+                moment += timedelta(days=1)
+            await asyncio.sleep((moment - now).total_seconds())
+            try:
+                await self.blocking(job)
+            except Exception as e:
+                logger.critical(f'Ошибка при выполнении {job.__name__} по расписанию: {e}')
+
+    async def watch_weather(self) -> None:
+        """ Уведомления о погоде по правилам alerts.py (см. main.check_weather_alerts)"""
+        engine = await self.blocking(alerts.create_engine)
+        while True:
+            # Правила считаются в пуле потоков, названия метеостанций запрашиваются одновременно
+            found = await self.blocking(engine.poll)
+            names = await adb.get_weather_station_names([alert[1] for alert in found])
+            for users, texts in self.legacy.weather_alert_messages(engine, found, names).items():
+                for number, text in enumerate(texts, 1):
+                    await self.send(users=list(users), text=text, back=number == len(texts))
+            await asyncio.sleep(getattr(settings, 'ALERT_POLL_SECONDS', 60))
+
+    async def watch_batteries(self) -> None:
+        """ Прогноз разряда батарей метеостанций и уведомления о скором отключении (см. main.check_batteries)"""
+        alerted = {}
+        while True:
+            if await self.blocking(battery.battery_forecast.refresh) and self.legacy.is_working_time():
+                low = self.legacy.due_battery_alerts(alerted)
+                text = self.legacy.battery_alert_text(low, await adb.get_weather_station_names(list(low)))
+                if text:
+                    await self.send(users=subscription_index.recipients('battery'), text=text, back=True)
+            await asyncio.sleep(battery.REFRESH_SECONDS)
+
+    async def refresh_forecast_index(self) -> None:
+        """ Перестроение индекса прогноза погоды при изменении версии прогноза, раз в 10 минут"""
+        version = None
+        while True:
+            version = await self.blocking(self.legacy.update_forecast_index, version)
+            await asyncio.sleep(600)
+
+    @staticmethod
+    def _log_task_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logger.critical(f'Задача {task.get_name()} завершилась с ошибкой: {task.exception()!r}')
+
+    async def serve(self) -> None:
+        """ Запускает все сопрограммы и ожидает сигнала остановки (SIGINT, SIGTERM)"""
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(self.executor)
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        coroutines = {
+            'polling': self.bot.polling(non_stop=True, timeout=20),
+            'sentinel': self.watch_sentinel(AGRO_LIST),
+            'weather_stations': self.probe(adb.check_weatherstations, self.notify_weather_stations),
+            'cameras': self.probe(adb.check_cameras, self.notify_cameras),
+            'forecast_index': self.refresh_forecast_index(),
+            'weather_alerts': self.watch_weather(),
+            'batteries': self.watch_batteries(),
+            'alerts_rain': self.daily('08:00:00', self.legacy.alerts_rain.__wrapped__),
+        }
+        for time_ in settings.TIMES_FORECAST_VLG:
+            coroutines[f'forecast_volgograd_{time_}'] = self.daily(time_,
+                                                                   self.legacy.alert_forecast_volgograd.__wrapped__)
+
+        tasks = []
+        for name, coroutine in coroutines.items():
+            task = asyncio.create_task(coroutine, name=name)
+            task.add_done_callback(self._log_task_error)
+            tasks.append(task)
+        logger.critical(f'Бот запущен в асинхронном режиме. Задач: {len(tasks)}')
+
+        await stop.wait()
+        logger.critical('Остановка бота...')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.bot.close_session()
+        adb.pool.close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        logger.critical('Бот остановлен')
+
+
+def run(legacy) -> None:
+    """ Запуск бота в асинхронном режиме
+
+    :param legacy:
+        Модуль main. Передаётся явно, так как при запуске python main.py он загружен под именем __main__
+    """
+    # Синхронные обработчики вызываются в пуле потоков, поэтому собственный пул TeleBot не нужен
+    legacy.bot.threaded = False
+    legacy.main().join()
+    legacy.start_metrics()
+    check_migrations()
+    start_snapshot()
+    start_rollups()
+    start_weather_version()
+    subscription_index.load()
+    geo.location_index.load()
+    search_index.load()
+    runtime = AsyncRuntime(legacy, workers=getattr(settings, 'ASYNC_WORKERS', 8))
+    asyncio.run(runtime.serve())
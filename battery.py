@@ -0,0 +1,151 @@
+""" Прогноз разряда батарей метеостанций по истории напряжения.
+    История всех метеостанций (наименьшее за сутки напряжение за BATTERY_HISTORY_DAYS дней) читается одним
+    запросом, по каждой метеостанции строится линейный тренд методом наименьших квадратов и оценивается
+    количество дней до напряжения отключения BATTERY_CUTOFF_VOLTAGE.
+
+    Суммы для трендов всех метеостанций считаются векторно (numpy.bincount, пакет указан в requirements.txt),
+    без numpy - в цикле.
+    Прогноз пересчитывается в фоне раз в BATTERY_REFRESH_SECONDS секунд и хранится в памяти для меню батареек
+    и уведомлений
+"""
+import threading
+from datetime import date, datetime, timedelta
+
+import dboperator as db
+import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Напряжение, при котором метеостанция перестаёт работать
+CUTOFF_VOLTAGE = getattr(settings, 'BATTERY_CUTOFF_VOLTAGE', 3.5)
+# Количество последних дней, по которым строится тренд
+HISTORY_DAYS = getattr(settings, 'BATTERY_HISTORY_DAYS', 30)
+# Наименьшее количество дней с показаниями для построения тренда
+MIN_POINTS = getattr(settings, 'BATTERY_MIN_POINTS', 5)
+# Уведомлять, если до отключения осталось не больше этого количества дней
+ALERT_DAYS = getattr(settings, 'BATTERY_ALERT_DAYS', 7)
+REFRESH_SECONDS = getattr(settings, 'BATTERY_REFRESH_SECONDS', 3600)
+
+
+def group_sums(groups: list, xs: list, ys: list, size: int) -> tuple:
+    """ Суммы n, x, y, x², xy по группам
+
+    :param groups:
+        Номер группы (0..size-1) каждой точки
+    :return:
+        Кортеж последовательностей длиной size
+    """
+    if numpy is not None:
+        groups = numpy.asarray(groups, dtype=numpy.intp)
+        xs, ys = numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float)
+        return tuple(numpy.bincount(groups, weights=weights, minlength=size)
+                     for weights in (None, xs, ys, xs * xs, xs * ys))
+    sums = [[0.0] * size for _ in range(5)]
+    for group, x, y in zip(groups, xs, ys):
+        for number, value in enumerate((1, x, y, x * x, x * y)):
+            sums[number][group] += value
+    return tuple(sums)
+
+
+def fit_trends(rows: list, today: date = None) -> dict:
+    """ Тренды напряжения по истории из db.get_battery_voltage_history
+
+    :return:
+        Словарь {id метеостанции: {'voltage': последнее напряжение, 'date': день последнего показания,
+        'below': последнее напряжение не выше порога отключения, 'slope': изменение напряжения за сутки или None,
+        'days_left': дней до отключения или None}}.
+        days_left равно None, если напряжение не снижается или показаний мало для тренда. Если последнее
+        напряжение выше порога, а тренд уже опустился до него, days_left равно 0 при below False
+    """
+    today = today or date.today()
+    stations, groups, xs, ys, latest = {}, [], [], [], {}
+    for station_id, day, voltage in rows:
+        group = stations.setdefault(station_id, len(stations))
+        groups.append(group)
+        # x - номер дня относительно сегодняшнего (0 - сегодня, отрицательные - прошлые дни)
+        xs.append((day - today).days)
+        ys.append(float(voltage))
+        latest[station_id] = (day, float(voltage))
+
+    counts, sum_x, sum_y, sum_xx, sum_xy = group_sums(groups, xs, ys, len(stations))
+    trends = {}
+    for station_id, group in stations.items():
+        day, voltage = latest[station_id]
+        trend = {'voltage': voltage, 'date': day, 'below': voltage <= CUTOFF_VOLTAGE, 'slope': None,
+                 'days_left': None}
+        n = counts[group]
+        denominator = n * sum_xx[group] - sum_x[group] ** 2
+        if n >= MIN_POINTS and denominator > 0:
+            slope = (n * sum_xy[group] - sum_x[group] * sum_y[group]) / denominator
+            intercept = (sum_y[group] - slope * sum_x[group]) / n
+            trend['slope'] = float(slope)
+            if trend['below']:
+                trend['days_left'] = 0.0
+            elif slope < 0:
+                # intercept - напряжение по тренду на сегодня
+                trend['days_left'] = max(float((CUTOFF_VOLTAGE - intercept) / slope), 0.0)
+        elif trend['below']:
+            trend['days_left'] = 0.0
+        trends[station_id] = trend
+    return trends
+
+
+class BatteryForecast:
+    """ Последний рассчитанный прогноз разряда батарей всех метеостанций"""
+
+    def __init__(self):
+        self.trends = {}
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """ Пересчитывает прогноз по истории напряжения из базы данных
+
+        :return:
+            False, если историю получить не удалось (остаётся предыдущий прогноз)
+        """
+        rows = db.get_battery_voltage_history(date_start=date.today() - timedelta(days=HISTORY_DAYS))
+        if rows is None:
+            return False
+        trends = fit_trends(rows)
+        with self._lock:
+            self.trends = trends
+            self.updated_at = datetime.now()
+        return True
+
+    def get(self, station_id: int) -> dict or None:
+        with self._lock:
+            return self.trends.get(station_id)
+
+    def low(self, days: float = ALERT_DAYS) -> dict:
+        """ Метеостанции, до отключения которых осталось не больше days дней"""
+        with self._lock:
+            return {station_id: trend for station_id, trend in self.trends.items()
+                    if trend['days_left'] is not None and trend['days_left'] <= days}
+
+    @property
+    def version(self):
+        """ Версия прогноза для кэша экранов"""
+        return self.updated_at
+
+
+def describe(trend: dict or None) -> str:
+    """ Строка прогноза для меню батареек"""
+    if trend is not None and trend.get('below'):
+        return 'Прогноз: *напряжение ниже порога отключения*'
+    if trend is None or trend['slope'] is None:
+        return 'Прогноз: недостаточно данных'
+    if trend['days_left'] is None:
+        return 'Прогноз: напряжение не снижается'
+    if trend['days_left'] > 365:
+        return 'Прогноз: разряда в ближайший год не ожидается'
+    if trend['days_left'] < 1:
+        return f'Прогноз: *отключение в ближайшие сутки* (снижение {abs(trend["slope"]):.3f} В/сутки)'
+    return f'Прогноз: отключение примерно через {trend["days_left"]:.0f} дн. ' \
+           f'(снижение {abs(trend["slope"]):.3f} В/сутки)'
+
+
+battery_forecast = BatteryForecast()
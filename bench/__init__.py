@@ -0,0 +1,3 @@
+""" Инструменты нагрузочного тестирования бота: поддельный Telegram Bot API, заполнение локальной базы
+    синтетическими данными и замер времени обработки запросов по пунктам меню
+"""
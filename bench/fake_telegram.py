@@ -0,0 +1,179 @@
+""" Поддельный сервер Telegram Bot API для нагрузочного тестирования.
+    Записывает все отправленные ботом сообщения, умеет имитировать задержку сети и ответы 429
+"""
+import json
+import random
+import threading
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qsl, urlparse
+
+import telebot
+
+
+class FakeTelegramServer:
+    """ Поддельный Telegram Bot API
+
+    :param latency:
+        Задержка ответа на каждый запрос в секундах
+    :param rate_429:
+        Доля запросов, на которые сервер отвечает ошибкой 429 Too Many Requests
+    :param retry_after:
+        Значение retry_after в ответе 429
+    """
+
+    def __init__(self, latency: float = 0.0, rate_429: float = 0.0, retry_after: int = 1,
+                 host: str = '127.0.0.1', port: int = 0) -> None:
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.sent = []
+        self.methods = Counter()
+        self.updates = deque()
+        self._lock = threading.Lock()
+        self._sent_condition = threading.Condition(self._lock)
+        self._message_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    @property
+    def api_url(self) -> str:
+        """ Шаблон адреса API для telebot.apihelper.API_URL"""
+        return f'http://{self._server.server_address[0]}:{self.port}/bot{{0}}/{{1}}'
+
+    def start(self) -> 'FakeTelegramServer':
+        """ Запускает сервер и перенаправляет на него все запросы telebot"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name='fake-telegram')
+        self._thread.start()
+        telebot.apihelper.API_URL = self.api_url
+        return self
+
+    def stop(self) -> None:
+        """ Останавливает сервер"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_updates(self, updates: list) -> None:
+        """ Добавляет обновления, которые бот получит через getUpdates"""
+        with self._lock:
+            self.updates.extend(updates)
+
+    def wait_for_message(self, chat_id: int, after: float, timeout: float = 30.0) -> float or None:
+        """ Ожидает первое сообщение пользователю, отправленное после указанного момента
+        :return:
+            Время отправки сообщения или None, если сообщение не пришло за timeout секунд
+        """
+        chat_id = str(chat_id)
+        deadline = time() + timeout
+        with self._sent_condition:
+            checked = 0
+            while True:
+                for message in self.sent[checked:]:
+                    if message['chat_id'] == chat_id and message['time'] >= after:
+                        return message['time']
+                checked = len(self.sent)
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return None
+                self._sent_condition.wait(remaining)
+
+    def reset(self) -> None:
+        """ Очищает записанные сообщения и счётчики"""
+        with self._lock:
+            self.sent.clear()
+            self.methods.clear()
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _take_updates(self, offset: int, limit: int) -> list:
+        with self._lock:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            return [self.updates[i] for i in range(min(limit, len(self.updates)))]
+
+    def handle(self, method: str, params: dict) -> tuple:
+        """ Обрабатывает запрос к API
+        :return:
+            Код ответа HTTP и тело ответа
+        """
+        if self.latency:
+            sleep(self.latency)
+
+        with self._lock:
+            self.methods[method] += 1
+
+        if method != 'getUpdates' and self.rate_429 and random.random() < self.rate_429:
+            with self._lock:
+                self.methods['429'] += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench',
+                                                'username': 'bench_bot'}}
+        if method == 'getUpdates':
+            updates = self._take_updates(offset=int(params.get('offset', 0) or 0),
+                                         limit=int(params.get('limit', 100) or 100))
+            if not updates:
+                # Имитация long polling без удержания соединения
+                sleep(min(float(params.get('timeout', 0) or 0), 0.05))
+            return 200, {'ok': True, 'result': updates}
+
+        if method.startswith('send') and method != 'sendChatAction':
+            chat_id = params.get('chat_id')
+            with self._sent_condition:
+                self.sent.append({'time': time(), 'method': method, 'chat_id': chat_id,
+                                  'text': params.get('text') or params.get('caption')})
+                self._sent_condition.notify_all()
+            message = {'message_id': self._next_message_id(), 'date': int(time()),
+                       'chat': {'id': int(chat_id) if chat_id and chat_id.lstrip('-').isdigit() else 0,
+                                'type': 'private'}}
+            if params.get('text'):
+                message['text'] = params['text']
+            return 200, {'ok': True, 'result': message}
+
+        return 200, {'ok': True, 'result': True}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """ Обработчик HTTP-запросов поддельного API"""
+
+            def _serve(self) -> None:
+                url = urlparse(self.path)
+                method = url.path.rstrip('/').split('/')[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                if body and content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qsl(body.decode('utf-8')))
+                elif body and content_type.startswith('application/json'):
+                    params.update({key: str(value) for key, value in json.loads(body).items()})
+
+                status, answer = server.handle(method, params)
+                data = json.dumps(answer).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _serve
+            do_POST = _serve
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
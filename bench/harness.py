@@ -0,0 +1,204 @@
+""" Замер производительности обработчиков бота по пунктам меню.
+    Бот работает с поддельным Telegram Bot API и локальной базой PostgreSQL с синтетическими данными.
+
+    Пример запуска (settings.py должен быть доступен, DB_CONFIG подменяется на --dsn):
+        python -m bench.harness --dsn "dbname=bench user=postgres" --requests 500 --concurrency 8
+"""
+import argparse
+import itertools
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+import telebot
+
+from bench.fake_telegram import FakeTelegramServer
+from bench.seed import describe, seed
+
+_update_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def next_update_id() -> int:
+    with _lock:
+        return next(_update_ids)
+
+
+def make_message(chat_id: int, text: str) -> dict:
+    """ Обновление с текстовым сообщением (или командой) от пользователя"""
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}
+    message = {'message_id': next_update_id(), 'date': int(time()), 'text': text, 'from': user,
+               'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Bench'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next_update_id(), 'message': message}
+
+
+def make_callback(chat_id: int, data: str) -> dict:
+    """ Обновление с нажатием кнопки"""
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}
+    message = {'message_id': next_update_id(), 'date': int(time()), 'from': user,
+               'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Bench'}}
+    return {'update_id': next_update_id(),
+            'callback_query': {'id': str(next_update_id()), 'from': user, 'chat_instance': str(chat_id),
+                               'data': data, 'message': message}}
+
+
+def menu_paths(info: dict) -> dict:
+    """ Пункты меню, по которым идёт замер. Каждый пункт - функция, создающая обновление для пользователя"""
+    agro_list = sorted(info['stations'])
+
+    def station_of(agro_id: int) -> int:
+        return random.choice(info['stations'][agro_id])
+
+    def zone_of(agro_id: int) -> int:
+        return random.choice(info['zones'][agro_id])
+
+    def with_agro(build):
+        def factory(chat_id: int) -> dict:
+            return build(chat_id, random.choice(agro_list))
+        return factory
+
+    return {
+        'menu': lambda chat_id: make_message(chat_id, '/menu'),
+        'weather': with_agro(lambda chat_id, agro: make_callback(chat_id, f'button:weather,agro:{agro}')),
+        'battery': with_agro(lambda chat_id, agro: make_callback(chat_id, f'button:battery,agro:{agro}')),
+        'archive_stations': with_agro(lambda chat_id, agro: make_callback(chat_id, f'button:archive,agro:{agro}')),
+        'archive_week': with_agro(lambda chat_id, agro: make_callback(
+            chat_id, f'button:archive_stations_date,week:{random.randint(1, 4)},'
+                     f'station:{station_of(agro)},agro:{agro}')),
+        'forecast_dates': with_agro(lambda chat_id, agro: make_callback(
+            chat_id, f'button:forecast_zones,zone:{zone_of(agro)},agro:{agro}')),
+        'forecast': with_agro(lambda chat_id, agro: make_callback(
+            chat_id, f'button:forecast_zones_date,date:{random.choice(info["forecast_dates"])},'
+                     f'zone:{zone_of(agro)},agro:{agro}')),
+    }
+
+
+class BotDriver:
+    """ Запускает обработчики из main.py и передаёт им обновления синхронно, замеряя время обработки
+
+    :param dsn:
+        Строка подключения к тестовой базе. Если None - используются настройки из settings.py
+        или подменённые функции dboperator (воспроизведение записи)
+    :param throttled:
+        Оставить ограничение частоты запросов (throttle.py). По умолчанию отключено: пользователи нагрузки
+        повторяют одни и те же сессии, и отказы искажали бы задержки и считались бы ошибками
+    """
+
+    def __init__(self, dsn: str = None, throttled: bool = False) -> None:
+        import dboperator as db
+        import main
+        import throttle
+
+        if dsn is not None:
+            db.db_config = {'dsn': dsn}
+        if not throttled:
+            throttle.throttle.rules = {}
+        self.db = db
+        self.main = main
+        self.bot = main.bot
+        # Обработка в вызывающем потоке, чтобы замерять полное время ответа на обновление
+        self.bot.threaded = False
+        main.main().join()
+
+    def process(self, update: dict) -> float:
+        """ Обрабатывает обновление и возвращает время обработки в секундах"""
+        start = perf_counter()
+        self.bot.process_new_updates([telebot.types.Update.de_json(update)])
+        return perf_counter() - start
+
+    def clear_caches(self) -> None:
+        """ Сбрасывает кэши экранов и запросов, чтобы замерить обработку без кэша"""
+        self.main.render_cache.invalidate()
+        self.db.get_weather_data_from_agro.flight.clear()
+        self.db.get_last_weather_data_id.flight.clear()
+
+
+def percentile(values: list, percent: float) -> float:
+    """ Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def format_report(results: dict, elapsed: float, server: FakeTelegramServer = None) -> str:
+    """ Таблица с пропускной способностью и задержками по пунктам меню"""
+    lines = [f'{"Пункт меню":<20}{"запросов":>10}{"rps":>10}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}']
+    total = 0
+    for path, latencies in sorted(results.items()):
+        total += len(latencies)
+        lines.append(f'{path:<20}{len(latencies):>10}{len(latencies) / elapsed:>10.1f}'
+                     f'{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 95) * 1000:>10.1f}'
+                     f'{percentile(latencies, 99) * 1000:>10.1f}')
+    lines.append(f'Всего: {total} запросов за {elapsed:.2f} с ({total / elapsed:.1f} rps)')
+    if server:
+        lines.append(f'Отправлено сообщений: {len(server.sent)}, ответов 429: {server.methods["429"]}')
+    return '\n'.join(lines)
+
+
+def run(driver: BotDriver, info: dict, paths: list, requests: int, concurrency: int, cold: bool = False) -> tuple:
+    """ Выполняет замер
+
+    :param paths:
+        Названия пунктов меню из menu_paths
+    :param requests:
+        Количество запросов на каждый пункт меню
+    :param concurrency:
+        Количество одновременно работающих пользователей
+    :param cold:
+        Сбрасывать кэши перед каждым запросом
+    :return:
+        Словарь задержек по пунктам меню и общее время замера
+    """
+    factories = menu_paths(info)
+    jobs = [path for path in paths for _ in range(requests)]
+    random.shuffle(jobs)
+    results = {path: [] for path in paths}
+
+    def job(path: str) -> None:
+        if cold:
+            driver.clear_caches()
+        update = factories[path](random.choice(info['telegram_ids']))
+        latency = driver.process(update)
+        with _lock:
+            results[path].append(latency)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(job, jobs))
+    return results, perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Замер производительности обработчиков бота')
+    parser.add_argument('--dsn', required=True, help='Строка подключения к тестовой базе PostgreSQL')
+    parser.add_argument('--no-seed', action='store_true', help='Не пересоздавать тестовые данные')
+    parser.add_argument('--stations-per-agro', type=int, default=2)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=200, help='Запросов на каждый пункт меню')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--paths', default=','.join(menu_paths({'stations': {1: [1]}, 'zones': {1: [1]}})),
+                        help='Пункты меню через запятую')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Задержка ответа Telegram API')
+    parser.add_argument('--rate-429', type=float, default=0, help='Доля ответов 429 от Telegram API')
+    parser.add_argument('--cold', action='store_true', help='Сбрасывать кэши перед каждым запросом')
+    args = parser.parse_args()
+
+    if args.no_seed:
+        seed_info = describe(args.dsn)
+    else:
+        seed_info = seed(args.dsn, stations_per_agro=args.stations_per_agro, days=args.days, users=args.users)
+
+    fake_server = FakeTelegramServer(latency=args.latency_ms / 1000, rate_429=args.rate_429).start()
+    bot_driver = BotDriver(dsn=args.dsn)
+    bench_results, bench_elapsed = run(bot_driver, seed_info, args.paths.split(','), requests=args.requests,
+                                       concurrency=args.concurrency, cold=args.cold)
+    print(format_report(bench_results, bench_elapsed, fake_server))
+    print(bot_driver.db.db_stats.dump())
+    fake_server.stop()
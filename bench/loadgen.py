@@ -0,0 +1,200 @@
+""" Генератор нагрузки: множество пользователей проходят типичные цепочки нажатий по меню бота.
+    Количество одновременных пользователей увеличивается ступенями до точки насыщения.
+
+    Режимы доставки обновлений:
+        direct - обновления передаются обработчикам напрямую, как при работе через webhook
+        polling - обновления выдаются поддельным API через getUpdates, бот работает в infinity_polling,
+                  время ответа считается до первого сообщения пользователю
+
+    Пример запуска:
+        python -m bench.loadgen --dsn "dbname=bench user=postgres" --mode polling --stages 1,4,16,64
+"""
+import argparse
+import json
+import random
+import threading
+from time import perf_counter, sleep, time
+
+import dboperator as db
+from bench.fake_telegram import FakeTelegramServer
+from bench.harness import BotDriver, make_callback, make_message, percentile
+from bench.seed import describe, seed
+from metrics import metrics
+
+
+def synthesize_session(info: dict) -> list:
+    """ Случайная цепочка нажатий одного пользователя: текущая погода, архив или прогноз"""
+    agro = random.choice(sorted(info['stations']))
+    station = random.choice(info['stations'][agro])
+    zone = random.choice(info['zones'][agro])
+    kind = random.choice(['weather', 'archive', 'forecast'])
+
+    if kind == 'weather':
+        return ['/menu', 'button:weather', f'button:weather,agro:{agro}']
+    if kind == 'archive':
+        return ['/menu', 'button:archive', f'button:archive,agro:{agro}',
+                f'button:archive_stations,station:{station},agro:{agro}',
+                f'button:archive_stations_date,week:{random.randint(1, 4)},station:{station},agro:{agro}']
+    # Меню выбора микрозоны отправляет карту с диска сервера, поэтому цепочка начинается с выбора микрозоны
+    return ['/menu', 'button:forecast', f'button:forecast_zones,zone:{zone},agro:{agro}',
+            f'button:forecast_zones_date,date:{random.choice(info["forecast_dates"])},zone:{zone},agro:{agro}']
+
+
+def load_sessions(path: str) -> list:
+    """ Загружает записанные цепочки нажатий. Формат файла - JSON по строкам: {"steps": ["/menu", ...]}"""
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line)['steps'] for line in file if line.strip()]
+
+
+def step_name(step: str) -> str:
+    """ Название шага для отчёта: команда или значение button"""
+    if step.startswith('/'):
+        return step
+    return step.split(',')[0].replace('button:', '')
+
+
+class LoadGenerator:
+    """ Запускает виртуальных пользователей и собирает задержки по шагам
+
+    :param mode:
+        direct или polling
+    :param think_time:
+        Пауза пользователя между нажатиями в секундах
+    """
+
+    def __init__(self, driver: BotDriver, server: FakeTelegramServer, info: dict, mode: str = 'direct',
+                 sessions: list = None, think_time: float = 0.0, timeout: float = 30.0) -> None:
+        self.driver = driver
+        self.server = server
+        self.info = info
+        self.mode = mode
+        self.sessions = sessions
+        self.think_time = think_time
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        if mode == 'polling':
+            driver.bot.threaded = True
+            threading.Thread(target=driver.bot.infinity_polling, kwargs={'timeout': 1}, daemon=True,
+                             name='bench-polling').start()
+
+    def _send(self, chat_id: int, step: str) -> float or None:
+        """ Доставляет шаг боту и возвращает время ответа"""
+        update = make_message(chat_id, step) if step.startswith('/') else make_callback(chat_id, step)
+        if self.mode == 'direct':
+            return self.driver.process(update)
+
+        start = time()
+        self.server.push_updates([update])
+        answered = self.server.wait_for_message(chat_id, after=start, timeout=self.timeout)
+        return answered - start if answered else None
+
+    def run_stage(self, users: int, duration: float) -> dict:
+        """ Ступень нагрузки: users пользователей в течение duration секунд
+
+        :return:
+            Задержки по шагам, количество ошибок и сводка времени по этапам обработки
+        """
+        latencies = {}
+        errors = [0]
+        stop_at = perf_counter() + duration
+        chat_ids = random.sample(self.info['telegram_ids'], min(users, len(self.info['telegram_ids'])))
+        before = self._breakdown()
+        queue_depth = []
+
+        def user(chat_id: int) -> None:
+            while perf_counter() < stop_at:
+                steps = random.choice(self.sessions) if self.sessions else synthesize_session(self.info)
+                for step in steps:
+                    latency = self._send(chat_id, step)
+                    with self._lock:
+                        if latency is None:
+                            errors[0] += 1
+                        else:
+                            latencies.setdefault(step_name(step), []).append(latency)
+                    if self.think_time:
+                        sleep(self.think_time)
+                    if perf_counter() >= stop_at:
+                        return
+
+        threads = [threading.Thread(target=user, args=(chat_ids[i % len(chat_ids)],), daemon=True)
+                   for i in range(users)]
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            if self.mode == 'polling':
+                queue_depth.append(self.driver.bot.worker_pool.tasks.qsize())
+            sleep(0.1)
+        elapsed = perf_counter() - started
+
+        after = self._breakdown()
+        all_latencies = [value for values in latencies.values() for value in values]
+        return {'users': users, 'elapsed': elapsed, 'requests': len(all_latencies), 'errors': errors[0],
+                'throughput': len(all_latencies) / elapsed if elapsed else 0,
+                'p50': percentile(all_latencies, 50), 'p95': percentile(all_latencies, 95),
+                'steps': latencies, 'queue_depth': max(queue_depth) if queue_depth else 0,
+                'breakdown': {key: after[key] - before[key] for key in after}}
+
+    @staticmethod
+    def _breakdown() -> dict:
+        """ Суммарное время по этапам обработки: база данных, построение экранов, запросы к Telegram API"""
+        db_stats = db.db_stats.snapshot()
+        return {'db': sum(stats['execute_seconds'] + stats['connect_seconds'] for stats in db_stats.values()),
+                'render': metrics.total('bot_stage_seconds', stage='render'),
+                'keyboard': metrics.total('bot_stage_seconds', stage='keyboard'),
+                'telegram_api': metrics.total('bot_telegram_api_seconds')}
+
+
+def find_saturation(stages: list) -> dict or None:
+    """ Первая ступень, на которой пропускная способность выросла меньше чем на 10%, а p95 - больше чем в полтора
+        раза по сравнению с предыдущей ступенью
+    """
+    for previous, current in zip(stages, stages[1:]):
+        if current['throughput'] < previous['throughput'] * 1.1 and current['p95'] > previous['p95'] * 1.5:
+            return current
+    return None
+
+
+def format_stages(stages: list) -> str:
+    """ Отчёт по ступеням нагрузки"""
+    lines = [f'{"польз.":>8}{"rps":>10}{"p50, мс":>10}{"p95, мс":>10}{"ошибок":>8}{"очередь":>9}'
+             f'{"БД, с":>9}{"экраны, с":>11}{"API, с":>9}']
+    for stage in stages:
+        breakdown = stage['breakdown']
+        lines.append(f'{stage["users"]:>8}{stage["throughput"]:>10.1f}{stage["p50"] * 1000:>10.1f}'
+                     f'{stage["p95"] * 1000:>10.1f}{stage["errors"]:>8}{stage["queue_depth"]:>9}'
+                     f'{breakdown["db"]:>9.2f}{breakdown["render"] + breakdown["keyboard"]:>11.2f}'
+                     f'{breakdown["telegram_api"]:>9.2f}')
+    saturation = find_saturation(stages)
+    if saturation:
+        lines.append(f'Точка насыщения: {saturation["users"]} одновременных пользователей')
+    else:
+        lines.append('Точка насыщения не достигнута')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Генератор нагрузки на бота')
+    parser.add_argument('--dsn', required=True, help='Строка подключения к тестовой базе PostgreSQL')
+    parser.add_argument('--no-seed', action='store_true', help='Не пересоздавать тестовые данные')
+    parser.add_argument('--users', type=int, default=500, help='Количество пользователей в тестовой базе')
+    parser.add_argument('--mode', choices=['direct', 'polling'], default='direct')
+    parser.add_argument('--stages', default='1,2,4,8,16,32,64', help='Количество пользователей по ступеням')
+    parser.add_argument('--duration', type=float, default=20, help='Длительность ступени в секундах')
+    parser.add_argument('--think-time', type=float, default=0, help='Пауза между нажатиями в секундах')
+    parser.add_argument('--sessions', help='Файл с записанными цепочками нажатий')
+    parser.add_argument('--latency-ms', type=float, default=50, help='Задержка ответа Telegram API')
+    parser.add_argument('--rate-429', type=float, default=0, help='Доля ответов 429 от Telegram API')
+    args = parser.parse_args()
+
+    seed_info = describe(args.dsn) if args.no_seed else seed(args.dsn, users=args.users)
+    fake_server = FakeTelegramServer(latency=args.latency_ms / 1000, rate_429=args.rate_429).start()
+    generator = LoadGenerator(BotDriver(dsn=args.dsn), fake_server, seed_info, mode=args.mode,
+                              sessions=load_sessions(args.sessions) if args.sessions else None,
+                              think_time=args.think_time)
+    results = []
+    for stage_users in [int(value) for value in args.stages.split(',')]:
+        results.append(generator.run_stage(users=stage_users, duration=args.duration))
+        print(f'Ступень {stage_users}: {results[-1]["throughput"]:.1f} rps, p95 {results[-1]["p95"] * 1000:.1f} мс')
+    print(format_stages(results))
+    fake_server.stop()
@@ -0,0 +1,201 @@
+""" Заполнение локальной базы PostgreSQL синтетическими данными в схеме, которую использует бот.
+    ВНИМАНИЕ: таблицы пересоздаются, поэтому запускать только на тестовой базе
+"""
+import argparse
+import io
+import random
+from datetime import datetime, timedelta
+
+import psycopg2
+
+# Структура таблиц повторяет порядок колонок, на который рассчитаны запросы SELECT * в dboperator
+SCHEMA = '''
+DROP TABLE IF EXISTS public."TelegramBot", public."WeatherGroup", public."WeatherGroupAgro",
+    public."WeatherStation", public."WeatherData", public."SecurityCam", public."ForecastZoneArea",
+    public."ForecastDaily", public."Layer", public."ForecastZoneAgro", public."BotMigrations",
+    public."WeatherDataHourly", public."WeatherDataDaily", public."WeatherDataRollupState" CASCADE;
+
+CREATE TABLE public."TelegramBot" (
+    id serial PRIMARY KEY, name varchar, surname varchar, regisdate timestamp,
+    telegram_id bigint, regcheck boolean, role integer);
+
+CREATE TABLE public."WeatherGroup" (
+    id integer PRIMARY KEY, name varchar, shortname varchar, location text, additional text);
+
+CREATE TABLE public."WeatherGroupAgro" (weathergroupid integer, agroid integer);
+
+CREATE TABLE public."WeatherStation" (
+    id integer PRIMARY KEY, weathergroupid integer, name varchar, location text, description text,
+    installdate date, active boolean, ip inet);
+
+CREATE TABLE public."WeatherData" (
+    id bigserial PRIMARY KEY, datetime timestamp, weatherstationid integer, temperature real, humidity real,
+    barometer real, dewpoint real, rain real, windspeed real, windgust real, winddegrees real,
+    winddirection varchar, consbatteryvoltage real);
+
+CREATE TABLE public."SecurityCam" (
+    agroid integer, camname varchar, ip inet, lat double precision, lon double precision, login varchar,
+    password varchar, port integer, addstream varchar, filename varchar, id serial PRIMARY KEY);
+
+CREATE TABLE public."ForecastZoneArea" (id integer PRIMARY KEY, forecastareaname varchar, agroid varchar);
+
+CREATE TABLE public."ForecastDaily" (
+    forecastzoneid integer, "time" timestamp, summary varchar, precipintensity real, precipintensitymax real,
+    dewpoint real, humidity real, pressure real, temperaturemin real, temperaturemax real,
+    temperaturemintime timestamp, temperaturemaxtime timestamp);
+
+CREATE TABLE public."Layer" (id serial PRIMARY KEY, agroid integer, set varchar);
+'''
+
+# Список Агро, в которых есть метеостанции
+AGRO_LIST = [1, 3, 4, 5, 6]
+
+
+def copy_rows(cur, table: str, columns: list, rows) -> None:
+    """ Загружает строки в таблицу через COPY пачками, не собирая весь набор данных в памяти"""
+    buffer = io.StringIO()
+    count = 0
+    sql = f'COPY public."{table}" ({", ".join(columns)}) FROM STDIN WITH (FORMAT text, NULL \'\\N\')'
+    for row in rows:
+        buffer.write('\t'.join('\\N' if value is None else str(value) for value in row) + '\n')
+        count += 1
+        if count % 100000 == 0:
+            buffer.seek(0)
+            cur.copy_expert(sql, buffer)
+            buffer = io.StringIO()
+    if buffer.tell():
+        buffer.seek(0)
+        cur.copy_expert(sql, buffer)
+
+
+def weather_rows(stations: list, days: int, interval: int, now: datetime):
+    """ Генерирует показания метеостанций за указанное количество дней с заданным интервалом в минутах.
+        Строки идут по времени, чтобы id возрастал вместе с datetime, как в рабочей базе
+    """
+    start = now - timedelta(days=days)
+    steps = days * 24 * 60 // interval
+    for step in range(steps):
+        moment = start + timedelta(minutes=step * interval)
+        for station_id in stations:
+            temperature = round(15 + 10 * random.random() - 5 * (moment.hour < 6), 1)
+            rain = round(random.random() * 2, 1) if random.random() < 0.05 else 0
+            voltage = round(4.8 - 0.6 * step / steps + random.random() * 0.05, 2)
+            yield (moment, station_id, temperature, round(40 + 50 * random.random(), 1),
+                   round(750 + 10 * random.random(), 1), round(temperature - 5, 1), rain,
+                   round(5 * random.random(), 1), round(10 * random.random(), 1), random.randint(0, 359),
+                   random.choice(['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']), voltage)
+
+
+def seed(dsn: str, stations_per_agro: int = 2, days: int = 30, interval: int = 10, users: int = 100,
+         zones_per_agro: int = 3, forecast_days: int = 8, cameras_per_agro: int = 5) -> dict:
+    """ Пересоздаёт таблицы и заполняет их синтетическими данными
+
+    :param dsn:
+        Строка подключения к тестовой базе
+    :param stations_per_agro:
+        Количество метеостанций в каждом Агро
+    :param days:
+        Глубина истории показаний метеостанций в днях
+    :param interval:
+        Интервал между показаниями в минутах
+    :param users:
+        Количество зарегистрированных пользователей
+    :return:
+        Описание созданных данных: id пользователей, метеостанций, микрозон и даты прогноза
+    """
+    now = datetime.now().replace(second=0, microsecond=0)
+    stations = {}
+    zones = {}
+    station_id = zone_id = 0
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(SCHEMA)
+
+            for agro_id in AGRO_LIST:
+                for _ in range(stations_per_agro):
+                    station_id += 1
+                    stations.setdefault(agro_id, []).append(station_id)
+                    cur.execute('INSERT INTO public."WeatherGroup" VALUES (%s, %s, %s, %s, %s)',
+                                (station_id, f'Метеостанция {station_id}', f'Метео {station_id}',
+                                 f'{48 + random.random():.5f}, {44 + random.random():.5f}', None))
+                    cur.execute('INSERT INTO public."WeatherGroupAgro" VALUES (%s, %s)', (station_id, agro_id))
+                    cur.execute('INSERT INTO public."WeatherStation" VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+                                (station_id, station_id, f'Метео {station_id}', None, None, None, True,
+                                 '127.0.0.1'))
+                for _ in range(zones_per_agro):
+                    zone_id += 1
+                    zones.setdefault(agro_id, []).append(zone_id)
+                    cur.execute('INSERT INTO public."ForecastZoneArea" VALUES (%s, %s, %s)',
+                                (zone_id, f'Микрозона {zone_id}', str(agro_id)))
+                for camera in range(cameras_per_agro):
+                    cur.execute('INSERT INTO public."SecurityCam" (agroid, camname, ip, lat, lon) '
+                                'VALUES (%s, %s, %s, %s, %s)',
+                                (agro_id, f'ГПА-{agro_id} | Камера {camera}', '127.0.0.1',
+                                 48 + random.random(), 44 + random.random()))
+                cur.execute('INSERT INTO public."Layer" (agroid, set) VALUES (%s, %s)', (agro_id, 'visual'))
+
+            telegram_ids = [100000 + i for i in range(users)]
+            copy_rows(cur, 'TelegramBot', ['name', 'surname', 'regisdate', 'telegram_id', 'regcheck', 'role'],
+                      ((f'Имя{i}', f'Фамилия{i}', now, telegram_id, True, 2)
+                       for i, telegram_id in enumerate(telegram_ids)))
+
+            all_stations = [station for agro_stations in stations.values() for station in agro_stations]
+            copy_rows(cur, 'WeatherData', ['datetime', 'weatherstationid', 'temperature', 'humidity', 'barometer',
+                                           'dewpoint', 'rain', 'windspeed', 'windgust', 'winddegrees',
+                                           'winddirection', 'consbatteryvoltage'],
+                      weather_rows(all_stations, days=days, interval=interval, now=now))
+
+            today = datetime.combine(now.date(), datetime.min.time())
+            copy_rows(cur, 'ForecastDaily', ['forecastzoneid', '"time"', 'summary', 'precipintensity',
+                                             'precipintensitymax', 'dewpoint', 'humidity', 'pressure',
+                                             'temperaturemin', 'temperaturemax', 'temperaturemintime',
+                                             'temperaturemaxtime'],
+                      ((zone, today + timedelta(days=day), 'Переменная облачность', random.random(),
+                        random.random() * 3, 5 + random.random(), 60 + random.random() * 30,
+                        1000 + random.random() * 20, 5 + random.random() * 5, 15 + random.random() * 10,
+                        today + timedelta(days=day, hours=5), today + timedelta(days=day, hours=15))
+                       for agro_zones in zones.values() for zone in agro_zones for day in range(forecast_days)))
+            cur.execute('ANALYZE')
+    finally:
+        conn.close()
+
+    return {'telegram_ids': telegram_ids, 'stations': stations, 'zones': zones,
+            'forecast_dates': [str((now + timedelta(days=day)).date()) for day in range(forecast_days)]}
+
+
+def describe(dsn: str) -> dict:
+    """ Описание уже заполненной тестовой базы в том же формате, что возвращает seed"""
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute('SELECT telegram_id FROM public."TelegramBot" WHERE regcheck')
+            telegram_ids = [row[0] for row in cur.fetchall()]
+            cur.execute('SELECT agroid, weathergroupid FROM public."WeatherGroupAgro" ORDER BY 1, 2')
+            stations = {}
+            for agro_id, station_id in cur.fetchall():
+                stations.setdefault(agro_id, []).append(station_id)
+            cur.execute('SELECT agroid, id FROM public."ForecastZoneArea" ORDER BY 2')
+            zones = {}
+            for agro_id, zone_id in cur.fetchall():
+                zones.setdefault(int(agro_id), []).append(zone_id)
+            cur.execute('SELECT DISTINCT "time"::date FROM public."ForecastDaily" ORDER BY 1')
+            forecast_dates = [str(row[0]) for row in cur.fetchall()]
+    finally:
+        conn.close()
+    return {'telegram_ids': telegram_ids, 'stations': stations, 'zones': zones, 'forecast_dates': forecast_dates}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Заполнение тестовой базы синтетическими данными')
+    parser.add_argument('--dsn', required=True, help='Строка подключения к тестовой базе PostgreSQL')
+    parser.add_argument('--stations-per-agro', type=int, default=2)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--interval', type=int, default=10, help='Интервал показаний в минутах')
+    parser.add_argument('--users', type=int, default=100)
+    args = parser.parse_args()
+    info = seed(args.dsn, stations_per_agro=args.stations_per_agro, days=args.days, interval=args.interval,
+                users=args.users)
+    print(f'Создано метеостанций: {sum(len(s) for s in info["stations"].values())}, '
+          f'пользователей: {len(info["telegram_ids"])}')
@@ -0,0 +1,226 @@
+""" Графики для экранов архива погоды и батареек: температура (минимум, максимум и среднее), осадки
+    и напряжение батарей метеостанций. Графики рисуются в PNG без графического окружения (matplotlib, Agg).
+
+    Ряды перед построением прореживаются до CHART_POINTS точек (LTTB - Largest Triangle Three Buckets):
+    форма кривой сохраняется, а время построения не зависит от длины периода. Минимум и максимум берутся
+    по всем точкам прореженного интервала, осадки суммируются.
+
+    Построение выполняется в отдельном пуле потоков (CHART_WORKERS в settings.py). Отправленный график
+    запоминается по file_id Telegram, повторный запрос с той же версией данных отправляется без построения.
+    Без библиотеки matplotlib кнопки графиков не показываются
+"""
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import settings
+
+try:
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.dates import AutoDateLocator, ConciseDateFormatter
+    from matplotlib.figure import Figure
+except ImportError:
+    Figure = None
+
+# Наибольшее количество точек ряда на графике
+CHART_POINTS = getattr(settings, 'CHART_POINTS', 300)
+
+
+def available() -> bool:
+    """ Можно ли строить графики"""
+    return Figure is not None
+
+
+def lttb(xs: list, ys: list, threshold: int) -> list:
+    """ Прореживание ряда методом Largest Triangle Three Buckets
+
+    :param xs:
+        Значения по оси X по возрастанию (числа)
+    :param ys:
+        Значения ряда
+    :param threshold:
+        Наибольшее количество точек после прореживания
+    :return:
+        Индексы оставленных точек по возрастанию. Первая и последняя точки остаются всегда
+    """
+    length = len(xs)
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+
+    indices = [0]
+    bucket_size = (length - 2) / (threshold - 2)
+    previous = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        # Средняя точка следующей корзины (для последней корзины - последняя точка ряда)
+        next_start, next_end = end, min(int((bucket + 2) * bucket_size) + 1, length)
+        if next_start >= next_end:
+            next_start, next_end = length - 1, length
+        average_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        average_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        # Из корзины берётся точка, образующая треугольник наибольшей площади с предыдущей и средней точками
+        point_x, point_y = xs[previous], ys[previous]
+        chosen, largest = start, -1.0
+        for index in range(start, end):
+            area = abs((point_x - average_x) * (ys[index] - point_y) - (point_x - xs[index]) * (average_y - point_y))
+            if area > largest:
+                chosen, largest = index, area
+        indices.append(chosen)
+        previous = chosen
+    indices.append(length - 1)
+    return indices
+
+
+def windows(indices: list, length: int) -> list:
+    """ Интервалы исходного ряда длиной length, которые представляет каждая оставленная точка: от неё
+        (включительно) до следующей оставленной точки (не включительно)
+    """
+    return list(zip(indices, indices[1:] + [length]))
+
+
+def timestamps(moments: list) -> list:
+    return [moment.timestamp() if isinstance(moment, datetime) else
+            datetime.combine(moment, datetime.min.time()).timestamp() for moment in moments]
+
+
+def downsample_archive(rows: list, threshold: int = CHART_POINTS) -> tuple:
+    """ Прореживает архив (начало интервала, максимум, минимум, среднее, осадки) из db.get_weather_archive_period
+
+    :return:
+        Кортеж списков (время, максимум, минимум, среднее, осадки)
+    """
+    rows = [row for row in rows if row[3] is not None]
+    if not rows:
+        return [], [], [], [], []
+    moments = [row[0] for row in rows]
+    indices = lttb(timestamps(moments), [row[3] for row in rows], threshold)
+    maximum, minimum, rain = [], [], []
+    for start, end in windows(indices, len(rows)):
+        maximum.append(max(row[1] for row in rows[start:end]))
+        minimum.append(min(row[2] for row in rows[start:end]))
+        rain.append(sum(row[4] or 0 for row in rows[start:end]))
+    return [moments[index] for index in indices], maximum, minimum, [rows[index][3] for index in indices], rain
+
+
+def downsample_series(rows: list, threshold: int = CHART_POINTS) -> tuple:
+    """ Прореживает ряд (время, значение)
+
+    :return:
+        Кортеж списков (время, значение)
+    """
+    rows = [row for row in rows if row[1] is not None]
+    indices = lttb(timestamps([row[0] for row in rows]), [row[1] for row in rows], threshold)
+    return [rows[index][0] for index in indices], [rows[index][1] for index in indices]
+
+
+def new_figure(rows: int = 1):
+    """ Фигура без pyplot: pyplot хранит общее состояние и не подходит для построения в нескольких потоках"""
+    figure = Figure(figsize=(8, 4.5 if rows == 1 else 6), dpi=120)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def format_dates(axes) -> None:
+    locator = AutoDateLocator()
+    axes.xaxis.set_major_locator(locator)
+    axes.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+
+
+def to_png(figure) -> bytes:
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def archive_chart(title: str, rows: list) -> bytes or None:
+    """ График архива: полоса от минимальной до максимальной температуры, средняя температура и столбцы осадков
+
+    :param rows:
+        Строки db.get_weather_archive_period
+    :return:
+        PNG или None, если данных нет
+    """
+    moments, maximum, minimum, average, rain = downsample_archive(rows)
+    if not moments:
+        return None
+    figure = new_figure(rows=2)
+    temperature, precipitation = figure.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': (3, 1)})
+    temperature.fill_between(moments, minimum, maximum, color='tab:orange', alpha=0.3, linewidth=0,
+                             label='Мин. - макс.')
+    temperature.plot(moments, average, color='tab:red', linewidth=1.2, label='Средняя')
+    temperature.set_ylabel('Температура, °C')
+    temperature.set_title(title)
+    temperature.grid(alpha=0.3)
+    temperature.legend(loc='upper left', fontsize='small')
+
+    # Ширина столбца - расстояние до следующей точки в днях (единица оси дат matplotlib)
+    steps = [(following - current).total_seconds() / 86400 for current, following in zip(moments, moments[1:])]
+    widths = [step * 0.9 for step in steps + steps[-1:]] if steps else 0.03
+    precipitation.bar(moments, rain, width=widths, align='edge', color='tab:blue')
+    precipitation.set_ylabel('Осадки, мм')
+    precipitation.grid(alpha=0.3)
+    format_dates(precipitation)
+    figure.tight_layout()
+    return to_png(figure)
+
+
+def battery_chart(title: str, series: dict, cutoff: float = None) -> bytes or None:
+    """ График напряжения батарей метеостанций
+
+    :param series:
+        Словарь {название метеостанции: строки db.get_battery_voltage_period}
+    :param cutoff:
+        Напряжение отключения метеостанции (рисуется горизонтальной линией)
+    :return:
+        PNG или None, если данных нет
+    """
+    series = {name: downsample_series(rows) for name, rows in series.items() if rows}
+    if not any(moments for moments, _ in series.values()):
+        return None
+    figure = new_figure()
+    axes = figure.subplots()
+    for name, (moments, voltage) in series.items():
+        axes.plot(moments, voltage, linewidth=1.2, label=name)
+    if cutoff:
+        axes.axhline(cutoff, color='tab:red', linestyle='--', linewidth=1, label='Отключение')
+    axes.set_ylabel('Напряжение, В')
+    axes.set_title(title)
+    axes.grid(alpha=0.3)
+    axes.legend(loc='lower left', fontsize='small')
+    format_dates(axes)
+    figure.tight_layout()
+    return to_png(figure)
+
+
+class ChartCache:
+    """ file_id отправленных графиков по ключу (вид графика, параметры, версия данных)"""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> str or None:
+        with self._lock:
+            file_id = self._files.get(key)
+            if file_id is not None:
+                self._files.move_to_end(key)
+            return file_id
+
+    def set(self, key: tuple, file_id: str) -> None:
+        with self._lock:
+            self._files[key] = file_id
+            self._files.move_to_end(key)
+            while len(self._files) > self.maxsize:
+                self._files.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+
+chart_cache = ChartCache(getattr(settings, 'CHART_CACHE_SIZE', 256))
+chart_pool = ThreadPoolExecutor(max_workers=getattr(settings, 'CHART_WORKERS', 2), thread_name_prefix='chart')
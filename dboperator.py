@@ -8,10 +8,14 @@ import logging
 import sqlite3
 import sqlite3 as lite
 import sys
+import threading
+from collections import deque
 from datetime import datetime
 from datetime import time, timedelta
+from functools import wraps
 from os.path import join
-from typing import Any
+from time import monotonic, perf_counter, sleep
+from typing import Any, Callable
 
 import psycopg2
 import psycopg2.extras
@@ -22,6 +26,12 @@ import settings
 logger = logging.getLogger('__name__')
 db_config = settings.DB_CONFIG
 
+# Порог в секундах, после которого запрос записывается в лог медленных запросов
+slow_query_seconds = getattr(settings, 'DB_SLOW_QUERY_SECONDS', 0.5)
+
+# Время ожидания подключения к базе данных в секундах
+connect_timeout = getattr(settings, 'DB_CONNECT_TIMEOUT', 3)
+
 
 class MyPsycopg2Error(psycopg2.Error):
     """ Кастомный обработчик ошибок Psycopg2"""
@@ -32,26 +42,551 @@ class MyPsycopg2Error(psycopg2.Error):
         return f"Ошибка: {self.error.pgcode} {self.error.pgerror}"
 
 
+class DBStats:
+    """ Статистика работы с базой данных по функциям dboperator: количество вызовов,
+        время получения соединения, гистограмма времени выполнения запросов и количество строк
+    """
+
+    # Верхние границы корзин гистограммы времени выполнения в секундах
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._functions = {}
+
+    def _get(self, name: str) -> dict:
+        """ Возвращает статистику функции, создавая её при первом обращении"""
+        stats = self._functions.get(name)
+        if stats is None:
+            stats = self._functions[name] = {'calls': 0, 'errors': 0, 'connect_seconds': 0.0,
+                                             'queries': 0, 'execute_seconds': 0.0, 'execute_max': 0.0,
+                                             'rows': 0, 'histogram': [0] * len(self.buckets)}
+        return stats
+
+    def record_connect(self, name: str, seconds: float, error: bool = False) -> None:
+        """ Учитывает получение соединения"""
+        with self._lock:
+            stats = self._get(name)
+            stats['calls'] += 1
+            stats['connect_seconds'] += seconds
+            if error:
+                stats['errors'] += 1
+
+    def record_execute(self, name: str, seconds: float, error: bool = False) -> None:
+        """ Учитывает выполнение запроса"""
+        with self._lock:
+            stats = self._get(name)
+            stats['queries'] += 1
+            stats['execute_seconds'] += seconds
+            stats['execute_max'] = max(stats['execute_max'], seconds)
+            if error:
+                stats['errors'] += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats['histogram'][i] += 1
+                    break
+
+    def record_rows(self, name: str, rows: int) -> None:
+        """ Учитывает количество полученных строк"""
+        with self._lock:
+            self._get(name)['rows'] += rows
+
+    def snapshot(self) -> dict:
+        """ Копия текущей статистики"""
+        with self._lock:
+            return {name: dict(stats, histogram=list(stats['histogram'])) for name, stats in self._functions.items()}
+
+    def reset(self) -> None:
+        """ Сбрасывает статистику"""
+        with self._lock:
+            self._functions.clear()
+
+    def format_histogram(self, histogram: list) -> str:
+        """ Непустые корзины гистограммы в виде «до 5 мс: 10, до 10 мс: 2, более 5000 мс: 1»"""
+        parts = []
+        for i, count in enumerate(histogram):
+            if not count:
+                continue
+            bound = self.buckets[i]
+            if bound == float('inf'):
+                parts.append(f'более {self.buckets[i - 1] * 1000:g} мс: {count}')
+            else:
+                parts.append(f'до {bound * 1000:g} мс: {count}')
+        return ', '.join(parts)
+
+    def dump(self) -> str:
+        """ Текстовый отчёт по статистике, отсортированный по суммарному времени запросов"""
+        functions = sorted(self.snapshot().items(), key=lambda item: item[1]['execute_seconds'], reverse=True)
+        lines = []
+        for name, stats in functions:
+            avg = stats['execute_seconds'] / stats['queries'] if stats['queries'] else 0
+            lines.append(f'{name}: вызовов {stats["calls"]}, ошибок {stats["errors"]}, '
+                         f'соединение {stats["connect_seconds"]:.3f} с, '
+                         f'запросов {stats["queries"]} за {stats["execute_seconds"]:.3f} с '
+                         f'(ср. {avg * 1000:.1f} мс, макс. {stats["execute_max"] * 1000:.1f} мс), '
+                         f'строк {stats["rows"]}')
+            histogram = self.format_histogram(stats['histogram'])
+            if histogram:
+                lines.append(f'    время запросов: {histogram}')
+        return '\n'.join(lines) if lines else 'Запросов к базе данных не было'
+
+
+db_stats = DBStats()
+
+
+def redact_params(params) -> str:
+    """ Заменяет значения параметров запроса их типами, чтобы данные пользователей не попадали в лог"""
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in params.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+
+
+class InstrumentedCursor:
+    """ Обёртка курсора psycopg2, которая замеряет время выполнения запросов и количество строк"""
+
+    def __init__(self, cursor, name: str) -> None:
+        self._cursor = cursor
+        self._name = name
+        # Время, проведённое в базе данных (выполнение запросов и чтение строк), для размыкателя цепи
+        self.elapsed = 0.0
+
+    def execute(self, sql, params=None):
+        """ Выполняет запрос и записывает его в статистику"""
+        start = perf_counter()
+        error = False
+        try:
+            return self._cursor.execute(sql, params)
+        except psycopg2.Error:
+            error = True
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            self.elapsed += elapsed
+            db_stats.record_execute(self._name, elapsed, error=error)
+            if elapsed > slow_query_seconds:
+                logger.warning(f'Медленный запрос в {self._name}: {elapsed:.3f} с. '
+                               f'SQL: {sql} Параметры: {redact_params(params)}')
+
+    def fetchall(self) -> list:
+        """ Получает все строки результата"""
+        start = perf_counter()
+        rows = self._cursor.fetchall()
+        self.elapsed += perf_counter() - start
+        db_stats.record_rows(self._name, len(rows))
+        return rows
+
+    def fetchone(self):
+        """ Получает одну строку результата"""
+        start = perf_counter()
+        row = self._cursor.fetchone()
+        self.elapsed += perf_counter() - start
+        if row is not None:
+            db_stats.record_rows(self._name, 1)
+        return row
+
+    def fetchmany(self, size=None) -> list:
+        """ Получает следующую пачку строк результата"""
+        start = perf_counter()
+        rows = self._cursor.fetchmany(size) if size else self._cursor.fetchmany()
+        self.elapsed += perf_counter() - start
+        db_stats.record_rows(self._name, len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            db_stats.record_rows(self._name, 1)
+            yield row
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+
+class CircuitOpenError(psycopg2.OperationalError):
+    """ База данных недоступна: запрос не выполнялся, так как размыкатель разомкнут"""
+
+
+class CircuitBreaker:
+    """ Размыкатель цепи для запросов к базе данных.
+        closed - запросы выполняются, ошибки и медленные запросы учитываются в скользящем окне.
+        open - доля неудачных запросов превысила порог, запросы сразу завершаются ошибкой CircuitOpenError,
+        а фоновый поток периодически проверяет доступность базы.
+        half-open - идёт проверка доступности, запросы по-прежнему не выполняются до её успешного завершения
+
+    :param error_rate:
+        Доля неудачных запросов в окне, при которой цепь размыкается
+    :param min_calls:
+        Минимальное количество запросов в окне для принятия решения
+    :param window:
+        Длительность скользящего окна в секундах
+    :param slow_seconds:
+        Запрос дольше этого времени считается неудачным
+    :param probe_interval:
+        Интервал проверки доступности базы в разомкнутом состоянии
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half-open', 'open'
+
+    def __init__(self, error_rate: float = 0.5, min_calls: int = 5, window: float = 30.0,
+                 slow_seconds: float = 2.0, probe_interval: float = 5.0) -> None:
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_seconds = slow_seconds
+        self.probe_interval = probe_interval
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self) -> bool:
+        return self.state == self.CLOSED
+
+    def before(self) -> None:
+        """ Проверка перед запросом: если цепь разомкнута - запрос сразу завершается ошибкой"""
+        if self.state != self.CLOSED:
+            raise CircuitOpenError('База данных недоступна, повторите попытку позже')
+
+    def record(self, seconds: float, failed: bool) -> None:
+        """ Учитывает результат запроса и размыкает цепь при превышении доли неудачных запросов"""
+        now = monotonic()
+        with self._lock:
+            if self.state != self.CLOSED:
+                return
+            self._calls.append((now, failed or seconds > self.slow_seconds))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            failures = sum(1 for _, bad in self._calls if bad)
+            if len(self._calls) < self.min_calls or failures / len(self._calls) < self.error_rate:
+                return
+            self.state = self.OPEN
+            self.opened_at = datetime.now()
+            self._calls.clear()
+        logger.critical(f'База данных недоступна: {failures} неудачных запросов за {self.window:.0f} с. '
+                        f'Запросы приостановлены до восстановления соединения')
+        threading.Thread(target=self._probe, daemon=True, name='db-circuit-probe').start()
+
+    def _probe(self) -> None:
+        """ Проверяет доступность базы данных, пока цепь разомкнута"""
+        while True:
+            sleep(self.probe_interval)
+            self.state = self.HALF_OPEN
+            try:
+                conn = psycopg2.connect(**{'connect_timeout': connect_timeout, **db_config})
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT 1')
+                finally:
+                    conn.close()
+            except psycopg2.Error:
+                self.state = self.OPEN
+                continue
+            with self._lock:
+                self.state = self.CLOSED
+            logger.critical(f'Соединение с базой данных восстановлено. Недоступна с {self.opened_at:%H:%M:%S}')
+            return
+
+
+circuit = CircuitBreaker(error_rate=getattr(settings, 'DB_CIRCUIT_ERROR_RATE', 0.5),
+                         min_calls=getattr(settings, 'DB_CIRCUIT_MIN_CALLS', 5),
+                         window=getattr(settings, 'DB_CIRCUIT_WINDOW', 30.0),
+                         slow_seconds=getattr(settings, 'DB_CIRCUIT_SLOW_SECONDS', 2.0),
+                         probe_interval=getattr(settings, 'DB_CIRCUIT_PROBE_INTERVAL', 5.0))
+
+# Локальный снимок таблиц для чтения, пока база данных недоступна (см. snapshot.py)
+snapshot = None
+# Время обновления снимка, по которому последний раз читались данные в текущем потоке (см. RenderCache)
+snapshot_reads = threading.local()
+
+# Архив погоды и осадки читаются из сводных таблиц WeatherDataHourly и WeatherDataDaily (см. rollup.py)
+rollups = False
+
+# Применённые миграции базы данных (см. migrations.py)
+migrations = set()
+
+
 class DBConnector:
     """ Диспетчер контекста для подключения к базе данных.
-        Параметры подключения передаются через словарь
+        Параметры подключения передаются через словарь.
+        Время подключения и выполнения запросов учитывается в db_stats под именем вызвавшей функции.
+        Пока база данных недоступна (см. CircuitBreaker), подключение сразу завершается ошибкой CircuitOpenError.
+        Если включён локальный снимок (см. snapshot.py), запросы на чтение в это время выполняются по снимку
+
+    :param cursor_name:
+        Название курсора на стороне сервера. Строки результата передаются по мере чтения через fetchmany,
+        а не все сразу при выполнении запроса
+    :param background:
+        Фоновый или потоковый запрос: его длительность не учитывается размыкателем как признак недоступности базы
     """
 
-    def __init__(self, config_dict: dict) -> None:
+    def __init__(self, config_dict: dict, use_snapshot: bool = True, cursor_name: str = None,
+                 background: bool = False) -> None:
         self.configuration = config_dict
+        self.use_snapshot = use_snapshot
+        self.cursor_name = cursor_name
+        self.background = background
+        self.name = sys._getframe(1).f_code.co_name
+        self.conn = None
+        self.cursor = None
+        self.from_snapshot = False
+        self.connect_seconds = 0.0
+
+    def _snapshot_available(self) -> bool:
+        return self.use_snapshot and snapshot is not None and snapshot.ready
+
+    def _snapshot_cursor(self):
+        self.from_snapshot = True
+        snapshot_reads.refreshed_at = snapshot.refreshed_at
+        self.cursor = snapshot.cursor()
+        return self.cursor
 
     def __enter__(self):
+        if not circuit.closed and self._snapshot_available():
+            return self._snapshot_cursor()
+        circuit.before()
+        self.start = perf_counter()
         try:
-            self.conn = psycopg2.connect(**self.configuration)
-            self.cursor = self.conn.cursor()
+            self.conn = psycopg2.connect(**{'connect_timeout': connect_timeout, **self.configuration})
+            self.connect_seconds = perf_counter() - self.start
+            db_stats.record_connect(self.name, self.connect_seconds)
+            self.cursor = InstrumentedCursor(self.conn.cursor(name=self.cursor_name), self.name)
             return self.cursor
         except psycopg2.Error as e:
+            db_stats.record_connect(self.name, perf_counter() - self.start, error=True)
+            circuit.record(perf_counter() - self.start, failed=True)
+            if self.conn is not None:
+                self.conn.close()
+            if self._snapshot_available():
+                logger.critical(f'Нет соединения с базой данных, {self.name} выполняется по локальному снимку')
+                return self._snapshot_cursor()
             raise MyPsycopg2Error(e)
 
     def __exit__(self, exc_type, exc_value, exc_trace) -> None:
-        self.conn.commit()
-        self.cursor.close()
-        self.conn.close()
+        if self.from_snapshot:
+            self.cursor.close()
+            return
+        failed = exc_type is not None and issubclass(exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        start = perf_counter()
+        try:
+            if self.conn is not None and not self.conn.closed:
+                if exc_type is None:
+                    self.conn.commit()
+                else:
+                    self.conn.rollback()
+        except psycopg2.Error as e:
+            failed = True
+            logger.critical(f'Ошибка при завершении транзакции в {self.name}: {e}')
+        finally:
+            if self.cursor is not None and not self.cursor.closed:
+                self.cursor.close()
+            if self.conn is not None:
+                self.conn.close()
+            # Учитывается только время работы базы данных: подключение, запросы, чтение строк и завершение
+            # транзакции. Работа вызывающего кода внутри блока with (например, ping) не считается
+            seconds = self.connect_seconds + self.cursor.elapsed + perf_counter() - start
+            circuit.record(0 if self.background else seconds, failed=failed)
+
+
+class SingleFlight:
+    """ Объединение одинаковых одновременных запросов к базе данных.
+        Пока первый вызов выполняется, остальные вызовы с теми же аргументами ждут его результат.
+        Готовый результат хранится ttl секунд и привязан к версии данных
+    """
+
+    class _Call:
+        """ Выполняющийся в данный момент запрос"""
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, ttl: float, version: Callable = None) -> None:
+        """
+        :param ttl:
+            Время хранения результата в секундах
+        :param version:
+            Функция, возвращающая текущую версию данных. При смене версии сохранённый результат не используется
+        """
+        self.ttl = ttl
+        self.version = version
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._results = {}
+
+    def do(self, key: tuple, func: Callable, *args, **kwargs) -> Any:
+        """ Выполняет функцию один раз для всех одновременных вызовов с одинаковым ключом"""
+        if self.version:
+            key = (key, self.version())
+
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and cached[0] > monotonic():
+                return cached[1]
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                # Пустой результат означает ошибку запроса, такой результат не сохраняем
+                if call.error is None and call.result is not None:
+                    now = monotonic()
+                    self._results = {k: v for k, v in self._results.items() if v[0] > now}
+                    self._results[key] = (now + self.ttl, call.result)
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def clear(self) -> None:
+        """ Сбрасывает сохранённые результаты"""
+        with self._lock:
+            self._results.clear()
+
+
+def single_flight(ttl: float, version: Callable = None):
+    """ Декоратор объединения одинаковых одновременных запросов к базе данных (см. SingleFlight)
+
+    :param ttl:
+        Время хранения результата в секундах
+    :param version:
+        Функция, возвращающая текущую версию данных
+    """
+
+    def decorator(func):
+        flight = SingleFlight(ttl=ttl, version=version)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """ Передаёт вызов в общую группу запросов"""
+            return flight.do((args, tuple(sorted(kwargs.items()))), func, *args, **kwargs)
+
+        wrapper.flight = flight
+        return wrapper
+
+    return decorator
+
+
+# Запросы к базе данных. Общие для функций этого модуля и их асинхронных вариантов из async_dboperator
+SQL_CHECK_USER = 'SELECT * FROM public."TelegramBot" WHERE telegram_id in (%s)'
+# Запросы регистрации изменяют запись только один раз: повторная заявка или повторное подтверждение
+# не изменяют ни одной строки
+# Одновременные заявки отсекает уникальный индекс TelegramBot_telegram_id_key (migrations.py).
+# NOT EXISTS сохраняет защиту от повторной заявки в базе, где миграция ещё не применена
+SQL_REGISTRATION_USER = 'INSERT INTO public."TelegramBot"(name, surname, regisdate, ' \
+    'telegram_id, regcheck, role) ' \
+    'SELECT %s, %s, %s, %s, %s, %s ' \
+    'WHERE NOT EXISTS (SELECT 1 FROM public."TelegramBot" WHERE telegram_id = %s) ' \
+    'ON CONFLICT DO NOTHING;'
+SQL_DELETE_USER = 'DELETE FROM public."TelegramBot" WHERE "telegram_id" = %s'
+SQL_CONFIRM_USER = 'UPDATE public."TelegramBot" SET regcheck = True WHERE telegram_id = %s AND regcheck IS NOT TRUE'
+SQL_REG_STATUS = 'SELECT regcheck FROM public."TelegramBot" WHERE telegram_id in (%s)'
+SQL_ROLE = 'SELECT role FROM public."TelegramBot" WHERE telegram_id in (%s)'
+SQL_CONFIRMED_ROLE = 'SELECT role FROM public."TelegramBot" WHERE telegram_id = %s AND regcheck'
+SQL_WEATHER_STATION_ID_FROM_AGRO = 'SELECT weathergroupid FROM public."WeatherGroupAgro" WHERE agroid in (%s)'
+SQL_LAST_WEATHER_DATA_ID = 'SELECT MAX(id) FROM public."WeatherData"'
+SQL_WEATHER_DATA_FROM_AGRO = 'SELECT wd.datetime, wd.temperature, wd.humidity, wd.barometer, wd.rain, wd.windspeed, ' \
+    'wd.windgust, wd.winddegrees, wd.winddirection, wd.weatherstationid, wd.consbatteryvoltage ' \
+    'FROM public."WeatherGroupAgro" wga ' \
+    'CROSS JOIN LATERAL (SELECT * FROM public."WeatherData" ' \
+    'WHERE weatherstationid = wga.weathergroupid ORDER BY id DESC LIMIT 1) wd ' \
+    'WHERE wga.agroid in (%s) ORDER BY wga.weathergroupid;'
+SQL_WEATHER_STATION_NAME = 'SELECT shortname FROM public."WeatherGroup" WHERE id in (%s)'
+SQL_MAX_ID_FROM_LAYER = 'SELECT MAX(id) FROM public."Layer" WHERE agroid in (%s) and set in (%s)'
+SQL_PRECIPITATION_SUM = 'SELECT SUM(rain) FROM public."WeatherData" where datetime ' \
+    'BETWEEN (%s) AND (%s) AND weatherstationid in (%s)'
+SQL_ZONE_ID_FROM_AGRO = 'SELECT fza.id, fza.forecastareaname FROM public."ForecastZoneAgro" fzg ' \
+    'JOIN public."ForecastZoneArea" fza ON fza.id = fzg.forecastzoneid WHERE fzg.agroid = %s ORDER BY fza.id'
+# До миграции forecast_zone_agro: номера Агро хранятся текстом в ForecastZoneArea.agroid ("1", "1, 3")
+SQL_ZONE_ID_FROM_AGRO_TEXT = 'SELECT id, forecastareaname FROM public."ForecastZoneArea" ' \
+    'WHERE %s = ANY(regexp_split_to_array(agroid::text, \'\\D+\')) ORDER BY id'
+SQL_FORECAST_DATA = 'SELECT "time", summary, precipintensity, precipintensitymax, dewpoint, humidity, pressure, ' \
+    'temperaturemin, temperaturemax, temperaturemintime, temperaturemaxtime ' \
+    'FROM public."ForecastDaily" where forecastzoneid in (%s) '
+SQL_FORECAST_NAME = 'SELECT forecastareaname FROM public."ForecastZoneArea" where id in (%s)'
+SQL_FORECAST_DATES = 'SELECT "time" FROM public."ForecastDaily" where forecastzoneid in (%s)'
+SQL_FORECAST_VERSION = 'SELECT MIN("time"), MAX("time"), COUNT(*) FROM public."ForecastDaily"'
+SQL_FORECAST_DATA_WITH_DATE = 'SELECT "time", summary, precipintensity, ' \
+    'precipintensitymax, dewpoint, humidity, pressure, ' \
+    'temperaturemin, temperaturemax, temperaturemintime, temperaturemaxtime ' \
+    'FROM public."ForecastDaily" where forecastzoneid in (%s) and "time" >= (%s) and "time" < (%s) ' \
+    'ORDER BY "time" LIMIT 1'
+SQL_ALL_FORECAST_DATA = 'SELECT fd.forecastzoneid, fza.forecastareaname, fd."time", fd.summary, fd.precipintensity, ' \
+    'fd.precipintensitymax, fd.dewpoint, fd.humidity, fd.pressure, ' \
+    'fd.temperaturemin, fd.temperaturemax, fd.temperaturemintime, fd.temperaturemaxtime ' \
+    'FROM public."ForecastDaily" fd ' \
+    'LEFT JOIN public."ForecastZoneArea" fza ON fza.id = fd.forecastzoneid ' \
+    'ORDER BY fd.forecastzoneid, fd."time"'
+SQL_CAMERAS = 'SELECT * FROM public."SecurityCam"'
+# Сводные таблицы содержат показания с id не больше водяного знака, остальные досчитываются по WeatherData
+SQL_ROLLUP_TAIL = 'FROM public."WeatherData" WHERE id > (SELECT lastid FROM public."WeatherDataRollupState" ' \
+    'WHERE name = \'WeatherData\') AND weatherstationid = %s AND datetime >= %s AND datetime < %s'
+SQL_PRECIPITATION_SUM_ROLLUP = 'SELECT SUM(rain) FROM (SELECT rain FROM public."WeatherDataHourly" ' \
+    'WHERE weatherstationid = %s AND hour >= %s AND hour < %s UNION ALL SELECT rain ' + SQL_ROLLUP_TAIL + ') t'
+# Архив за период, сгруппированный по часам, дням или неделям (первый параметр - единица date_trunc)
+SQL_WEATHER_ARCHIVE_PERIOD = 'SELECT date_trunc(%s, datetime), MAX(temperature), MIN(temperature), ' \
+    'AVG(temperature), SUM(rain) FROM public."WeatherData" ' \
+    'WHERE weatherstationid = %s AND datetime >= %s AND datetime < %s GROUP BY 1 ORDER BY 1'
+SQL_ROLLUP_TAIL_ROWS = 'SELECT datetime, temperature, temperature, temperature, ' \
+    'CASE WHEN temperature IS NULL THEN 0 ELSE 1 END, rain ' + SQL_ROLLUP_TAIL
+SQL_ARCHIVE_PERIOD_GROUP = 'SELECT date_trunc(%s, moment), MAX(tmax), MIN(tmin), SUM(tsum) / NULLIF(SUM(tcount), 0), ' \
+    'SUM(rain) FROM ({rows}) t (moment, tmax, tmin, tsum, tcount, rain) GROUP BY 1 ORDER BY 1'
+SQL_WEATHER_ARCHIVE_PERIOD_HOURLY = SQL_ARCHIVE_PERIOD_GROUP.format(
+    rows='SELECT hour, temperaturemax, temperaturemin, temperaturesum, temperaturecount, rain '
+         'FROM public."WeatherDataHourly" WHERE weatherstationid = %s AND hour >= %s AND hour < %s '
+         'UNION ALL ' + SQL_ROLLUP_TAIL_ROWS)
+SQL_WEATHER_ARCHIVE_PERIOD_DAILY = SQL_ARCHIVE_PERIOD_GROUP.format(
+    rows='SELECT day::timestamp, temperaturemax, temperaturemin, temperaturesum, temperaturecount, rain '
+         'FROM public."WeatherDataDaily" WHERE weatherstationid = %s AND day >= %s AND day < %s '
+         'UNION ALL ' + SQL_ROLLUP_TAIL_ROWS)
+# Наименьшее за час напряжение батареи метеостанции
+SQL_BATTERY_VOLTAGE_PERIOD = 'SELECT date_trunc(\'hour\', datetime), MIN(consbatteryvoltage) ' \
+    'FROM public."WeatherData" WHERE weatherstationid = %s AND datetime >= %s AND datetime < %s ' \
+    'AND consbatteryvoltage IS NOT NULL GROUP BY 1 ORDER BY 1'
+SQL_BATTERY_VOLTAGE_PERIOD_ROLLUP = 'SELECT date_trunc(\'hour\', moment), MIN(voltage) FROM (' \
+    'SELECT hour, consbatteryvoltagemin FROM public."WeatherDataHourly" ' \
+    'WHERE weatherstationid = %s AND hour >= %s AND hour < %s UNION ALL ' \
+    'SELECT datetime, consbatteryvoltage ' + SQL_ROLLUP_TAIL + ') t (moment, voltage) ' \
+    'WHERE voltage IS NOT NULL GROUP BY 1 ORDER BY 1'
+# Наименьшее за сутки напряжение батарей всех метеостанций
+SQL_BATTERY_VOLTAGE_HISTORY = 'SELECT weatherstationid, datetime::date, MIN(consbatteryvoltage) ' \
+    'FROM public."WeatherData" WHERE datetime >= %s AND consbatteryvoltage IS NOT NULL GROUP BY 1, 2 ORDER BY 1, 2'
+SQL_BATTERY_VOLTAGE_HISTORY_ROLLUP = 'SELECT weatherstationid, day, MIN(voltage) FROM (' \
+    'SELECT weatherstationid, day, consbatteryvoltagemin FROM public."WeatherDataDaily" WHERE day >= %s UNION ALL ' \
+    'SELECT weatherstationid, datetime::date, consbatteryvoltage FROM public."WeatherData" ' \
+    'WHERE id > (SELECT lastid FROM public."WeatherDataRollupState" WHERE name = \'WeatherData\') ' \
+    'AND datetime >= %s) t (weatherstationid, day, voltage) WHERE voltage IS NOT NULL GROUP BY 1, 2 ORDER BY 1, 2'
+# Новые показания для проверки правил уведомлений (alerts.py)
+SQL_WEATHER_DATA_AFTER_ID = 'SELECT id, weatherstationid, datetime, temperature, humidity, barometer, rain, ' \
+    'windspeed, windgust FROM public."WeatherData" WHERE id > %s ORDER BY id LIMIT %s'
+SQL_WEATHER_DATA_SINCE = 'SELECT id, weatherstationid, datetime, temperature, humidity, barometer, rain, ' \
+    'windspeed, windgust FROM public."WeatherData" WHERE datetime >= %s ORDER BY id'
+SQL_STATION_AGRO = 'SELECT weathergroupid, agroid FROM public."WeatherGroupAgro"'
+SQL_WEATHER_STATIONS = 'SELECT * FROM public."WeatherStation"'
+SQL_WEATHER_STATIONS_ID = 'SELECT id FROM public."WeatherStation"'
+SQL_USERS = 'SELECT * FROM public."TelegramBot"'
+SQL_WEATHER_GROUPS = 'SELECT id, shortname FROM public."WeatherGroup" ORDER BY id'
+SQL_WEATHER_GROUP_LOCATIONS = 'SELECT id, shortname, location FROM public."WeatherGroup" ORDER BY id'
+SQL_CAMERA_LOCATIONS = 'SELECT id, camname, agroid, lat, lon FROM public."SecurityCam" ' \
+    'WHERE lat IS NOT NULL AND lon IS NOT NULL ORDER BY id'
+SQL_EXPORT_WEATHER_DATA = 'SELECT datetime, temperature, humidity, barometer, dewpoint, rain, windspeed, windgust, ' \
+    'winddegrees, winddirection, consbatteryvoltage FROM public."WeatherData" ' \
+    'WHERE weatherstationid = %s AND datetime >= %s AND datetime < %s ORDER BY datetime'
 
 
 def check_user(telegram_id: int) -> bool:
@@ -64,7 +599,7 @@ def check_user(telegram_id: int) -> bool:
     """
     try:
         with DBConnector(db_config) as cur:
-            sql = f'SELECT * FROM public."TelegramBot" WHERE telegram_id in (%s)'
+            sql = SQL_CHECK_USER
             cur.execute(sql, (telegram_id,))
             user_data = cur.fetchall()
             if user_data:
@@ -75,67 +610,75 @@ def check_user(telegram_id: int) -> bool:
         logger.critical(f'Невозможно проверить пользователя. Ошибка: {e}')
 
 
-def registration_users(user_data: dict) -> None:
+def registration_users(user_data: dict) -> bool or None:
     """ Регистрация пользователя в системе. Все данные заносятся в таблицу TelegramBot
 
     :param user_data:
         Словарь фиксированной длины с данными о пользователе
+    :return:
+        True - заявка добавлена, False - заявка пользователя уже есть, None - ошибка базы данных
     """
     try:
         with DBConnector(db_config) as cur:
-            sql = 'INSERT INTO public."TelegramBot"(name, surname, regisdate, ' \
-                  'telegram_id, regcheck, role) ' \
-                  'VALUES (%s, %s, %s, %s, %s, %s);'
+            sql = SQL_REGISTRATION_USER
 
             cur.execute(sql, (user_data['name'],
                               user_data['surname'],
                               user_data['regisdate'],
                               user_data['telegram_id'],
                               False,
-                              user_data['role']))
+                              user_data['role'],
+                              user_data['telegram_id']))
+            return cur.rowcount > 0
     except psycopg2.Error as e:
         logger.critical(f'Невозможно добавить пользователя. Ошибка: {e}')
 
 
-def confirm_reg(telegram_id: int, check: str) -> None:
+def confirm_reg(telegram_id: int, check: str) -> bool or None:
     """ Подтверждение или удаление учётной записи пользователя в базе данных
     :param telegram_id:
         Идентификатор пользователя в telegram
     :param check:
         Параметр, по которому делается запрос в базу данных. В строковом формате, если 'true', то подтверждает
         регистрацию пользователя, если 'delete' - удаляет запись о пользователе из базы данных
+    :return:
+        True - запись изменена, False - заявка уже обработана (повторное нажатие), None - ошибка базы данных
     """
     if check == 'delete':
-        sql = 'DELETE FROM public."TelegramBot" WHERE "telegram_id" = %s'
+        sql = SQL_DELETE_USER
     elif check == 'true':
-        sql = 'UPDATE public."TelegramBot" SET regcheck = True WHERE telegram_id = %s'
+        sql = SQL_CONFIRM_USER
     else:
-        sql = None
+        return False
     try:
-        if sql:
-            with DBConnector(db_config) as cur:
-                cur.execute(sql, (telegram_id, ))
+        with DBConnector(db_config) as cur:
+            cur.execute(sql, (telegram_id, ))
+            return cur.rowcount > 0
     except psycopg2.Error as e:
         logger.critical(f'Невозможно проверить/удалить пользователя. Ошибка: {e}')
 
 
-def check_reg_status(telegram_id: int) -> bool:
+def check_reg_status(telegram_id: int) -> bool or None:
     """ Проверка статуса подтверждения регистрации пользователя
 
     :param telegram_id:
         Идентификатор пользователя в telegram
     :return:
-        Если у пользователя есть подтверждение регистрации - возвращается True
+        Если у пользователя есть подтверждение регистрации - возвращается True.
+        None - статус получить не удалось (нет соединения с базой данных)
     """
     try:
         with DBConnector(db_config) as cur:
-            sql = f'SELECT regcheck FROM public."TelegramBot" WHERE telegram_id in (%s)'
+            sql = SQL_REG_STATUS
             cur.execute(sql, (telegram_id,))
             status = cur.fetchall()
-            return status[0][0]
-    except IndexError as e:
+            return status[0][0] is True
+    except IndexError:
+        return False
+    except psycopg2.Error as e:
         logger.critical(
             f'Невозможно проверить статус регистрации пользователя. Ошибка: {e}')
+        return None
 
 
 def get_role(telegram_id: int) -> int:
@@ -149,7 +692,7 @@ def get_role(telegram_id: int) -> int:
 
     try:
         with DBConnector(db_config) as cur:
-            sql = f'SELECT role FROM public."TelegramBot" WHERE telegram_id in (%s)'
+            sql = SQL_ROLE
             cur.execute(sql, (telegram_id,))
             data = cur.fetchall()
             return data[0][0]
@@ -157,6 +700,21 @@ def get_role(telegram_id: int) -> int:
         logger.critical(f'Невозможно получить данные по роли и месту работы. Ошибка: {e}')
 
 
+def get_confirmed_role(telegram_id: int) -> int or None:
+    """ Роль пользователя с подтверждённой регистрацией
+
+    :return:
+        Номер роли или None, если пользователь не зарегистрирован, не подтверждён или база данных недоступна
+    """
+    try:
+        with DBConnector(db_config) as cur:
+            cur.execute(SQL_CONFIRMED_ROLE, (telegram_id,))
+            row = cur.fetchone()
+            return row[0] if row else None
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить роль пользователя. Ошибка: {e}')
+
+
 def get_weather_station_id_from_agro(agro_id: int) -> list:
     """ Получение id метеостанций
 
@@ -167,7 +725,7 @@ def get_weather_station_id_from_agro(agro_id: int) -> list:
     """
     try:
         with DBConnector(db_config) as cur:
-            sql = f'SELECT weathergroupid FROM public."WeatherGroupAgro" WHERE agroid in (%s)'
+            sql = SQL_WEATHER_STATION_ID_FROM_AGRO
             cur.execute(sql, (agro_id,))
             weather_station_id = cur.fetchall()
             return weather_station_id
@@ -176,8 +734,27 @@ def get_weather_station_id_from_agro(agro_id: int) -> list:
             f'Невозможно получить id метеостанций в Агро {agro_id}. Ошибка: {e}')
 
 
+@single_flight(ttl=2)
+def get_last_weather_data_id() -> int:
+    """ Получение id последней записи о погоде. Используется как версия данных о текущей погоде
+
+    :return:
+        Максимальный id из таблицы WeatherData
+    """
+    try:
+        with DBConnector(db_config) as cur:
+            sql = SQL_LAST_WEATHER_DATA_ID
+            cur.execute(sql)
+            return cur.fetchall()[0][0]
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить id последней записи о погоде. Ошибка: {e}')
+
+
+@single_flight(ttl=60, version=get_last_weather_data_id)
 def get_weather_data_from_agro(agro_id: int) -> list:
-    """ Функция получения данных о текущей погоде в хозяйстве по номеру Агро
+    """ Функция получения данных о текущей погоде в хозяйстве по номеру Агро.
+        Одновременные запросы по одному Агро выполняются одним запросом к базе данных,
+        результат хранится до появления новых данных о погоде
 
     :param agro_id:
         Предприятие, по которому производится запрос
@@ -187,15 +764,9 @@ def get_weather_data_from_agro(agro_id: int) -> list:
 
     try:
         with DBConnector(db_config) as cur:
-            weather_station_id = get_weather_station_id_from_agro(agro_id=agro_id)
-            output_data = []
-            for station_id in weather_station_id:
-                sql = 'SELECT datetime, temperature, humidity, barometer, rain, windspeed, windgust, winddegrees, ' \
-                      'winddirection, weatherstationid, consbatteryvoltage FROM public."WeatherData" ' \
-                      'WHERE weatherstationid in (%s) ORDER BY id DESC LIMIT 1;'
-                cur.execute(sql, (station_id[0],))
-                weather_data = cur.fetchall()
-                output_data.append(weather_data[0])
+            sql = SQL_WEATHER_DATA_FROM_AGRO
+            cur.execute(sql, (agro_id,))
+            output_data = cur.fetchall()
             return output_data
     except psycopg2.Error as e:
         logger.critical(f'Невозможно получить данные по текущей погоде для Агро {agro_id}. Ошибка: {e}')
@@ -212,7 +783,7 @@ def get_weather_station_name(weather_station_id: int) -> str:
 
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT shortname FROM public."WeatherGroup" WHERE id in (%s)'
+            sql = SQL_WEATHER_STATION_NAME
             cur.execute(sql, (weather_station_id,))
             weather_station_name = cur.fetchall()[0][0]
             return weather_station_name
@@ -229,7 +800,7 @@ def get_max_id_from_layer(agro_id: int) -> int:
     """
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT MAX(id) FROM public."Layer" WHERE agroid in (%s) and set in (%s)'
+            sql = SQL_MAX_ID_FROM_LAYER
             cur.execute(sql, (agro_id, 'visual'))
             current_id = cur.fetchall()[0][0]
             return current_id
@@ -238,6 +809,23 @@ def get_max_id_from_layer(agro_id: int) -> int:
             f'Невозможно извлечь данные о пользователях. Ошибка: {e}')
 
 
+def precipitation_period() -> tuple:
+    """ Период, за который считается сумма осадков: с 8 часов вчерашнего дня до 8 часов сегодняшнего"""
+    time_ = time(8, 00)
+    date_end = datetime.combine(datetime.now().date(), time_)
+    date_start = datetime.combine(datetime.now().date() - timedelta(days=1), time_)
+    return date_start, date_end
+
+
+def precipitation_query(weather_station_id: int) -> tuple:
+    """ Запрос суммы осадков за прошедшие сутки и его параметры: по сводным таблицам, если они включены"""
+    date_start, date_end = precipitation_period()
+    if rollups:
+        return SQL_PRECIPITATION_SUM_ROLLUP, (weather_station_id, date_start, date_end,
+                                              weather_station_id, date_start, date_end)
+    return SQL_PRECIPITATION_SUM, (date_start, date_end, weather_station_id)
+
+
 def get_amount_of_precipitation_for_the_last_day(weather_station_id: int) -> float:
     """ Получение суммы осадков за прошедшие сутки с каждой метеостанции
 
@@ -248,13 +836,8 @@ def get_amount_of_precipitation_for_the_last_day(weather_station_id: int) -> flo
     """
     try:
         with DBConnector(db_config) as cur:
-            time_ = time(8, 00)
-            date_end = datetime.combine(datetime.now().date(), time_)
-            date_start = datetime.combine(
-                datetime.now().date() - timedelta(days=1), time_)
-            sql = 'SELECT SUM(rain) FROM public."WeatherData" where datetime ' \
-                  'BETWEEN (%s) AND (%s) AND weatherstationid in (%s)'
-            cur.execute(sql, (date_start, date_end, weather_station_id))
+            sql, params = precipitation_query(weather_station_id)
+            cur.execute(sql, params)
             sum_rain = cur.fetchall()[0][0]
             return sum_rain
     except psycopg2.Error as e:
@@ -262,6 +845,13 @@ def get_amount_of_precipitation_for_the_last_day(weather_station_id: int) -> flo
             f'Невозможно извлечь данные о пользователях. Ошибка: {e}')
 
 
+def zone_query(agro_id: int) -> tuple:
+    """ Запрос микрозон Агро и его параметры: по таблице связи ForecastZoneAgro, если она создана"""
+    if 'forecast_zone_agro' in migrations:
+        return SQL_ZONE_ID_FROM_AGRO, (agro_id,)
+    return SQL_ZONE_ID_FROM_AGRO_TEXT, (str(agro_id),)
+
+
 def get_zone_id_from_agro(agro_id: int) -> list:
     """ Получение id микрозон для конкретного Агро
 
@@ -272,9 +862,8 @@ def get_zone_id_from_agro(agro_id: int) -> list:
     """
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT id, forecastareaname FROM public."ForecastZoneArea" where agroid like (%s)'
-            param = f'%{agro_id}%'
-            cur.execute(sql, (param,))
+            sql, params = zone_query(agro_id)
+            cur.execute(sql, params)
             zones_id = cur.fetchall()
             return zones_id
     except psycopg2.Error as e:
@@ -293,12 +882,9 @@ def get_forecast_data(zone_id: int) -> list:
 
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT "time", summary, precipintensity, precipintensitymax, dewpoint, humidity, pressure, ' \
-                  'temperaturemin, temperaturemax, temperaturemintime, temperaturemaxtime ' \
-                  f'FROM public."ForecastDaily" where forecastzoneid in (%s) '
+            sql = SQL_FORECAST_DATA
             cur.execute(sql, (zone_id,))
             forecast_data = cur.fetchall()
-            print(forecast_data)
             return forecast_data
     except psycopg2.Error as e:
         logging.critical(
@@ -316,7 +902,7 @@ def get_forecast_name(zone_id: int) -> str:
 
     try:
         with DBConnector(db_config) as cur:
-            sql = f'SELECT forecastareaname FROM public."ForecastZoneArea" where id in (%s)'
+            sql = SQL_FORECAST_NAME
             cur.execute(sql, (zone_id,))
             name = cur.fetchall()[0][0]
             return name
@@ -336,7 +922,7 @@ def get_forecast_dates(zone_id: int) -> list:
 
     try:
         with DBConnector(db_config) as cur:
-            sql = f'SELECT "time" FROM public."ForecastDaily" where forecastzoneid in (%s)'
+            sql = SQL_FORECAST_DATES
             cur.execute(sql, (zone_id,))
             dates = cur.fetchall()
             return dates
@@ -345,6 +931,24 @@ def get_forecast_dates(zone_id: int) -> list:
             f'Невозможно получить название микрозоны. Ошибка: {e}')
 
 
+@single_flight(ttl=60)
+def get_forecast_version() -> tuple:
+    """ Получение версии данных прогноза погоды. Версия меняется после ночного обновления таблицы ForecastDaily
+
+    :return:
+        Кортеж из первой и последней даты прогноза и количества записей
+    """
+
+    try:
+        with DBConnector(db_config) as cur:
+            sql = SQL_FORECAST_VERSION
+            cur.execute(sql)
+            return cur.fetchall()[0]
+    except psycopg2.Error as e:
+        logging.critical(
+            f'Невозможно получить версию данных прогноза погоды. Ошибка: {e}')
+
+
 def get_forecast_data_with_date(zone_id: int, forecast_date: datetime.date = None) -> tuple[Any, ...]:
     """ Получение данных по прогнозу для выбранной микрозоны и даты
         Эта функция вынесена отдельно, чтобы точно проверять время прогноза
@@ -357,26 +961,41 @@ def get_forecast_data_with_date(zone_id: int, forecast_date: datetime.date = Non
         Данные о прогнозе погоды по микрозоне по заданной дате
     """
 
+    if not forecast_date:
+        return None
     try:
+        date_start = datetime.strptime(str(forecast_date), '%Y-%m-%d')
         with DBConnector(db_config) as cur:
-            sql = f'SELECT "time" FROM public."ForecastDaily" where forecastzoneid in (%s) '
-            cur.execute(sql, (zone_id,))
-            forecast_date_now = cur.fetchall()
-            for dates in forecast_date_now:
-                if str(forecast_date) == str(dates[0].date()):
-                    sql = 'SELECT "time", summary, precipintensity, ' \
-                          'precipintensitymax, dewpoint, humidity, pressure, ' \
-                          'temperaturemin, temperaturemax, temperaturemintime, temperaturemaxtime ' \
-                          'FROM public."ForecastDaily" where forecastzoneid in (%s) and "time" in (%s)'
-                    cur.execute(sql, (zone_id, forecast_date_now[0]))
-                    forecast_data = cur.fetchall()[0]
-                    return forecast_data
+            sql = SQL_FORECAST_DATA_WITH_DATE
+            cur.execute(sql, (zone_id, date_start, date_start + timedelta(days=1)))
+            forecast_data = cur.fetchall()
+            if forecast_data:
+                return forecast_data[0]
 
-    except psycopg2.Error as e:
+    except (psycopg2.Error, ValueError) as e:
         logging.critical(
             f'Невозможно получить данные о погоде в микрозонах. Ошибка: {e}')
 
 
+def get_all_forecast_data() -> list:
+    """ Получение прогноза погоды по всем микрозонам одним запросом.
+        Используется для построения индекса прогноза после ночного обновления ForecastDaily
+
+    :return:
+        Список кортежей: номер микрозоны, название микрозоны и данные прогноза в том же порядке,
+        что и в get_forecast_data_with_date
+    """
+
+    try:
+        with DBConnector(db_config) as cur:
+            sql = SQL_ALL_FORECAST_DATA
+            cur.execute(sql)
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logging.critical(
+            f'Невозможно получить прогноз погоды по всем микрозонам. Ошибка: {e}')
+
+
 def check_cameras() -> list:
     """ Проверка статуса работы камер
     :return:
@@ -385,39 +1004,89 @@ def check_cameras() -> list:
 
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT * FROM public."SecurityCam"'
+            sql = SQL_CAMERAS
             cur.execute(sql)
             cameras_data = cur.fetchall()
-            output_data = []
-            for camera in cameras_data:
-                if not pythonping.ping(camera[2], count=1).success():
-                    output_data.append(camera)
-            return output_data
     except psycopg2.Error as e:
         logging.critical(
             f'Невозможно получить данные о статусе видеокамер. Ошибка: {e}')
+        return None
+    # Проверка ping выполняется после закрытия соединения, чтобы не занимать его на время проверки
+    return [camera for camera in cameras_data if not pythonping.ping(camera[2], count=1).success()]
 
 
-def get_weather_archive(station_id: int, date: datetime.date) -> list:
-    """ Получение архива данных о погоде (температуре и осадках) за указанный период
-
-    :param station_id:
-        id метеостанции
-    :param date:
-        Дата, по которой извлекаются данные
+def weather_archive_period_query(station_id: int, date_start: datetime.date, date_end: datetime.date,
+                                 step: str) -> tuple:
+    """ Запрос архива за период и его параметры. Для шага в час читается часовая сводная таблица,
+        для дней и недель - дневная (если сводные таблицы включены)
+    """
+    if rollups:
+        sql = SQL_WEATHER_ARCHIVE_PERIOD_HOURLY if step == 'hour' else SQL_WEATHER_ARCHIVE_PERIOD_DAILY
+        return sql, (step, station_id, date_start, date_end, station_id, date_start, date_end)
+    return SQL_WEATHER_ARCHIVE_PERIOD, (step, station_id, date_start, date_end)
+
+
+def get_weather_archive_period(station_id: int, date_start: datetime.date, date_end: datetime.date,
+                               step: str) -> list:
+    """ Архив температуры и осадков за период одним запросом, по строке на каждый интервал
+
+    :param date_start:
+        Первый день периода
+    :param date_end:
+        День после последнего дня периода
+    :param step:
+        Шаг агрегации: hour, day или week
+    :return:
+        Список (начало интервала, максимальная, минимальная, средняя температура, сумма осадков)
     """
+    try:
+        with DBConnector(db_config) as cur:
+            cur.execute(*weather_archive_period_query(station_id, date_start, date_end, step))
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logging.critical(f'Невозможно получить архивные данные о погоде за период. Ошибка запроса БД: {e}')
+
+
+def battery_voltage_period_query(station_id: int, date_start: datetime, date_end: datetime) -> tuple:
+    """ Запрос напряжения батареи по часам и его параметры: по часовой сводной таблице, если она включена"""
+    if rollups:
+        return SQL_BATTERY_VOLTAGE_PERIOD_ROLLUP, (station_id, date_start, date_end, station_id, date_start, date_end)
+    return SQL_BATTERY_VOLTAGE_PERIOD, (station_id, date_start, date_end)
 
+
+def get_battery_voltage_period(station_id: int, date_start: datetime, date_end: datetime) -> list:
+    """ Наименьшее за каждый час напряжение батареи метеостанции за период
+
+    :return:
+        Список (начало часа, напряжение)
+    """
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT MAX(temperature), MIN(temperature), AVG(temperature), SUM(rain) ' \
-                  'FROM public."WeatherData" WHERE weatherstationid in (%s) AND datetime BETWEEN (%s) and (%s)'
-            cur.execute(sql, (station_id, date, datetime.combine(date, time(hour=23, minute=30))))
-            weather_data = cur.fetchall()
-            if weather_data:
-                return weather_data
+            cur.execute(*battery_voltage_period_query(station_id, date_start, date_end))
+            return cur.fetchall()
     except psycopg2.Error as e:
-        logging.critical(
-            f'Невозможно получить архивные данные о погоде. Ошибка запроса БД: {e}')
+        logger.critical(f'Невозможно получить напряжение батареи метеостанции {station_id}. Ошибка: {e}')
+
+
+def battery_voltage_history_query(date_start: datetime.date) -> tuple:
+    """ Запрос истории напряжения батарей и его параметры: по дневной сводной таблице, если она включена"""
+    if rollups:
+        return SQL_BATTERY_VOLTAGE_HISTORY_ROLLUP, (date_start, date_start)
+    return SQL_BATTERY_VOLTAGE_HISTORY, (date_start,)
+
+
+def get_battery_voltage_history(date_start: datetime.date) -> list:
+    """ Наименьшее за каждые сутки напряжение батарей всех метеостанций начиная с date_start одним запросом
+
+    :return:
+        Список (id метеостанции, день, напряжение), упорядоченный по метеостанции и дню
+    """
+    try:
+        with DBConnector(db_config, background=True) as cur:
+            cur.execute(*battery_voltage_history_query(date_start))
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить историю напряжения батарей метеостанций. Ошибка: {e}')
 
 
 def check_weatherstations() -> list:
@@ -427,17 +1096,15 @@ def check_weatherstations() -> list:
     """
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT * FROM public."WeatherStation"'
+            sql = SQL_WEATHER_STATIONS
             cur.execute(sql)
             weatherstations_data = cur.fetchall()
-            output_data = []
-            for weatherstation in weatherstations_data:
-                if not pythonping.ping(weatherstation[7], count=2).success():
-                    output_data.append(weatherstation)
-            return output_data
     except psycopg2.Error as e:
         logging.critical(
             f'Невозможно получить данные о статусе метеостанций. Ошибка: {e}')
+        return None
+    # Проверка ping выполняется после закрытия соединения, чтобы не занимать его на время проверки
+    return [station for station in weatherstations_data if not pythonping.ping(station[7], count=2).success()]
 
 
 def get_list_weather_stations_id() -> list:
@@ -448,7 +1115,7 @@ def get_list_weather_stations_id() -> list:
     try:
         with DBConnector(db_config) as cur:
             try:
-                sql = 'SELECT id FROM public."WeatherStation"'
+                sql = SQL_WEATHER_STATIONS_ID
                 cur.execute(sql)
                 list_weather_stations_id = cur.fetchall()
                 list_stations_id = []
@@ -514,9 +1181,97 @@ def get_list_users() -> list:
     """ Получает список всех зарегистрированных пользователей"""
     try:
         with DBConnector(db_config) as cur:
-            sql = 'SELECT * FROM public."TelegramBot"'
+            sql = SQL_USERS
             cur.execute(sql, )
             list_users_without_reg = cur.fetchall()
             return list_users_without_reg
     except psycopg2.Error as e:
         logger.critical(f'Невозможно получить список пользователей без регистрации. Ошибка: {e}')
+
+
+def get_weather_data_after_id(last_id: int, limit: int = 5000) -> list:
+    """ Показания всех метеостанций с id больше last_id по возрастанию id
+
+    :return:
+        Список (id, id метеостанции, дата и время, температура, влажность, давление, осадки, скорость ветра,
+        порывы ветра)
+    """
+    try:
+        with DBConnector(db_config, background=True) as cur:
+            cur.execute(SQL_WEATHER_DATA_AFTER_ID, (last_id, limit))
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить новые показания метеостанций. Ошибка: {e}')
+
+
+def get_weather_data_since(date_start: datetime) -> list:
+    """ Показания всех метеостанций начиная с date_start по возрастанию id (см. get_weather_data_after_id)"""
+    try:
+        with DBConnector(db_config, background=True) as cur:
+            cur.execute(SQL_WEATHER_DATA_SINCE, (date_start,))
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить показания метеостанций. Ошибка: {e}')
+
+
+def get_station_agro() -> list:
+    """ Пары (id метеостанции, номер Агро)"""
+    try:
+        with DBConnector(db_config) as cur:
+            cur.execute(SQL_STATION_AGRO)
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить список метеостанций Агро. Ошибка: {e}')
+
+
+def get_weather_groups() -> list:
+    """ Список метеостанций: номер и короткое название"""
+    try:
+        with DBConnector(db_config) as cur:
+            sql = SQL_WEATHER_GROUPS
+            cur.execute(sql)
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить список метеостанций. Ошибка: {e}')
+
+
+def get_weather_group_locations() -> list:
+    """ Координаты метеостанций: номер, короткое название и местоположение (строка вида "48.7, 44.5")"""
+    try:
+        with DBConnector(db_config) as cur:
+            cur.execute(SQL_WEATHER_GROUP_LOCATIONS)
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить координаты метеостанций. Ошибка: {e}')
+
+
+def get_camera_locations() -> list:
+    """ Координаты камер видеонаблюдения: id, название, номер Агро, широта и долгота"""
+    try:
+        with DBConnector(db_config) as cur:
+            cur.execute(SQL_CAMERA_LOCATIONS)
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить координаты камер. Ошибка: {e}')
+
+
+def stream_weather_data(weather_station_id: int, date_start: datetime, date_end: datetime, batch: int = 5000):
+    """ Показания метеостанции за период пачками по batch строк. Строки читаются курсором на стороне сервера,
+        поэтому в памяти одновременно находится не больше одной пачки. Ошибки базы данных передаются вызывающему
+
+    :param weather_station_id:
+        Номер метеостанции
+    :param date_start:
+        Начало периода (включительно)
+    :param date_end:
+        Конец периода (не включительно)
+    :return:
+        Генератор списков строк
+    """
+    with DBConnector(db_config, use_snapshot=False, cursor_name='stream_weather_data', background=True) as cur:
+        cur.execute(SQL_EXPORT_WEATHER_DATA, (weather_station_id, date_start, date_end))
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            yield rows
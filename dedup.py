@@ -0,0 +1,88 @@
+""" Отбрасывание повторных входящих обновлений до обработчиков.
+    После переподключения infinity_polling Telegram может повторно прислать уже обработанные обновления -
+    они отбрасываются по update_id в течение DEDUP_UPDATE_SECONDS секунд. Двойное нажатие кнопки приходит двумя
+    нажатиями с одинаковыми данными на одном сообщении - второе отбрасывается, если пришло в течение
+    DEDUP_CALLBACK_SECONDS секунд после первого.
+
+    Память ограничена: хранится не больше DEDUP_MAXSIZE ключей каждого вида, самые старые вытесняются
+"""
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+import settings
+from metrics import metrics
+
+logger = logging.getLogger('__name__')
+
+UPDATE_SECONDS = getattr(settings, 'DEDUP_UPDATE_SECONDS', 600)
+CALLBACK_SECONDS = getattr(settings, 'DEDUP_CALLBACK_SECONDS', 2)
+MAXSIZE = getattr(settings, 'DEDUP_MAXSIZE', 10000)
+
+
+class SeenKeys:
+    """ Ключи, встреченные за последние ttl секунд"""
+
+    def __init__(self, ttl: float, maxsize: int = MAXSIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key) -> bool:
+        """ Запоминает ключ
+
+        :return:
+            True - ключ новый, False - ключ уже встречался за последние ttl секунд
+        """
+        now = monotonic()
+        with self._lock:
+            # Ключи добавляются с одинаковым ttl, поэтому устаревшие всегда находятся в начале
+            while self._expires and next(iter(self._expires.values())) <= now:
+                self._expires.popitem(last=False)
+            if key in self._expires:
+                return False
+            self._expires[key] = now + self.ttl
+            while len(self._expires) > self.maxsize:
+                self._expires.popitem(last=False)
+            return True
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+
+class UpdateDeduplicator:
+    """ Функция приёма обновлений (IntakeTeleBot.intake), отбрасывающая повторы
+
+    :param answer:
+        Функция ответа на отброшенное нажатие кнопки (принимает CallbackQuery), чтобы у пользователя
+        не оставался индикатор загрузки
+    """
+
+    def __init__(self, answer=None, update_ttl: float = UPDATE_SECONDS, callback_ttl: float = CALLBACK_SECONDS):
+        self.answer = answer
+        self.updates = SeenKeys(update_ttl)
+        self.callbacks = SeenKeys(callback_ttl)
+
+    def filter_updates(self, updates: list) -> list:
+        """ Возвращает обновления без повторов"""
+        result = []
+        for update in updates:
+            if not self.updates.add(update.update_id):
+                metrics.inc('bot_duplicate_updates_total', help_text='Отброшенные повторные обновления',
+                            kind='update')
+                continue
+            query = update.callback_query
+            if query is not None and query.message is not None and \
+                    not self.callbacks.add((query.message.chat.id, query.message.message_id, query.data)):
+                metrics.inc('bot_duplicate_updates_total', help_text='Отброшенные повторные обновления',
+                            kind='callback')
+                if self.answer is not None:
+                    try:
+                        self.answer(query)
+                    except Exception as e:
+                        logger.critical(f'Невозможно ответить на повторное нажатие кнопки. Ошибка: {e}')
+                continue
+            result.append(update)
+        return result
@@ -0,0 +1,143 @@
+""" Выгрузка показаний метеостанции за произвольный период в файл CSV или XLSX.
+    Показания читаются из базы пачками курсором на стороне сервера (db.stream_weather_data) и сразу дописываются
+    во временный файл, поэтому расход памяти не зависит от количества строк.
+    Для XLSX нужна библиотека openpyxl, без неё доступна только выгрузка в CSV
+"""
+import csv
+import logging
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+
+import psycopg2
+
+import dboperator as db
+import settings
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+logger = logging.getLogger('__name__')
+
+# Заголовки колонок в порядке db.SQL_EXPORT_WEATHER_DATA
+EXPORT_HEADER = ('Дата и время', 'Температура, °C', 'Влажность, %', 'Давление, мм', 'Точка росы, °C', 'Осадки, мм',
+                 'Скорость ветра, м/с', 'Порывы ветра, м/с', 'Направление ветра, °', 'Направление ветра',
+                 'Напряжение батареи, В')
+
+# Ограничение Telegram на размер отправляемого ботом файла
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+
+class ExportError(Exception):
+    """ Ошибка выгрузки, текст которой можно показать пользователю"""
+
+
+def max_days() -> int:
+    """ Наибольшая длина периода выгрузки в днях"""
+    return getattr(settings, 'EXPORT_MAX_DAYS', 400)
+
+
+def recent_period(days) -> tuple:
+    """ Период выгрузки за последние days дней, включая текущий. Количество дней приходит из данных кнопки,
+        поэтому проверяется так же, как период команды /export
+
+    :return:
+        Кортеж (начало, конец) для db.stream_weather_data
+    """
+    try:
+        days = int(days)
+    except (TypeError, ValueError):
+        raise ExportError('Неверный период выгрузки')
+    if not 1 <= days <= max_days():
+        raise ExportError(f'Период выгрузки не может быть больше {max_days()} дней')
+    end = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+    return end - timedelta(days=days), end
+
+
+def parse_period(date_start: str, date_end: str) -> tuple:
+    """ Период выгрузки из дат в формате ДД.ММ.ГГГГ. Последний день входит в период
+
+    :return:
+        Кортеж (начало, конец) для db.stream_weather_data
+    """
+    try:
+        start = datetime.strptime(date_start, '%d.%m.%Y')
+        end = datetime.strptime(date_end, '%d.%m.%Y') + timedelta(days=1)
+    except ValueError:
+        raise ExportError('Даты нужно указать в формате ДД.ММ.ГГГГ')
+    if end <= start:
+        raise ExportError('Дата окончания периода раньше даты начала')
+    if (end - start).days > max_days():
+        raise ExportError(f'Период выгрузки не может быть больше {max_days()} дней')
+    return start, end
+
+
+def write_csv(batches, path: str) -> int:
+    """ Записывает пачки строк в CSV с разделителем ";" (открывается в Excel без настройки импорта)
+
+    :return:
+        Количество записанных строк
+    """
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8-sig') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(EXPORT_HEADER)
+        for rows in batches:
+            writer.writerows((row[0].strftime('%d.%m.%Y %H:%M'), *row[1:]) for row in rows)
+            count += len(rows)
+    return count
+
+
+def write_xlsx(batches, path: str) -> int:
+    """ Записывает пачки строк в XLSX. Книга в режиме write_only не хранит записанные строки в памяти
+
+    :return:
+        Количество записанных строк
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Показания')
+    sheet.append(EXPORT_HEADER)
+    count = 0
+    for rows in batches:
+        for row in rows:
+            sheet.append(row)
+        count += len(rows)
+    workbook.save(path)
+    return count
+
+
+def export_weather_data(station_id: int, date_start: datetime, date_end: datetime, file_format: str = 'csv') -> tuple:
+    """ Выгружает показания метеостанции во временный файл. Файл удаляет вызывающий
+
+    :param file_format:
+        csv или xlsx
+    :return:
+        Кортеж (путь к файлу, количество строк)
+    """
+    if file_format == 'xlsx' and Workbook is None:
+        raise ExportError('Выгрузка в XLSX недоступна, используйте CSV')
+    writer = write_xlsx if file_format == 'xlsx' else write_csv
+    descriptor, path = tempfile.mkstemp(prefix='export_', suffix=f'.{file_format}')
+    os.close(descriptor)
+    try:
+        count = writer(db.stream_weather_data(station_id, date_start, date_end,
+                                              batch=getattr(settings, 'EXPORT_BATCH', 5000)), path)
+    except psycopg2.Error as e:
+        os.remove(path)
+        logger.critical(f'Невозможно выгрузить показания метеостанции {station_id}. Ошибка: {e}')
+        raise ExportError('Нет соединения с базой данных. Пожалуйста, повторите попытку позже')
+    except Exception:
+        os.remove(path)
+        raise
+    if os.path.getsize(path) > MAX_DOCUMENT_SIZE:
+        os.remove(path)
+        raise ExportError('Файл получился больше 50 МБ. Выберите период короче')
+    return path, count
+
+
+def file_name(station_name: str, date_start: date, date_end: date, file_format: str) -> str:
+    """ Название файла выгрузки для пользователя"""
+    name = ''.join(char if char.isalnum() else '_' for char in station_name or 'meteo')
+    return f'{name}_{date_start:%d.%m.%Y}-{date_end - timedelta(days=1):%d.%m.%Y}.{file_format}'
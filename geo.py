@@ -0,0 +1,152 @@
+""" Поиск ближайших метеостанций и камер видеонаблюдения по местоположению, которым поделился пользователь.
+    Координаты метеостанций (WeatherGroup.location, строка "широта, долгота") и камер (SecurityCam.lat, lon)
+    загружаются один раз при запуске в сеточные индексы: точки раскладываются по ячейкам CELL_DEGREES градусов,
+    поиск просматривает ячейки кольцами вокруг точки запроса и останавливается, как только более дальние
+    кольца не могут содержать более близких точек или находятся дальше NEAREST_MAX_KM километров
+"""
+import math
+import threading
+
+import dboperator as db
+import settings
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Размер ячейки индекса в градусах (около 28 км по широте)
+CELL_DEGREES = 0.25
+# Наибольшее расстояние до метеостанции или камеры в километрах
+MAX_DISTANCE_KM = getattr(settings, 'NEAREST_MAX_KM', 30)
+
+
+def parse_location(text: str) -> tuple or None:
+    """ Координаты из строки "широта, долгота" или None, если строка не разбирается"""
+    try:
+        lat, lon = (float(value) for value in str(text).replace(';', ',').split(','))
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """ Расстояние между точками по поверхности Земли (формула гаверсинусов)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """ Сеточный индекс точек
+
+    :param points:
+        Список (широта, долгота, объект)
+    """
+
+    def __init__(self, points: list, cell: float = CELL_DEGREES):
+        self.cell = cell
+        self.cells = {}
+        for lat, lon, item in points:
+            self.cells.setdefault(self.key(lat, lon), []).append((lat, lon, item))
+        self.size = len(points)
+        rows, columns = [row for row, _ in self.cells], [column for _, column in self.cells]
+        self.extent = (min(rows), max(rows), min(columns), max(columns)) if self.cells else None
+
+    def key(self, lat: float, lon: float) -> tuple:
+        return int(math.floor(lat / self.cell)), int(math.floor(lon / self.cell))
+
+    def ring(self, center: tuple, radius: int):
+        """ Ячейки на расстоянии radius ячеек от центральной (по большей из координат)"""
+        row, column = center
+        for d_row in range(-radius, radius + 1):
+            step = 1 if abs(d_row) == radius else 2 * radius or 1
+            for d_column in range(-radius, radius + 1, step):
+                yield row + d_row, column + d_column
+
+    def bound_km(self, lat: float, radius: int) -> float:
+        """ Наименьшее расстояние до точек, которые лежат за пределами просмотренных radius колец.
+            Отступ по долготе сокращается к полюсам, поэтому берётся по наибольшей широте этих колец
+        """
+        degrees = radius * self.cell
+        widest = min(abs(lat) + degrees + self.cell, 90.0)
+        return degrees * KM_PER_DEGREE * math.cos(math.radians(widest))
+
+    def nearest(self, lat: float, lon: float, count: int = 1, max_km: float = MAX_DISTANCE_KM) -> list:
+        """ Ближайшие точки
+
+        :return:
+            Не больше count пар (расстояние в км, объект) по возрастанию расстояния, не дальше max_km
+        """
+        if not self.size:
+            return []
+        center = self.key(lat, lon)
+        found = []
+        radius = 0
+        # Кольца дальше крайних ячеек с точками не просматриваются
+        min_row, max_row, min_column, max_column = self.extent
+        limit = max(abs(center[0] - min_row), abs(center[0] - max_row),
+                    abs(center[1] - min_column), abs(center[1] - max_column))
+        while radius <= limit:
+            for key in self.ring(center, radius):
+                for point_lat, point_lon, item in self.cells.get(key, ()):
+                    distance = distance_km(lat, lon, point_lat, point_lon)
+                    if distance <= max_km:
+                        found.append((distance, item))
+            bound = self.bound_km(lat, radius)
+            found.sort(key=lambda pair: pair[0])
+            if bound > max_km or (len(found) >= count and found[count - 1][0] <= bound):
+                break
+            radius += 1
+        return found[:count]
+
+
+class LocationIndex:
+    """ Индексы метеостанций и камер видеонаблюдения"""
+
+    def __init__(self):
+        self.stations = GridIndex([])
+        self.cameras = GridIndex([])
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """ Загружает координаты из базы данных
+
+        :return:
+            False, если координаты получить не удалось (остаются прежние индексы)
+        """
+        stations = db.get_weather_group_locations()
+        station_agro = db.get_station_agro()
+        cameras = db.get_camera_locations()
+        if stations is None or station_agro is None or cameras is None:
+            return False
+        agro = {}
+        for station_id, agro_id in station_agro:
+            agro.setdefault(station_id, []).append(agro_id)
+        points = []
+        for station_id, name, location in stations:
+            coordinates = parse_location(location)
+            if coordinates:
+                points.append((*coordinates, (station_id, name, agro.get(station_id, []))))
+        with self._lock:
+            self.stations = GridIndex(points)
+            self.cameras = GridIndex([(float(lat), float(lon), (camera_id, name, agro_id, float(lat), float(lon)))
+                                      for camera_id, name, agro_id, lat, lon in cameras])
+            self.loaded = True
+        return True
+
+    def nearest_stations(self, lat: float, lon: float, count: int = 1) -> list:
+        """ Ближайшие метеостанции: пары (расстояние в км, (номер, короткое название, номера Агро))"""
+        if not self.loaded:
+            self.load()
+        return self.stations.nearest(lat, lon, count)
+
+    def nearest_cameras(self, lat: float, lon: float, count: int = 1) -> list:
+        """ Ближайшие камеры: пары (расстояние в км, (id, название, номер Агро, широта, долгота))"""
+        if not self.loaded:
+            self.load()
+        return self.cameras.nearest(lat, lon, count)
+
+
+location_index = LocationIndex()
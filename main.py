@@ -4,23 +4,47 @@ __author__ = 'Maxim Ilmenskiy, Evgeniy Klucherov'
 __date__ = 'July 2021'
 
 import logging
+import os
 import platform
+import signal
+import sys
 import threading
 from datetime import datetime, time, timedelta
+from functools import partial
 from time import sleep
+from typing import Callable
 
 import requests
 import telebot
 from decouple import config
 
+import alerts
+import archive
+import battery
+import charts
 import dboperator as db
+import geo
+import search
 import settings
-from utils import RepeatedTimer, check_permission, check_registration, create_button, delete_message, \
-    get_agro_from_user, get_agro_from_user_classmethod, mult_threading, parse_query, send_bot_location, send_bot_message
+import subscriptions
+from dedup import UpdateDeduplicator
+from export import ExportError, export_weather_data, file_name, parse_period, recent_period
+from metrics import measure, metrics, start_metrics_server, timed
+from migrations import check_migrations
+from profiling import profiler, thread_stacks
+from recorder import start_recorder
+from rollup import start_rollups
+from search import search_index
+from snapshot import start_snapshot
+from subscriptions import AGRO_LIST, ALL_AGRO, CAMERA_ROLES, subscription_index
+from throttle import throttle
+from utils import IntakeTeleBot, RepeatedTimer, check_permission, check_registration, create_button, \
+    delete_message, forecast_index, get_agro_from_user, get_agro_from_user_classmethod, mult_threading, parse_query, \
+    render_cache, send_bot_location, send_bot_message, start_weather_version, weather_version
 
 
 # Управляющий токен для бота
-bot = telebot.TeleBot(config('TOKEN', default=''))
+bot = IntakeTeleBot(config('TOKEN', default=''))
 logger = logging.getLogger('__name__')
 
 """ Существует система распределения информации в зависимости от роли
@@ -57,56 +81,149 @@ def timer(start: str, func_name: str, *args):
             globals()[func_name]()
 
 
+@render_cache.cached('weather', version=weather_version.get)
+def render_weather(agro_id: int) -> tuple or None:
+    """ Формирует экран текущей погоды в выбранном Агро
+    :param agro_id:
+        Номер Агро
+    :return:
+        Кортеж из текста сообщения и клавиатуры или None, если данные недоступны
+    """
+    weather_data = db.get_weather_data_from_agro(agro_id=agro_id)
+    if not weather_data:
+        return None
+
+    names = {weather[9]: db.get_weather_station_name(weather_station_id=weather[9]) for weather in weather_data}
+    return weather_view(weather_data, names)
+
+
+def weather_view(weather_data: list, names: dict) -> tuple:
+    """ Экран текущей погоды по уже полученным данным (общий для синхронного и асинхронного режима)
+
+    :param weather_data:
+        Строки db.get_weather_data_from_agro
+    :param names:
+        Словарь {id метеостанции: название}
+    """
+    text = '*Текущая погода*\n'
+    for weather in weather_data:
+        text += f'\nМетеостанция: _{names.get(weather[9])}_\n' + weather_station_text(weather)
+
+    keyboard = create_button('back_to_weather_agro_menu', 'back_to_menu')
+    return text, keyboard
+
+
+def weather_station_text(weather: list) -> str:
+    """ Текущая погода на метеостанции
+
+    :param weather:
+        Строка db.get_weather_data_from_agro
+    """
+    weather_date = datetime.strftime(weather[0], '%d-%m-%Y %H:%M')
+    wind_speed = f'{weather[5]} м/с' if weather[5] else 'Ветра нет'
+    gusts_speed = f'{weather[6]} м/с' if weather[6] else 'Порывов нет'
+    wind_direction = f'{weather[7]}°' if weather[7] else 'Ветра нет'
+    return f'Дата и время: {weather_date}\n' \
+           f'Температура: {weather[1]}°\n' \
+           f'Влажность: {weather[2]}%\n' \
+           f'Давление (по барометру): {weather[3]} мм\n' \
+           f'Текущие осадки: {weather[4] if weather[4] else 0} мм\n' \
+           f'Скорость ветра: {wind_speed}\n' \
+           f'Порывы ветра: {gusts_speed}\n' \
+           f'Направление ветра: {wind_direction}\n'
+
+
+def weather_screen(agro_id: int) -> tuple:
+    """ Экран текущей погоды в выбранном Агро или сообщение об ошибке, если данные недоступны"""
+    return render_weather(agro_id=agro_id) or weather_unavailable()
+
+
+def weather_unavailable() -> tuple:
+    """ Сообщение о недоступности текущей погоды"""
+    text = 'Невозможно получить доступ к текущей погоде. Потеряно соединение с базой данных.\n ' \
+           'Пожалуйста, повторите попытку позже'
+    keyboard = create_button('back_to_weather_agro_menu', 'back_to_menu')
+    return text, keyboard
+
+
 @get_agro_from_user
 def answer_about_weather(query: telebot.types.CallbackQuery) -> None:
     """ Ответ на запрос о погоде в выбранном Агро"""
+    data = parse_query(query=query)
+    text, keyboard = weather_screen(agro_id=int(data.get('agro')))
+    send_bot_message(users=query.message.chat.id, text=text, keyboard=keyboard)
 
-    def parse_weather_data(weather_data: list) -> str:
-        """ Парсит данные о погоде в строковый формат
-        :param weather_data:
-            Список данных с погодой из базы данных
-        :return:
-            Строковый формат представления данных по всем заданным метеостанциям
-        """
-        text_ = ''
-        if weather_data:
-            text_ = '*Текущая погода*\n'
-            for i in range(0, len(weather_data)):
-                weather_date = datetime.strftime(weather_data[i][0], '%d-%m-%Y %H:%M')
-                weather_station_name = db.get_weather_station_name(weather_station_id=weather_data[i][9])
-                if weather_data[i][5]:
-                    wind_speed = str(weather_data[i][5]) + ' м/с'
-                else:
-                    wind_speed = 'Ветра нет'
-                if weather_data[i][6]:
-                    gusts_speed = str(weather_data[i][6]) + ' м/с'
-                else:
-                    gusts_speed = 'Порывов нет'
-                if weather_data[i][7]:
-                    wind_direction = str(weather_data[i][7]) + '°'
-                else:
-                    wind_direction = 'Ветра нет'
-                text_ += f'\nМетеостанция: _{weather_station_name}_\n' \
-                         f'Дата и время: {weather_date}\n' \
-                         f'Температура: {weather_data[i][1]}°\n' \
-                         f'Влажность: {weather_data[i][2]}%\n' \
-                         f'Давление (по барометру): {weather_data[i][3]} мм\n' \
-                         f'Текущие осадки: {weather_data[i][4] if weather_data[i][4] else 0} мм\n' \
-                         f'Скорость ветра: {wind_speed}\n' \
-                         f'Порывы ветра: {gusts_speed}\n' \
-                         f'Направление ветра: {wind_direction}\n'
-        return text_
 
-    data = parse_query(query=query)
-    text = parse_weather_data(weather_data=db.get_weather_data_from_agro(agro_id=int(data.get('agro'))))
+# Количество ближайших метеостанций в ответе на местоположение
+NEAREST_STATIONS = getattr(settings, 'NEAREST_STATIONS', 2)
 
-    if not text:
-        bot.send_chat_action(chat_id=query.message.chat.id, action='typing')
-        text = 'Невозможно получить доступ к текущей погоде. Потеряно соединение с базой данных.\n ' \
-               'Пожалуйста, повторите попытку позже'
 
-    keyboard = create_button('back_to_weather_agro_menu', 'back_to_menu')
-    send_bot_message(users=query.message.chat.id, text=text, keyboard=keyboard)
+def answer_about_location(users: int, lat: float, lon: float) -> None:
+    """ Ответ на местоположение пользователя: текущая погода на ближайших метеостанциях, а для ролей с доступом
+        к камерам - ближайшая камера видеонаблюдения
+    """
+    role = db.get_role(telegram_id=users)
+    if role == 9999:
+        send_bot_message(users=users, text='У вас нет доступа к этой функции')
+        return
+
+    stations = geo.location_index.nearest_stations(lat, lon, count=NEAREST_STATIONS)
+    if stations:
+        text = '*Ближайшие метеостанции*\n'
+        for distance, (station_id, name, agro) in stations:
+            weather_data = db.get_weather_data_from_agro(agro_id=agro[0]) if agro else None
+            weather = next((row for row in weather_data or [] if row[9] == station_id), None)
+            text += f'\nМетеостанция: _{name}_ ({distance:.1f} км)\n'
+            text += weather_station_text(weather) if weather else 'Нет данных о текущей погоде\n'
+    else:
+        text = f'В радиусе {geo.MAX_DISTANCE_KM} км от вас нет метеостанций'
+
+    camera = geo.location_index.nearest_cameras(lat, lon) if role in CAMERA_ROLES else []
+    if camera:
+        distance, (_, name, agro_id, camera_lat, camera_lon) = camera[0]
+        text += f'\n*Ближайшая камера*: {name}\nНомер Агро: {agro_id}\nРасстояние: {distance:.1f} км\n' \
+                f'\nМестоположение камеры: (см. ниже)'
+        send_bot_message(users=users, text=text)
+        send_bot_location(users=users, lon=camera_lon, lat=camera_lat, back=True)
+    else:
+        send_bot_message(users=users, text=text, back=True)
+
+
+def inline_result(entry: dict) -> telebot.types.InlineQueryResultArticle:
+    """ Результат встроенного режима со ссылкой, которая открывает экран записи в боте
+
+    :param entry:
+        Запись индекса поиска (см. search.SearchIndex)
+    """
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    keyboard.add(telebot.types.InlineKeyboardButton(
+        text='Открыть в боте', url=f'https://t.me/{bot.user.username}?start={entry["payload"]}'))
+    text = f'{search.KIND_TITLES[entry["kind"]]}: {entry["title"]}'
+    return telebot.types.InlineQueryResultArticle(
+        id=entry['payload'], title=entry['title'], description=entry['description'],
+        input_message_content=telebot.types.InputTextMessageContent(message_text=text), reply_markup=keyboard)
+
+
+def answer_about_link(users: int, payload: str) -> None:
+    """ Открывает экран по ссылке из встроенного режима: меню архива метеостанции, выбор даты прогноза
+        по микрозоне или местоположение камеры. Права проверяются заново, так как ссылку можно переслать
+    """
+    kind, item_id, agro_id = search.parse_payload(payload)
+    role = db.get_role(telegram_id=users)
+    entry = search_index.get(kind, item_id, agro_id)
+    if role == 9999 or entry is None or (kind == 'camera' and role not in CAMERA_ROLES):
+        send_bot_message(users=users, text='Ссылка недоступна', back=True)
+        return
+
+    if kind == 'station':
+        WeatherArchive.send_station_menu(users=users, station_id=item_id, agro_id=entry['agro'])
+    elif kind == 'zone':
+        Forecast.send_zone_dates(users=users, zone_id=str(item_id), agro_id=str(entry['agro']))
+    else:
+        lat, lon = entry['location']
+        send_bot_message(users=users, text=f'*Камера*: {entry["title"]}\nНомер Агро: {entry["agro"]}\n'
+                                           f'\nМестоположение камеры: (см. ниже)')
+        send_bot_location(users=users, lon=lon, lat=lat, back=True)
 
 
 class WeatherArchive:
@@ -127,67 +244,165 @@ class WeatherArchive:
     def get_archive_stations_date(self):
         """ Меню выбора даты архива"""
         data = parse_query(query=self.query)
+        self.send_station_menu(users=self.query.message.chat.id, station_id=int(data.get('station')),
+                               agro_id=int(data.get('agro')))
 
+    @staticmethod
+    def send_station_menu(users: int, station_id: int, agro_id: int) -> None:
+        """ Меню архива выбранной метеостанции: недели, календарь и выгрузка в файл"""
         # Создание кнопок меню
-        args = ['archive_stations_date', 'back_to_archive_stations', 'back_to_archive_agro_menu', 'back_to_menu']
+        args = ['archive_stations_date', 'archive_calendar', 'archive_export', 'back_to_archive_stations',
+                'back_to_archive_agro_menu', 'back_to_menu']
         kwargs = {
-            'station_id': int(data.get('station')),
-            'agro_id': int(data.get('agro'))
+            'station_id': station_id,
+            'agro_id': agro_id
         }
 
         keyboard = create_button(*args, **kwargs)
-        bot.send_message(chat_id=self.query.message.chat.id,
-                         text='Выберите необходимую неделю в архиве:',
+        bot.send_message(chat_id=users,
+                         text='Выберите необходимую неделю или период в календаре либо выгрузите показания в файл. '
+                              'Выгрузка за любой период: /export',
                          reply_markup=keyboard)
 
+    def export_archive(self) -> bool:
+        """ Выгрузка показаний выбранной метеостанции за последние дни в CSV
+
+        :return:
+            True - выгрузка запущена в отдельном потоке и сама отметит завершение запроса в throttle
+        """
+        try:
+            date_start, date_end = recent_period(self.data.get('days', 30))
+        except ExportError as e:
+            send_bot_message(users=self.query.message.chat.id, text=str(e))
+            return False
+        send_weather_export(self.query.message.chat.id, int(self.data.get('station')), date_start, date_end,
+                            release=partial(throttle.release, self.query.from_user.id, 'archive_export',
+                                            self.query.data))
+        return True
+
     def answer_about_archive_weather(self) -> None:
-        """ Ответ на запрос пользователя по архиву погоды"""
-
-        def get_range(week: int) -> datetime.date:
-            """Получение диапазона для работы с архивом"""
-            if week == 1:
-                date_range_1_ = datetime.now().date()
-                date_range_2_ = datetime.now().date() - timedelta(days=7)
-            elif week == 2:
-                date_range_1_ = datetime.now().date() - timedelta(days=7)
-                date_range_2_ = datetime.now().date() - timedelta(days=14)
-            elif week == 3:
-                date_range_1_ = datetime.now().date() - timedelta(days=14)
-                date_range_2_ = datetime.now().date() - timedelta(days=21)
-            else:
-                date_range_1_ = datetime.now().date() - timedelta(days=21)
-                date_range_2_ = datetime.now().date() - timedelta(days=28)
-            return date_range_1_, date_range_2_
+        """ Ответ на запрос пользователя по архиву погоды за одну из последних недель"""
+        date_start, date_end = archive.week_period(week=int(self.data.get('week')))
+        self.send_archive_period(int(self.data.get('station')), int(self.data.get('agro')), date_start, date_end)
+
+    def get_archive_calendar(self) -> None:
+        """ Календарь выбора периода архива. После выбора первого дня показывается календарь выбора последнего"""
+        station_id, agro_id = int(self.data.get('s')), int(self.data.get('a'))
+        first_day = archive.from_key(self.data['f']) if self.data.get('f') else None
+        keyboard = archive.calendar_keyboard(month=archive.from_key(self.data.get('m')), station_id=station_id,
+                                             agro_id=agro_id, first_day=first_day)
+        keyboard.keyboard.extend(create_button('back_to_archive_station_week_menu', 'back_to_menu',
+                                               station_id=station_id, agro_id=agro_id).keyboard)
+        if first_day:
+            text = f'Начало периода: {first_day:%d.%m.%Y}. Выберите последний день периода:'
+        else:
+            text = f'Выберите первый день периода (не больше {archive.max_days()} дней):'
+        send_bot_message(users=self.query.message.chat.id, text=text, keyboard=keyboard)
 
-        data = parse_query(query=self.query)
-        date_range_1, date_range_2 = get_range(week=int(data.get('week')))
-        search_date = date_range_2
-
-        station_name = db.get_weather_station_name(weather_station_id=int(data.get('station')))
-        text = f'*Архив погоды* метеостанции {station_name}:\n\n'
-
-        while search_date <= date_range_1:
-            weather_data = db.get_weather_archive(station_id=int(data.get('station')), date=search_date)
-            if weather_data:
-                text += f'Дата: {search_date}\n' \
-                        f'Макс.темп: {str(round(weather_data[0][0], 1)) + "°" if weather_data[0][0] else "Нет данных"}\n' \
-                        f'Мин.темп: {str(round(weather_data[0][1], 1)) + "°" if weather_data[0][1] else "Нет данных"}\n' \
-                        f'Ср.темп: {str(round(weather_data[0][2], 1)) + "°" if weather_data[0][2] else "Нет данных"}\n' \
-                        f'Осадки: {str(round(weather_data[0][3], 1)) if weather_data[0][3] else 0} мм\n\n'
-            search_date += timedelta(days=1)
-
-        args = ['back_to_archive_stations', 'back_to_archive_station_week_menu', 'back_to_archive_agro_menu',
-                'back_to_menu']
-        kwargs = {
-            'station_id': int(data.get('station')),
-            'agro_id': int(data.get('agro'))
-        }
+    def choose_archive_day(self) -> None:
+        """ Выбор дня в календаре архива: первый выбранный день - начало периода, второй - его конец"""
+        day = archive.from_key(self.data.get('d'))
+        if not self.data.get('f'):
+            self.data.update({'m': self.data.get('d'), 'f': self.data.get('d')})
+            self.get_archive_calendar()
+            return
 
-        keyboard = create_button(*args, **kwargs)
+        first_day = archive.from_key(self.data.get('f'))
+        date_start, date_end = min(first_day, day), max(first_day, day) + timedelta(days=1)
+        try:
+            archive.check_period(date_start, date_end)
+        except archive.ArchiveError as e:
+            send_bot_message(users=self.query.message.chat.id, text=f'{e}. Выберите последний день ещё раз')
+            self.data.update({'m': self.data.get('d')})
+            self.get_archive_calendar()
+            return
+        self.send_archive_period(int(self.data.get('s')), int(self.data.get('a')), date_start, date_end)
+
+    def archive_period(self) -> tuple or None:
+        """ Период архива из данных кнопки. О неверном периоде сообщается пользователю, возвращается None"""
+        try:
+            return archive.parse_period(self.data.get('f'), self.data.get('t'))
+        except archive.ArchiveError as e:
+            keyboard = create_button('back_to_archive_station_week_menu', 'back_to_menu',
+                                     station_id=int(self.data.get('s')), agro_id=int(self.data.get('a')))
+            send_bot_message(users=self.query.message.chat.id, text=str(e), keyboard=keyboard)
+            return None
+
+    def get_archive_page(self) -> None:
+        """ Страница архива за выбранный период"""
+        period = self.archive_period()
+        if period:
+            self.send_archive_period(int(self.data.get('s')), int(self.data.get('a')), *period,
+                                     page=int(self.data.get('p', 1)))
+
+    def get_archive_chart(self) -> None:
+        """ График архива за выбранный период. Для периодов до 2 месяцев строится по часам, для длинных - по дням"""
+        station_id = int(self.data.get('s'))
+        period = self.archive_period()
+        if not period:
+            return
+        date_start, date_end = period
+        step = 'hour' if (date_end - date_start).days <= 62 else 'day'
+        caption = f'Архив погоды метеостанции {db.get_weather_station_name(weather_station_id=station_id)}: ' \
+                  f'{date_start:%d.%m.%Y} - {date_end - timedelta(days=1):%d.%m.%Y}'
+
+        def build() -> bytes or None:
+            rows = db.get_weather_archive_period(station_id=station_id, date_start=date_start, date_end=date_end,
+                                                 step=step)
+            return charts.archive_chart('Температура и осадки', rows or [])
+
+        charts.chart_pool.submit(send_chart, self.query.message.chat.id, ('archive', station_id, date_start, date_end),
+                                 build, caption)
+
+    def send_archive_period(self, station_id: int, agro_id: int, date_start: datetime.date,
+                            date_end: datetime.date, page: int = 1) -> None:
+        """ Отправляет страницу архива за период"""
         bot.send_chat_action(chat_id=self.query.message.chat.id, action='typing')
+        screen = render_archive_period(station_id, agro_id, date_start, date_end, page)
+        if screen:
+            text, keyboard = screen
+        else:
+            text = 'Невозможно получить доступ к архиву погоды. Потеряно соединение с базой данных.\n ' \
+                   'Пожалуйста, повторите попытку позже'
+            keyboard = create_button('back_to_archive_station_week_menu', 'back_to_menu', station_id=station_id,
+                                     agro_id=agro_id)
         send_bot_message(users=self.query.message.chat.id, text=text, keyboard=keyboard)
 
 
+@render_cache.cached('archive_period', version=weather_version.get)
+def render_archive_period(station_id: int, agro_id: int, date_start: datetime.date, date_end: datetime.date,
+                          page: int) -> tuple or None:
+    """ Формирует страницу архива погоды за период. Шаг агрегации выбирается по длине периода,
+        все интервалы считаются одним запросом к базе данных
+
+    :param date_end:
+        День после последнего дня периода
+    :return:
+        Кортеж из текста сообщения и клавиатуры или None, если данные недоступны
+    """
+    step = archive.granularity(date_start, date_end)
+    weather_data = db.get_weather_archive_period(station_id=station_id, date_start=date_start, date_end=date_end,
+                                                 step=step)
+    if weather_data is None:
+        return None
+
+    pages = archive.paginate(archive.archive_lines(weather_data, step, date_start, date_end), step)
+    page = min(max(page, 1), len(pages))
+    station_name = db.get_weather_station_name(weather_station_id=station_id)
+    text = f'*Архив погоды* метеостанции {station_name}\n' \
+           f'Период: {date_start:%d.%m.%Y} - {date_end - timedelta(days=1):%d.%m.%Y}, ' \
+           f'{archive.STEP_NAMES[step]}\n' \
+           f'Макс. / мин. / ср. температура, осадки:\n\n'
+    text += '\n'.join(pages[page - 1]) if weather_data else 'Нет данных за выбранный период'
+    if len(pages) > 1:
+        text += f'\n\nСтраница {page} из {len(pages)}'
+
+    menu = create_button('archive_calendar', 'back_to_archive_station_week_menu', 'back_to_archive_stations',
+                         'back_to_archive_agro_menu', 'back_to_menu', station_id=station_id, agro_id=agro_id)
+    keyboard = archive.page_keyboard(date_start, date_end, page, len(pages), station_id, agro_id, menu)
+    return text, keyboard
+
+
 class Forecast:
     """ Класс создания меню прогноза погоды"""
 
@@ -218,45 +433,74 @@ class Forecast:
 
     def get_forecast_zone_date(self):
         """ Строит меню выбора даты прогноза погоды для указанной микрозоны"""
-        args = ['forecast_zones_date', 'back_to_forecast_zones', 'back_to_forecast_agro_menu', 'back_to_menu']
-        kwargs = {
-            'zone_id': self.data.get('zone'),
-            'agro_id': self.data.get('agro')
-        }
-        keyboard = create_button(*args, **kwargs)
-        send_bot_message(users=self.query.message.chat.id, text='Выберите дату прогноза:', keyboard=keyboard)
+        self.send_zone_dates(users=self.query.message.chat.id, zone_id=self.data.get('zone'),
+                             agro_id=self.data.get('agro'))
+
+    @staticmethod
+    def send_zone_dates(users: int, zone_id: str, agro_id: str) -> None:
+        """ Меню выбора даты прогноза погоды для микрозоны"""
+        keyboard = forecast_index.get_keyboard(zone_id=zone_id, agro_id=agro_id)
+        if not keyboard:
+            args = ['forecast_zones_date', 'back_to_forecast_zones', 'back_to_forecast_agro_menu', 'back_to_menu']
+            kwargs = {
+                'zone_id': zone_id,
+                'agro_id': agro_id
+            }
+            keyboard = create_button(*args, **kwargs)
+        send_bot_message(users=users, text='Выберите дату прогноза:', keyboard=keyboard)
+
+    @staticmethod
+    @render_cache.cached('forecast', version=lambda: forecast_index.version)
+    def render_forecast(zone_id: str, forecast_date: str, agro_id: str) -> tuple or None:
+        """ Формирует экран прогноза погоды на выбранную дату для заданной микрозоны.
+            Данные берутся из индекса прогноза, база данных используется только если индекс ещё не построен
+        :return:
+            Кортеж из текста сообщения и клавиатуры или None, если данные недоступны
+        """
+        zone = forecast_index.get_forecast(zone_id=zone_id, forecast_date=forecast_date) or \
+            db.get_forecast_data_with_date(zone_id=zone_id, forecast_date=forecast_date)
+        if not zone:
+            return None
 
-    def answer_about_forecast(self) -> None:
-        """ Ответ на запрос о прогнозе погоды в выбранном Агро и заданной микрозоне"""
+        zone_name = forecast_index.get_zone_name(zone_id=zone_id) or db.get_forecast_name(zone_id=zone_id)
+        return Forecast.forecast_view(zone, zone_name, zone_id=zone_id, agro_id=agro_id)
+
+    @staticmethod
+    def forecast_view(zone: tuple, zone_name: str, zone_id: str, agro_id: str) -> tuple:
+        """ Экран прогноза погоды по уже полученным данным (общий для синхронного и асинхронного режима)"""
+        text = f'*Прогноз погоды* на {zone[0].date()} по микрозоне: _{zone_name}_\n\n' \
+               f'Общий прогноз: {zone[1]}\n' \
+               f'Средние осадки: {round(zone[2], 1)} мм/ч\n' \
+               f'Максимальные осадки: {round(zone[3], 1)} мм/ч\n' \
+               f'Точка росы: {round(zone[4], 1)}°\n' \
+               f'Влажность: {round(zone[5], 1)}%\n' \
+               f'Давление: {round(zone[6] / 1.333, 1)} мм\n' \
+               f'Мин.темп: {round(zone[7], 1)}° в {zone[9].time()}\n' \
+               f'Макс.темп: {round(zone[8], 1)}° в {zone[10].time()}\n'
 
-        def parse_forecast_data(zone: tuple or None) -> str:
-            """Парсит данные по прогнозу погоды на выбранную дату для заданной микрозоны"""
-            text_ = ''
-            if zone:
-                zone_name = db.get_forecast_name(zone_id=self.data.get('zone'))
-                text_ = f'*Прогноз погоды* на {zone[0].date()} по микрозоне: _{zone_name}_\n\n' \
-                        f'Общий прогноз: {zone[1]}\n' \
-                        f'Средние осадки: {round(zone[2], 1)} мм/ч\n' \
-                        f'Максимальные осадки: {round(zone[3], 1)} мм/ч\n' \
-                        f'Точка росы: {round(zone[4], 1)}°\n' \
-                        f'Влажность: {round(zone[5], 1)}%\n' \
-                        f'Давление: {round(zone[6] / 1.333, 1)} мм\n' \
-                        f'Мин.темп: {round(zone[7], 1)}° в {zone[9].time()}\n' \
-                        f'Макс.темп: {round(zone[8], 1)}° в {zone[10].time()}\n'
-            return text_
-
-        zone_id = self.data.get('zone')
-        forecast_date = self.data.get('date')
-        text = parse_forecast_data(zone=db.get_forecast_data_with_date(zone_id=zone_id, forecast_date=forecast_date))
-        if not text:
-            text = 'Невозможно получить доступ к данным. Потеряно соединение с базой данных.\n' \
-                   'Пожалуйста, повторите попытку позже'
         args = ['back_to_forecast_zones_date', 'back_to_forecast_zones', 'back_to_forecast_agro_menu', 'back_to_menu']
-        kwargs = {
-            'zone_id': zone_id,
-            'agro_id': self.data.get('agro')
-        }
-        keyboard = create_button(*args, **kwargs)
+        keyboard = create_button(*args, zone_id=zone_id, agro_id=agro_id)
+        return text, keyboard
+
+    @classmethod
+    def forecast_screen(cls, zone_id: str, forecast_date: str, agro_id: str) -> tuple:
+        """ Экран прогноза погоды или сообщение об ошибке, если данные недоступны"""
+        return cls.render_forecast(zone_id=zone_id, forecast_date=forecast_date, agro_id=agro_id) or \
+            cls.forecast_unavailable(zone_id=zone_id, agro_id=agro_id)
+
+    @staticmethod
+    def forecast_unavailable(zone_id: str, agro_id: str) -> tuple:
+        """ Сообщение о недоступности прогноза погоды"""
+        text = 'Невозможно получить доступ к данным. Потеряно соединение с базой данных.\n' \
+               'Пожалуйста, повторите попытку позже'
+        args = ['back_to_forecast_zones_date', 'back_to_forecast_zones', 'back_to_forecast_agro_menu', 'back_to_menu']
+        keyboard = create_button(*args, zone_id=zone_id, agro_id=agro_id)
+        return text, keyboard
+
+    def answer_about_forecast(self) -> None:
+        """ Ответ на запрос о прогнозе погоды в выбранном Агро и заданной микрозоне"""
+        text, keyboard = self.forecast_screen(zone_id=self.data.get('zone'), forecast_date=self.data.get('date'),
+                                              agro_id=self.data.get('agro'))
         send_bot_message(users=self.query.message.chat.id, text=text, keyboard=keyboard)
 
 
@@ -305,33 +549,152 @@ def answer_about_weather_stations(query: telebot.types.CallbackQuery) -> None:
     send_bot_message(users=query.message.chat.id, text=text, keyboard=keyboard)
 
 
+@render_cache.cached('battery', version=lambda: (weather_version.get(), battery.battery_forecast.version))
+def render_weather_battery(agro_id: int) -> tuple or None:
+    """ Формирует экран состояния батареек метеостанций в выбранном Агро
+    :param agro_id:
+        Номер Агро
+    :return:
+        Кортеж из текста сообщения и клавиатуры или None, если данные недоступны
+    """
+    weather_data_battery = db.get_weather_data_from_agro(agro_id=agro_id)
+    if not weather_data_battery:
+        return None
+
+    names = {weather[9]: db.get_weather_station_name(weather_station_id=weather[9])
+             for weather in weather_data_battery}
+    return weather_battery_view(weather_data_battery, names, agro_id)
+
+
+def weather_battery_view(weather_data_battery: list, names: dict, agro_id: int) -> tuple:
+    """ Экран состояния батареек по уже полученным данным (общий для синхронного и асинхронного режима)
+
+    :param weather_data_battery:
+        Строки db.get_weather_data_from_agro
+    :param names:
+        Словарь {id метеостанции: название}
+    """
+    text = ''
+    for i in range(0, len(weather_data_battery)):
+        weather_station_name = names.get(weather_data_battery[i][9])
+
+        if weather_data_battery[i][10]:
+            voltage = str(weather_data_battery[i][10]) + ' В'
+        else:
+            voltage = 'Нет данных'
+
+        forecast = battery.describe(battery.battery_forecast.get(weather_data_battery[i][9]))
+        text += f'\n*Статус батареи* на _{weather_station_name}_\n' \
+                f'Дата и время: {weather_data_battery[i][0]}\n' \
+                f'Напряжение батареи: {voltage}\n' \
+                f'{forecast}\n'
+
+    args = ['battery_chart'] if charts.available() else []
+    keyboard = create_button(*args, 'back_to_battery_agro_menu', 'back_to_menu', agro_id=agro_id)
+    return text, keyboard
+
+
+def weather_battery_screen(agro_id: int) -> tuple:
+    """ Экран состояния батареек в выбранном Агро или сообщение об ошибке, если данные недоступны"""
+    return render_weather_battery(agro_id=agro_id) or weather_battery_unavailable()
+
+
+def weather_battery_unavailable() -> tuple:
+    """ Сообщение о недоступности состояния батареек"""
+    text = 'Невозможно получить доступ к данным. Потеряно соединение с базой данных.\n' \
+           'Пожалуйста, повторите попытку позже'
+    keyboard = create_button('back_to_battery_agro_menu', 'back_to_menu')
+    return text, keyboard
+
+
 @get_agro_from_user
 def answer_about_weather_battery(query: telebot.types.CallbackQuery) -> None:
     """ Ответ на запрос о состоянии батареек в выбранном Агро"""
+    data = parse_query(query=query)
+    text, keyboard = weather_battery_screen(agro_id=int(data.get('agro')))
+    send_bot_message(users=query.message.chat.id, text=text, keyboard=keyboard)
 
-    def parse_weather_battery_data(weather_data_battery: list) -> str:
-        """ Парсит данные по напряжению батареек на метеостанции"""
-        text_ = ''
-        for i in range(0, len(weather_data_battery)):
-            weather_station_name = db.get_weather_station_name(weather_station_id=weather_data_battery[i][9])
 
-            if weather_data_battery[i][10]:
-                voltage = str(weather_data_battery[i][10]) + ' В'
-            else:
-                voltage = 'Нет данных'
+def answer_about_battery_chart(query: telebot.types.CallbackQuery) -> None:
+    """ График напряжения батарей метеостанций выбранного Агро за последние BATTERY_CHART_DAYS дней"""
+    agro_id = int(parse_query(query=query).get('agro'))
 
-            text_ += f'\n*Статус батареи* на _{weather_station_name}_\n' \
-                     f'Дата и время: {weather_data_battery[i][0]}\n' \
-                     f'Напряжение батареи: {voltage}\n'
-        return text_
+    def build() -> bytes or None:
+        date_end = datetime.now() + timedelta(hours=1)
+        date_start = date_end - timedelta(days=getattr(settings, 'BATTERY_CHART_DAYS', 14))
+        series = {}
+        for station_id, *_ in db.get_weather_station_id_from_agro(agro_id=agro_id) or []:
+            name = db.get_weather_station_name(weather_station_id=station_id) or str(station_id)
+            series[name] = db.get_battery_voltage_period(station_id, date_start, date_end) or []
+        return charts.battery_chart('Напряжение батарей метеостанций', series,
+                                    cutoff=battery.CUTOFF_VOLTAGE)
 
-    data = parse_query(query=query)
-    text = parse_weather_battery_data(db.get_weather_data_from_agro(agro_id=data.get('agro')))
-    keyboard = create_button('back_to_battery_agro_menu', 'back_to_menu')
-    if not text:
-        text = 'Невозможно получить доступ к данным. Потеряно соединение с базой данных.\n' \
-               'Пожалуйста, повторите попытку позже'
-    send_bot_message(users=query.message.chat.id, text=text, keyboard=keyboard)
+    charts.chart_pool.submit(send_chart, query.message.chat.id, ('battery', agro_id), build)
+
+
+def send_chart(users: int, key: tuple, build, caption: str = None) -> None:
+    """ Отправляет график. Выполняется в пуле charts.chart_pool, чтобы построение не задерживало обработку
+        обновлений. График с той же версией данных повторно не строится: отправляется file_id из charts.chart_cache
+
+    :param key:
+        Ключ графика без версии данных
+    :param build:
+        Функция построения PNG (None, если данных нет)
+    """
+    try:
+        key = (*key, weather_version.get())
+        file_id = charts.chart_cache.get(key)
+        photo = file_id
+        if file_id is None:
+            bot.send_chat_action(chat_id=users, action='upload_photo')
+            with measure('bot_stage_seconds', help_text='Время этапов обработки запроса', stage='chart'):
+                photo = build()
+            if photo is None:
+                send_bot_message(users=users, text='Нет данных для построения графика')
+                return
+        with measure('bot_telegram_api_seconds', help_text='Время запросов к Telegram API', method='send_photo'):
+            message = bot.send_photo(chat_id=users, photo=photo, caption=caption)
+        if file_id is None and message.photo:
+            charts.chart_cache.set(key, message.photo[-1].file_id)
+    except Exception as e:
+        logger.critical(f'Невозможно отправить график {key}. Ошибка: {e}')
+
+
+def subscriptions_menu(users: int) -> None:
+    """ Меню подписок на автоматические уведомления. Пользователям с ролью 9999 недоступно"""
+    role = db.get_role(telegram_id=users)
+    if role is None or role == 9999:
+        send_bot_message(users=users, text='У вас нет доступа к подпискам на уведомления', back=role is not None)
+        return
+    keyboard = subscriptions.events_keyboard(telegram_id=users, role=role)
+    keyboard.keyboard.extend(create_button('back_to_menu').keyboard)
+    send_bot_message(users=users, keyboard=keyboard,
+                     text='*Подписки на уведомления*\nОтмеченные уведомления приходят вам автоматически. '
+                          'Нажмите на уведомление, чтобы подписаться или отменить подписку:')
+
+
+def subscriptions_agro_menu(users: int, event: str) -> None:
+    """ Выбор хозяйств для уведомления, которое приходит по каждому Агро отдельно"""
+    if event not in subscriptions.available_events(db.get_role(telegram_id=users)):
+        subscriptions_menu(users=users)
+        return
+    send_bot_message(users=users, keyboard=subscriptions.agro_keyboard(telegram_id=users, event=event),
+                     text=f'*{subscriptions.EVENTS[event][0]}*\nВыберите хозяйства, по которым присылать уведомления:')
+
+
+def toggle_subscription(users: int, event: str, agro_id: int) -> None:
+    """ Подписка на уведомление или её отмена с возвратом в меню, из которого она изменена"""
+    if event not in subscriptions.available_events(db.get_role(telegram_id=users)):
+        subscriptions_menu(users=users)
+        return
+    if subscription_index.toggle(telegram_id=users, event=event, agro_id=agro_id) is None:
+        send_bot_message(users=users, text='Нет соединения с базой данных. Пожалуйста, повторите попытку позже',
+                         back=True)
+        return
+    if subscriptions.EVENTS[event][1]:
+        subscriptions_agro_menu(users=users, event=event)
+    else:
+        subscriptions_menu(users=users)
 
 
 # @TODO доделать меню Wialon
@@ -358,7 +721,14 @@ def insert_user_in_db(message: telebot.types.Message) -> None:
                  'telegram_id': message.chat.id,
                  'role': 1}
 
-    db.registration_users(user_data=user_data)
+    registered = db.registration_users(user_data=user_data)
+    if registered is None:
+        send_bot_message(users=message.chat.id,
+                         text='Нет соединения с базой данных. Пожалуйста, повторите попытку позже')
+        return
+    # Повторная заявка (двойная команда /reg) не добавляет запись и не отправляет уведомления ещё раз
+    if not registered:
+        return
     text_admin = '*[Автоматическое уведомление*]:\n' \
                  f'Новый {mention_user(user_data["telegram_id"])} ' \
                  'подал заявку для работы с ботом. Сделайте проверку учетной записи:'
@@ -374,7 +744,15 @@ def insert_user_in_db(message: telebot.types.Message) -> None:
 def reg_user(query: telebot.types.CallbackQuery) -> None:
     """ Регистрирует или удаляет пользователя, в зависимости от переданных данных"""
     data = parse_query(query=query)
-    db.confirm_reg(telegram_id=int(data.get('user')), check=data.get('check'))
+    changed = db.confirm_reg(telegram_id=int(data.get('user')), check=data.get('check'))
+    if changed is None:
+        send_bot_message(users=query.message.chat.id,
+                         text='Нет соединения с базой данных. Пожалуйста, повторите попытку позже')
+        return
+    # Заявка уже одобрена или отклонена (повторное нажатие): пользователь уведомлён ранее
+    if not changed:
+        send_bot_message(users=query.message.chat.id, text='Заявка уже обработана')
+        return
     if data.get('check') == 'true':
         keyboard = create_button('menu', 'help', 'contact')
         send_bot_message(users=int(data.get('user')), text='*[Автоматическое уведомление]*\n'
@@ -387,12 +765,95 @@ def reg_user(query: telebot.types.CallbackQuery) -> None:
                                                            'Ваша заявка была отклонена. Вы не можете продолжить работу')
 
 
+def send_report(users: int, report: str) -> None:
+    """ Отправляет отчёт моноширинным текстом без разметки Markdown, разбивая его на сообщения до 4000 символов"""
+    lines = report.splitlines()
+    chunk = []
+    for line in lines + [None]:
+        if line is None or sum(len(item) + 1 for item in chunk) + len(line) > 4000:
+            if chunk:
+                with measure('bot_telegram_api_seconds', help_text='Время запросов к Telegram API',
+                             method='send_message'):
+                    bot.send_message(chat_id=users, text='\n'.join(chunk))
+            chunk = []
+        if line is not None:
+            chunk.append(line[:4000])
+
+
+@mult_threading
+def run_profile(users: int, seconds: int) -> None:
+    """ Сеанс профилирования всех потоков бота. По окончании отчёт отправляется администратору"""
+    report = profiler.run(seconds=seconds)
+    if report is None:
+        send_bot_message(users=users, text='Профилирование уже запущено')
+        return
+    send_report(users=users, report=report)
+    send_bot_message(users=users, text='Меню администратора:', keyboard=create_button('admin_profile',
+                                                                                       'admin_threads', 'menu'))
+
+
+# Одновременные выгрузки показаний: каждая занимает соединение с базой данных на всё время чтения
+export_slots = threading.BoundedSemaphore(getattr(settings, 'EXPORT_CONCURRENCY', 2))
+
+
+@mult_threading
+def send_weather_export(users: int, station_id: int, date_start: datetime, date_end: datetime,
+                        file_format: str = 'csv', release: Callable = None) -> None:
+    """ Выгружает показания метеостанции за период в файл и отправляет его пользователю
+
+    :param date_start:
+        Начало периода (включительно)
+    :param date_end:
+        Конец периода (не включительно)
+    :param file_format:
+        csv или xlsx
+    :param release:
+        Отметка о завершении запроса в throttle. Выгрузка выполняется в отдельном потоке, поэтому запрос
+        считается завершённым только после отправки файла
+    """
+    try:
+        export_and_send(users, station_id, date_start, date_end, file_format)
+    finally:
+        if release is not None:
+            release()
+
+
+def export_and_send(users: int, station_id: int, date_start: datetime, date_end: datetime, file_format: str) -> None:
+    """ Выгрузка и отправка файла (см. send_weather_export)"""
+    keyboard = create_button('back_to_archive_agro_menu', 'back_to_menu')
+    with export_slots:
+        bot.send_chat_action(chat_id=users, action='upload_document')
+        try:
+            path, count = export_weather_data(station_id, date_start, date_end, file_format=file_format)
+        except ExportError as e:
+            send_bot_message(users=users, text=str(e), keyboard=keyboard)
+            return
+    try:
+        if not count:
+            send_bot_message(users=users, text='За выбранный период показаний нет', keyboard=keyboard)
+            return
+        station_name = db.get_weather_station_name(weather_station_id=station_id)
+        with open(path, 'rb') as document, measure('bot_telegram_api_seconds',
+                                                   help_text='Время запросов к Telegram API',
+                                                   method='send_document'):
+            bot.send_document(chat_id=users, document=document, reply_markup=keyboard,
+                              caption=f'Показания метеостанции {station_name}: {count} записей',
+                              visible_file_name=file_name(station_name, date_start, date_end, file_format))
+    finally:
+        os.remove(path)
+
+
+# Описание метрики времени обработки команд и кнопок
+HANDLER_HELP = 'Время обработки команд и нажатий кнопок'
+
+
 # @TODO необходимо доделать отправку сообщений в главной функции
 @mult_threading
 def main() -> None:
     """ Основная функция. Здесь содержатся все функции обработки входящих сообщений и запросов от пользователей."""
 
     @bot.message_handler(commands=['start'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/start')
     def start_command(message: telebot.types.Message) -> None:
         """ Обработчик команды /start
 
@@ -402,6 +863,11 @@ def main() -> None:
             На основе этих атрибутов можно работать с конкретным пользователем.
             Например: message.chat.id = это id пользователя Telegram.
         """
+        # Ссылка из встроенного режима: t.me/<бот>?start=<параметр>
+        payload = telebot.util.extract_arguments(message.text or '')
+        if search.parse_payload(payload):
+            open_link(message, payload)
+            return
         keyboard = create_button('reg', 'contact', 'menu')
         bot.send_message(chat_id=message.chat.id,
                          text=f'Приветствуем, _{message.chat.first_name}_!\n'
@@ -410,7 +876,29 @@ def main() -> None:
                          reply_markup=keyboard,
                          parse_mode='Markdown')
 
+    @check_registration
+    def open_link(message: telebot.types.Message, payload: str) -> None:
+        """ Открывает экран по ссылке из встроенного режима (только для зарегистрированных пользователей)"""
+        answer_about_link(users=message.chat.id, payload=payload)
+
+    @bot.inline_handler(func=lambda query: True)
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='inline')
+    def inline_query(query: telebot.types.InlineQuery) -> None:
+        """ Обработчик встроенного режима (@бот запрос): поиск метеостанций, микрозон прогноза и камер.
+            Камеры показываются только ролям с доступом к ним
+        """
+        role = search_index.role(telegram_id=query.from_user.id)
+        if role is None:
+            bot.answer_inline_query(inline_query_id=query.id, results=[], cache_time=60, is_personal=True,
+                                    switch_pm_text='Поиск доступен после регистрации в боте',
+                                    switch_pm_parameter='reg')
+            return
+        kinds = () if role == 9999 else ('station', 'zone', 'camera') if role in CAMERA_ROLES else ('station', 'zone')
+        results = [inline_result(entry) for entry in search_index.search(query.query, kinds)]
+        bot.answer_inline_query(inline_query_id=query.id, results=results, cache_time=60, is_personal=True)
+
     @bot.message_handler(commands=['help'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/help')
     @check_registration
     def help_command(message: telebot.types.Message) -> None:
         """ Обработчики команды /help
@@ -429,6 +917,7 @@ def main() -> None:
                          parse_mode='Markdown')
 
     @bot.message_handler(commands=['reg'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/reg')
     @check_registration
     def reg_command(message: telebot.types.Message):
         """ Обработчик команды /reg
@@ -450,6 +939,7 @@ def main() -> None:
             insert_user_in_db(message=message)
 
     @bot.message_handler(commands=['contact'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/contact')
     def contact_command(message: telebot.types.Message) -> None:
         """ Обработчики команды /contact
 
@@ -471,6 +961,7 @@ def main() -> None:
                          reply_markup=keyboard)
 
     @bot.message_handler(commands=['menu'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/menu')
     @check_registration
     def menu_command(message: telebot.types.Message) -> None:
         """ Основное меню. Здесь происходят вся магия.
@@ -484,32 +975,130 @@ def main() -> None:
         role = db.get_role(telegram_id=message.chat.id)
         if role == 2:
             keyboard = create_button('weather', 'archive', 'forecast', 'cameras', 'weather_stations', 'battery',
-                                     'wialon', 'admin_menu', 'help')
+                                     'wialon', 'subscriptions', 'admin_menu', 'help')
         elif role == 3:
             keyboard = create_button('weather', 'archive', 'forecast', 'cameras', 'weather_stations', 'battery',
-                                     'wialon', 'help')
+                                     'wialon', 'subscriptions', 'help')
         elif role == 4:
-            keyboard = create_button('weather', 'archive', 'forecast', 'cameras', 'wialon', 'help')
+            keyboard = create_button('weather', 'archive', 'forecast', 'cameras', 'wialon', 'subscriptions', 'help')
         elif role == 9999:
             keyboard = None
             bot.send_message(chat_id=message.chat.id, text='Основное меню недоступно. У вас нет доступа')
         else:
-            keyboard = create_button('weather', 'archive', 'forecast', 'wialon', 'help')
+            keyboard = create_button('weather', 'archive', 'forecast', 'wialon', 'subscriptions', 'help')
 
         bot.send_message(chat_id=message.chat.id,
                          text='Основное меню _Geliopaxgeo_:',
                          reply_markup=keyboard,
                          parse_mode='Markdown')
 
+    @bot.message_handler(commands=['subscriptions'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/subscriptions')
+    @check_registration
+    def subscriptions_command(message: telebot.types.Message) -> None:
+        """ Обработчик команды /subscriptions. Меню подписок на автоматические уведомления"""
+        subscriptions_menu(users=message.chat.id)
+
+    @bot.message_handler(commands=['export'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/export')
+    @check_registration
+    def export_command(message: telebot.types.Message) -> None:
+        """ Обработчик команды /export. Выгрузка показаний метеостанции за период в файл:
+            /export <номер метеостанции> <ДД.ММ.ГГГГ> <ДД.ММ.ГГГГ> [xlsx]
+        """
+        if db.get_role(telegram_id=message.chat.id) == 9999:
+            send_bot_message(users=message.chat.id, text='У вас нет доступа к этой команде')
+            return
+        args = message.text.split()[1:]
+        if len(args) not in (3, 4) or not args[0].isdigit():
+            stations = '\n'.join(f'{station_id} - {name}' for station_id, name in db.get_weather_groups() or [])
+            send_bot_message(users=message.chat.id,
+                             text='Выгрузка показаний метеостанции за период:\n'
+                                  '`/export <номер> <ДД.ММ.ГГГГ> <ДД.ММ.ГГГГ>`\n'
+                                  'Для выгрузки в Excel добавьте в конце `xlsx`\n\n'
+                                  f'Метеостанции:\n```\n{stations}```')
+            return
+        try:
+            date_start, date_end = parse_period(args[1], args[2])
+        except ExportError as e:
+            send_bot_message(users=message.chat.id, text=str(e))
+            return
+        file_format = 'xlsx' if len(args) == 4 and args[3].lower() == 'xlsx' else 'csv'
+        refusal = throttle.acquire(message.chat.id, 'export')
+        if refusal:
+            send_bot_message(users=message.chat.id, text=refusal)
+            return
+        try:
+            send_weather_export(message.chat.id, int(args[0]), date_start, date_end, file_format,
+                                release=partial(throttle.release, message.chat.id, 'export'))
+        except Exception:
+            throttle.release(message.chat.id, 'export')
+            raise
+
+    @bot.message_handler(commands=['nearest'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/nearest')
+    @check_registration
+    def nearest_command(message: telebot.types.Message) -> None:
+        """ Обработчик команды /nearest. Кнопка отправки местоположения для поиска ближайших метеостанций"""
+        keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+        keyboard.add(telebot.types.KeyboardButton(text='Отправить местоположение', request_location=True))
+        bot.send_message(chat_id=message.chat.id,
+                         text='Отправьте своё местоположение, чтобы узнать погоду на ближайших метеостанциях',
+                         reply_markup=keyboard)
+
+    @bot.message_handler(content_types=['location'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='location')
+    @check_registration
+    def location_message(message: telebot.types.Message) -> None:
+        """ Обработчик местоположения, которым поделился пользователь"""
+        answer_about_location(users=message.chat.id, lat=message.location.latitude,
+                              lon=message.location.longitude)
+
     @bot.message_handler(commands=['admin'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='/admin')
     @check_registration
     @check_permission
     def admin_command(message: telebot.types.Message) -> None:
-        """ Обработчик команды /admin"""
-        pass
-        # args = ['users_list', 'users_list_without_reg']
+        """ Обработчик команды /admin. Меню профилирования работающего бота"""
+        keyboard = create_button('admin_profile', 'admin_threads', 'menu')
+        status = 'идёт сеанс профилирования' if profiler.running else 'профилирование не запущено'
+        bot.send_message(chat_id=message.chat.id,
+                         text=f'Меню администратора ({status}):',
+                         reply_markup=keyboard)
+
+    @check_permission
+    def admin_action(query: telebot.types.CallbackQuery, data: dict) -> None:
+        """ Выполняет действие из меню администратора
+
+        :param query:
+            Переменная, отвечающая за нажатие кнопки
+        :param data:
+            Данные кнопки, разобранные parse_query
+        """
+        users = query.message.chat.id
+        if data.get('button') == 'admin_profile':
+            seconds = int(data.get('seconds', 30))
+            if profiler.running:
+                send_bot_message(users=users, text='Профилирование уже запущено')
+            else:
+                send_bot_message(users=users, text=f'Профилирование запущено на {seconds} с. '
+                                                   f'Отчёт придёт по окончании сеанса')
+                run_profile(users, seconds)
+            return
+
+        if data.get('button') == 'admin_profile_stop':
+            if not profiler.stop():
+                send_bot_message(users=users, text='Профилирование не запущено')
+            return
+
+        if data.get('button') == 'admin_threads':
+            send_report(users=users, report=thread_stacks())
+        elif data.get('button') == 'admin_db':
+            send_report(users=users, report=db.db_stats.dump())
+        admin_command(message=query.message)
 
     @bot.message_handler(content_types=['text', 'photo', 'audio'])
+    @timed('bot_handler_seconds', help_text=HANDLER_HELP, route='other_messages')
     @check_registration
     def other_messages(message: telebot.types.Message) -> None:
         """ Обработчик всех левых сообщений
@@ -527,16 +1116,44 @@ def main() -> None:
 
     @bot.callback_query_handler(func=lambda call: True)
     def button_handler(query: telebot.types.CallbackQuery) -> None:
-        """ Обработчик нажатия клавиш в меню пользователя
+        """ Обработчик нажатия клавиш в меню пользователя. Время обработки записывается в метрики по кнопкам
 
         :param query:
             Переменная, отвечающая за нажатие кнопки. На основе данных
             атрибутов query можно выполнить необходимый запрос от пользователя
         """
-        print(query.data)
         data = parse_query(query=query)
+        # Повторное нажатие во время обработки и слишком частые тяжёлые запросы отклоняются
+        refusal = throttle.acquire(query.from_user.id, data.get('button'), query.data)
+        if refusal:
+            bot.answer_callback_query(callback_query_id=query.id, text=refusal)
+            return
+        detached = False
+        try:
+            with measure('bot_handler_seconds', help_text=HANDLER_HELP, route=f'callback:{data.get("button")}'):
+                detached = route_button(query=query, data=data)
+        finally:
+            # Действие, запущенное в отдельном потоке, отмечает завершение само
+            if not detached:
+                throttle.release(query.from_user.id, data.get('button'), query.data)
+
+    def route_button(query: telebot.types.CallbackQuery, data: dict) -> bool or None:
+        """ Выполняет действие нажатой кнопки
+
+        :param query:
+            Переменная, отвечающая за нажатие кнопки
+        :param data:
+            Данные кнопки, разобранные parse_query
+        :return:
+            True - действие выполняется в отдельном потоке и само вызовет throttle.release
+        """
         bot.answer_callback_query(callback_query_id=query.id)
-        delete_message(query=query)
+        # Кнопки-подписи календаря (название месяца, дни недели) ничего не делают
+        if data.get('button') == 'noop':
+            return
+        # График отправляется дополнительно к экрану, с которого он запрошен
+        if data.get('button') not in ('arc_chart', 'battery_chart'):
+            delete_message(query=query)
 
         # Кнопка основное меню
         if data.get('button') == 'menu':
@@ -572,6 +1189,21 @@ def main() -> None:
         elif data.get('button') == 'archive_stations_date':
             WeatherArchive(query=query).answer_about_archive_weather()
 
+        elif data.get('button') == 'archive_export':
+            return WeatherArchive(query=query).export_archive()
+
+        elif data.get('button') == 'arc_cal':
+            WeatherArchive(query=query).get_archive_calendar()
+
+        elif data.get('button') == 'arc_day':
+            WeatherArchive(query=query).choose_archive_day()
+
+        elif data.get('button') == 'arc_page':
+            WeatherArchive(query=query).get_archive_page()
+
+        elif data.get('button') == 'arc_chart':
+            WeatherArchive(query=query).get_archive_chart()
+
         elif data.get('button') == 'forecast':
             Forecast(query=query).get_forecast_zone()
 
@@ -593,6 +1225,19 @@ def main() -> None:
         elif data.get('button') == 'battery':
             answer_about_weather_battery(query=query)
 
+        elif data.get('button') == 'battery_chart':
+            answer_about_battery_chart(query=query)
+
+        # Меню подписок на автоматические уведомления
+        elif data.get('button') == 'subs':
+            subscriptions_menu(users=query.message.chat.id)
+
+        elif data.get('button') == 'subs_event':
+            subscriptions_agro_menu(users=query.message.chat.id, event=data.get('e'))
+
+        elif data.get('button') == 'subs_toggle':
+            toggle_subscription(users=query.message.chat.id, event=data.get('e'), agro_id=int(data.get('a')))
+
         # Вызов меню Wialon
         elif data.get('button') == 'wialon':
             answer_about_wialon(query=query)
@@ -746,6 +1391,10 @@ def main() -> None:
         elif data.get('button') == 'admin_menu':
             admin_command(message=query.message)
 
+        # Профилирование и состояние потоков из меню администратора
+        elif data.get('button', '').startswith('admin_'):
+            admin_action(query=query, data=data)
+
 
 @mult_threading
 def alert_messages_about_sentinel(agro_id: int) -> None:
@@ -760,10 +1409,21 @@ def alert_messages_about_sentinel(agro_id: int) -> None:
         while current_id > db.get_max_id_from_layer(agro_id=agro_id):
             sleep(5)
 
-        text = '*[Автоматическое уведомление]*:\n' \
-               'Опубликован новый спутниковый снимок по хозяйству Гелио-Пакс Агро {workplace}.\n' \
-               'Вы можете просмотреть его на сайте _Geliopaxgeo_.'
-        send_bot_message(users=settings.ALERTS_SENTINEL, text=text, back=True)
+        send_bot_message(users=subscription_index.recipients('sentinel', agro_id), text=sentinel_alert_text(agro_id),
+                         back=True)
+
+
+def sentinel_alert_text(agro_id: int) -> str:
+    """ Текст уведомления о новом спутниковом снимке по хозяйству"""
+    return '*[Автоматическое уведомление]*:\n' \
+           f'Опубликован новый спутниковый снимок по хозяйству Гелио-Пакс Агро {agro_id}.\n' \
+           'Вы можете просмотреть его на сайте _Geliopaxgeo_.'
+
+
+def is_working_time() -> bool:
+    """ Рабочее время, в которое проверяется состояние метеостанций и камер"""
+    return time(8, 00) <= datetime.now().time() <= time(17, 00) and (datetime.now().isoweekday() != 6 or
+                                                                     datetime.now().isoweekday() != 7)
 
 
 @mult_threading
@@ -778,7 +1438,7 @@ def alerts_rain() -> None:
             Список списков
         :example:
             >>> get_rain_data_from_weather_stations()
-            [['0.3', 'Новокиевка'], ['1.7', 'Красноармейский']]
+            [['0.3', 'Новокиевка', 1], ['1.7', 'Красноармейский', 3]]
         """
         all_rain_data = []
         for agro_id in range(1, 7):
@@ -790,28 +1450,32 @@ def alerts_rain() -> None:
                 sum_rains = db.get_amount_of_precipitation_for_the_last_day(weather_station_id=station_id[0])
                 name_station = db.get_weather_station_name(weather_station_id=station_id[0])
                 if sum_rains is not None:
-                    all_rain_data.append([sum_rains, name_station])
+                    all_rain_data.append([sum_rains, name_station, agro_id])
         return all_rain_data
 
-    # @TODO Доделать рассылку для работников агро
-    def send_message(data_rains: list) -> None:
-        """ Отправляет сообщению пользователю о сумме осадков"""
-        output_str_office = ''
+    def rain_text(data_rains: list, agro: set) -> str:
+        """ Текст уведомления о сумме осадков по хозяйствам agro (ALL_AGRO - по всем хозяйствам)"""
+        output_str = ''
         for data in data_rains:
-            if data[0] != 0:
-                output_str_office += f'\n\nМетеостанция: {data[1]}\nОсадки: {data[0]} мм'
+            if data[0] != 0 and (ALL_AGRO in agro or data[2] in agro):
+                output_str += f'\n\nМетеостанция: {data[1]}\nОсадки: {data[0]} мм'
 
-        if output_str_office:
-            text = '*[Автоматическое уведомление]*:\n ' \
+        if ALL_AGRO in agro:
+            farms = 'во всех хозяйствах Гелио-Пакс Агро'
+        else:
+            farms = 'в хозяйствах Гелио-Пакс Агро ' + ', '.join(str(agro_id) for agro_id in sorted(agro))
+        if output_str:
+            return '*[Автоматическое уведомление]*:\n ' \
                    'Выпавшие осадки за период \n' \
                    f'с {date_start.date()} по {date_end.date()}:\n' \
-                   'По всем хозяйствам Гелио-Пакс Агро:' + output_str_office
-        else:
-            text = '*[Автоматическое уведомление]*:\n' \
-                   f'За период с {date_start.date()} по {date_end.date()} осадков ' \
-                   'во всех хозяйствах Гелио-Пакс Агро не было.\n'
+                   f'{farms[0].upper()}{farms[1:]}:' + output_str
+        return '*[Автоматическое уведомление]*:\n' \
+               f'За период с {date_start.date()} по {date_end.date()} осадков {farms} не было.\n'
 
-        send_bot_message(users=settings.ALERTS_RAIN, text=text, back=True)
+    def send_message(data_rains: list) -> None:
+        """ Отправляет пользователям сумму осадков: сотрудникам Агро - только по их хозяйствам"""
+        for user, agro in subscription_index.recipients_by_agro('rain').items():
+            send_bot_message(users=user, text=rain_text(data_rains, agro), back=True)
 
     time_ = time(8, 00)
     date_end = datetime.combine(datetime.now().date(), time_)
@@ -901,12 +1565,14 @@ def alert_forecast_volgograd() -> None:
     # Прогноз погоды на сегодня
     if time(5, 59) < time_ < time(18, 2):
         if weather_today and header_today:
-            send_bot_message(users=settings.ALERTS_FORECAST_VLG, text=header_today + weather_today, back=True)
+            send_bot_message(users=subscription_index.recipients('forecast_vlg'), text=header_today + weather_today,
+                             back=True)
 
     # Прогноз погоды на завтра
     if time(20, 59) < time_ < time(21, 2):
         if weather_tomorrow and header_tomorrow:
-            send_bot_message(users=settings.ALERTS_FORECAST_VLG, text=header_tomorrow + weather_tomorrow, back=True)
+            send_bot_message(users=subscription_index.recipients('forecast_vlg'),
+                             text=header_tomorrow + weather_tomorrow, back=True)
 
 
 @mult_threading
@@ -914,8 +1580,7 @@ def alert_about_weather_stations() -> None:
     """ Автоматическая проверка статуса метеостанций"""
     while True:
         sleep(1)
-        if time(8, 00) <= datetime.now().time() <= time(17, 00) and (datetime.now().isoweekday() != 6 or
-                                                                     datetime.now().isoweekday() != 7):
+        if is_working_time():
             flag_1, flag_2 = False, False
 
             weatherstations_1 = db.check_weatherstations()
@@ -928,31 +1593,133 @@ def alert_about_weather_stations() -> None:
                 flag_2 = True
 
             if flag_1 and flag_2:
-                # Шапка сообщения
-                header = '*[Автоматическое уведомление]*:\n' \
-                         f'Список метеостанций, которые не работают в данный момент:'
-                msg = ''
-
-                for station in weatherstations_2:
-                    # @TODO Необходимо убрать эту проверку, когда подключат 9-ую метеостанцию
-                    if station[0] == 9:
-                        continue
-                    msg = f'\n\nМетеостанция: {station[2]}' \
-                          f'\nID метеостанции: {station[0]}' \
-                          f'\nIP-адрес: {station[7]}'
-
-                if msg:
-                    send_bot_message(users=settings.ALERTS_WEATHERSTATIONS, text=header + msg, back=True)
+                text = weather_stations_alert_text(weatherstations_2)
+                if text:
+                    send_bot_message(users=subscription_index.recipients('weather_stations'), text=text, back=True)
                 sleep(7200)
 
 
+def weather_stations_alert_text(weatherstations: list) -> str or None:
+    """ Текст уведомления о неработающих метеостанциях или None, если уведомлять не о чем"""
+    # Шапка сообщения
+    header = '*[Автоматическое уведомление]*:\n' \
+             f'Список метеостанций, которые не работают в данный момент:'
+    msg = ''
+
+    for station in weatherstations:
+        # @TODO Необходимо убрать эту проверку, когда подключат 9-ую метеостанцию
+        if station[0] == 9:
+            continue
+        msg = f'\n\nМетеостанция: {station[2]}' \
+              f'\nID метеостанции: {station[0]}' \
+              f'\nIP-адрес: {station[7]}'
+
+    return header + msg if msg else None
+
+
+@mult_threading
+def alert_about_weather() -> None:
+    """ Уведомления о погоде по правилам alerts.py (заморозок, сильный дождь, порывы ветра и т.д.)"""
+    engine = alerts.create_engine()
+    while True:
+        check_weather_alerts(engine)
+        sleep(getattr(settings, 'ALERT_POLL_SECONDS', 60))
+
+
+def check_weather_alerts(engine: alerts.AlertEngine) -> None:
+    """ Проверяет правила по новым показаниям и отправляет уведомления, объединённые по получателям"""
+    found = engine.poll()
+    names = {station_id: db.get_weather_station_name(weather_station_id=station_id)
+             for station_id in {alert[1] for alert in found}}
+    for users, texts in weather_alert_messages(engine, found, names).items():
+        for number, text in enumerate(texts, 1):
+            send_bot_message(users=list(users), text=text, back=number == len(texts))
+
+
+def weather_alert_messages(engine: alerts.AlertEngine, found: list, names: dict) -> dict:
+    """ Сообщения об уведомлениях о погоде, объединённые по получателям
+
+    :param found:
+        Уведомления AlertEngine.poll
+    :param names:
+        Словарь {id метеостанции: название}
+    :return:
+        Словарь {кортеж получателей: список сообщений}
+    """
+    messages = {}
+    for alert in found:
+        users = alert[0].users or subscription_index.recipients('weather', *engine.station_agro.get(alert[1], ()))
+        messages.setdefault(tuple(users) if isinstance(users, list) else (users,), []).append(
+            alerts.alert_text(alert, names.get(alert[1])))
+    return {users: alerts.split_messages('*[Автоматическое уведомление]*:\n', lines)
+            for users, lines in messages.items()}
+
+
+@mult_threading
+def alert_about_batteries() -> None:
+    """ Пересчёт прогноза разряда батарей метеостанций и уведомления о скором отключении"""
+    alerted = {}
+    while True:
+        check_batteries(alerted)
+        sleep(battery.REFRESH_SECONDS)
+
+
+def check_batteries(alerted: dict) -> None:
+    """ Пересчитывает прогноз разряда батарей и в рабочее время уведомляет о метеостанциях, которые отключатся
+        в ближайшие BATTERY_ALERT_DAYS дней. О каждой метеостанции уведомление приходит не чаще раза в сутки
+
+    :param alerted:
+        Словарь {id метеостанции: день последнего уведомления}, сохраняется между вызовами
+    """
+    if not battery.battery_forecast.refresh() or not is_working_time():
+        return
+    low = due_battery_alerts(alerted)
+    names = {station_id: db.get_weather_station_name(weather_station_id=station_id) for station_id in low}
+    text = battery_alert_text(low, names)
+    if text:
+        send_bot_message(users=subscription_index.recipients('battery'), text=text, back=True)
+
+
+def due_battery_alerts(alerted: dict) -> dict:
+    """ Метеостанции с низким зарядом батарей, о которых сегодня ещё не уведомляли (см. check_batteries)
+
+    :return:
+        Словарь {id метеостанции: тренд напряжения}
+    """
+    low = {}
+    for station_id, trend in battery.battery_forecast.low().items():
+        if alerted.get(station_id) == datetime.now().date():
+            continue
+        alerted[station_id] = datetime.now().date()
+        low[station_id] = trend
+    return low
+
+
+def battery_alert_text(low: dict, names: dict) -> str or None:
+    """ Уведомление о скором отключении метеостанций
+
+    :param low:
+        Словарь {id метеостанции: тренд напряжения} из due_battery_alerts
+    :param names:
+        Словарь {id метеостанции: название}
+    """
+    msg = ''
+    for station_id, trend in low.items():
+        msg += f'\n\nМетеостанция: {names.get(station_id)}' \
+               f'\nНапряжение батареи: {trend["voltage"]} В ({trend["date"]:%d.%m.%Y})' \
+               f'\n{battery.describe(trend)}'
+    if not msg:
+        return None
+    return '*[Автоматическое уведомление]*:\n' \
+           f'Батареи метеостанций скоро разрядятся (порог отключения {battery.CUTOFF_VOLTAGE} В):' + msg
+
+
 @mult_threading
 def alert_about_cameras() -> None:
     """ Автоматическая проверка статуса видеокамер"""
     while True:
         sleep(1)
-        if time(8, 00) <= datetime.now().time() <= time(17, 00) and (datetime.now().isoweekday() != 6 or
-                                                                     datetime.now().isoweekday() != 7):
+        if is_working_time():
             flag_1, flag_2 = False, False
 
             cameras_1 = db.check_cameras()
@@ -965,24 +1732,32 @@ def alert_about_cameras() -> None:
                 flag_2 = True
 
             if flag_1 and flag_2:
-                for cam in cameras_2:
-                    # @TODO убрать эту проверку, когда камера заработает
-                    if cam[1] == 'ГПА-5 | МТМ | КПП -> ворота':
-                        continue
-                    msg = f'*[Автоматическое уведомление]*:\n' \
-                          f'Нет ответа от камеры {cam[-1]}\n' \
-                          f'*Название камеры*: \n{cam[1]}\n' \
-                          f'IP-адрес: {cam[2]}\n' \
-                          f'\nМестоположение камеры: (см. ниже)'
-                    lat = cam[3]
-                    lon = cam[4]
-
-                    if msg and lat and lon:
-                        send_bot_message(users=settings.ALERTS_CAMERAS, text=msg)
-                        send_bot_location(users=settings.ALERTS_CAMERAS, lon=lon, lat=lat, back=True)
+                for msg, lat, lon in camera_alerts(cameras_2):
+                    send_bot_message(users=subscription_index.recipients('cameras'), text=msg)
+                    send_bot_location(users=subscription_index.recipients('cameras'), lon=lon, lat=lat, back=True)
                 sleep(7200)
 
 
+def camera_alerts(cameras: list) -> list:
+    """ Уведомления о неработающих камерах: список из текста сообщения и координат камеры"""
+    alerts = []
+    for cam in cameras:
+        # @TODO убрать эту проверку, когда камера заработает
+        if cam[1] == 'ГПА-5 | МТМ | КПП -> ворота':
+            continue
+        msg = f'*[Автоматическое уведомление]*:\n' \
+              f'Нет ответа от камеры {cam[-1]}\n' \
+              f'*Название камеры*: \n{cam[1]}\n' \
+              f'IP-адрес: {cam[2]}\n' \
+              f'\nМестоположение камеры: (см. ниже)'
+        lat = cam[3]
+        lon = cam[4]
+
+        if msg and lat and lon:
+            alerts.append((msg, lat, lon))
+    return alerts
+
+
 @mult_threading
 def check_weather_data() -> None:
     """ Автоматическая проверка уведомления о поступлении нулевых данных"""
@@ -1007,25 +1782,110 @@ def check_weather_data() -> None:
                             msg = f'\n\n{weather_line}'
 
                     if msg:
-                        send_bot_message(users=settings.ALERTS_WEATHERSTATIONS, text=header + msg, back=True)
+                        send_bot_message(users=subscription_index.recipients('weather_stations'), text=header + msg,
+                                         back=True)
             sleep(7200)
 
 
+@mult_threading
+def refresh_forecast_index() -> None:
+    """ Перестроение индекса прогноза погоды после ночного обновления ForecastDaily.
+        Раз в 10 минут проверяется версия прогноза, индекс перестраивается только при её изменении
+    """
+    current_version = None
+    while True:
+        current_version = update_forecast_index(current_version)
+        sleep(600)
+
+
+def update_forecast_index(current_version: tuple or None) -> tuple or None:
+    """ Перестраивает индекс прогноза погоды, если версия прогноза в базе изменилась
+    :return:
+        Версия прогноза, по которой построен индекс
+    """
+    version = db.get_forecast_version()
+    if version is not None and version != current_version:
+        if forecast_index.rebuild(agro_list=list(range(1, 7))):
+            render_cache.invalidate('forecast')
+            logger.critical(f'Индекс прогноза погоды обновлён. Версия прогноза: {version}')
+            return version
+    return current_version
+
+
+def start_metrics() -> None:
+    """ Регистрирует показатели состояния бота и запускает локальный HTTP-сервер метрик.
+        Порт задаётся в settings.METRICS_PORT, если он равен None - сервер не запускается
+    """
+    port = getattr(settings, 'METRICS_PORT', 9108)
+    if port is None:
+        return
+    metrics.gauge('bot_active_threads', threading.active_count, 'Количество активных потоков')
+    metrics.gauge('bot_worker_queue_depth', lambda: bot.worker_pool.tasks.qsize() if bot.threaded else 0,
+                  'Количество входящих обновлений, ожидающих обработки')
+    metrics.gauge('bot_render_cache_size', lambda: len(render_cache), 'Количество экранов в кэше')
+    metrics.gauge('bot_db_circuit_state', lambda: (db.circuit.CLOSED, db.circuit.HALF_OPEN,
+                                                   db.circuit.OPEN).index(db.circuit.state),
+                  'Состояние размыкателя запросов к базе данных: 0 - closed, 1 - half-open, 2 - open')
+    metrics.gauge('bot_db_snapshot_age_seconds',
+                  lambda: (datetime.now() - db.snapshot.refreshed_at).total_seconds()
+                  if db.snapshot is not None and db.snapshot.refreshed_at else -1,
+                  'Время с последнего обновления локального снимка базы данных, -1 - снимок не используется')
+    start_metrics_server(port=port)
+
+
 def starts_threads() -> None:
     """ Запускает указанные потоки"""
 
+    # Метрики работы бота
+    start_metrics()
+
+    # Отбрасывание повторных обновлений и двойных нажатий кнопок (dedup.py)
+    bot.intake.append(UpdateDeduplicator(
+        answer=lambda query: bot.answer_callback_query(callback_query_id=query.id)).filter_updates)
+
+    # Запись входящих обновлений для последующего воспроизведения (recorder.py)
+    start_recorder(bot)
+
+    # Применённые миграции базы данных (migrations.py)
+    check_migrations()
+
+    # Локальный снимок таблиц для работы при недоступной базе данных (snapshot.py)
+    start_snapshot()
+
+    # Сводные таблицы показаний метеостанций для архива погоды и суммы осадков (rollup.py)
+    start_rollups()
+
+    # Версия данных о погоде для кэша экранов: готовый экран отдаётся без запроса к базе данных
+    start_weather_version()
+
+    # Подписки пользователей на уведомления (subscriptions.py)
+    subscription_index.load()
+
+    # Индекс координат метеостанций и камер для поиска ближайших (geo.py)
+    geo.location_index.load()
+
+    # Индекс названий для встроенного режима (search.py)
+    search_index.load()
+
     # Основные функции бота
     main()
 
-    # Список агро
-    agro_ = [1, 3, 4, 5, 6]
+    # Индекс прогноза погоды по микрозонам
+    refresh_forecast_index()
+
     # Уведомления о спутниковых снимках, каждый поток для своего Агро
-    for agro in agro_:
+    for agro in AGRO_LIST:
         alert_messages_about_sentinel(agro)
 
     # Уведомления о нерабочих метеостанциях
     alert_about_weather_stations()
 
+    # Уведомления о погоде по правилам (alerts.py)
+    alert_about_weather()
+
+    # Прогноз разряда батарей метеостанций и уведомления о скором отключении
+    alert_about_batteries()
+
     # Уведомления о нерабочих камерах видеонаблюдения
     alert_about_cameras()
 
@@ -1038,8 +1898,16 @@ def starts_threads() -> None:
 
 
 if __name__ == '__main__':
-    # Запускаем все потоки
-    starts_threads()
-    # Включаем бота в режим бесконечной работы с перехватом ошибок и вылетов
-    logging.critical(f'Количество потоков, работающие в данный момент: {threading.active_count()}')
-    bot.infinity_polling()
+    # По сигналу SIGUSR1 в лог выводится статистика запросов к базе данных
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: logger.critical(db.db_stats.dump()))
+    if config('RUNTIME', default='threads') == 'asyncio':
+        # Асинхронный режим: обработчики, уведомления и расписания работают в одном цикле событий
+        from async_runtime import run
+        run(sys.modules[__name__])
+    else:
+        # Запускаем все потоки
+        starts_threads()
+        # Включаем бота в режим бесконечной работы с перехватом ошибок и вылетов
+        logging.critical(f'Количество потоков, работающие в данный момент: {threading.active_count()}')
+        bot.infinity_polling()
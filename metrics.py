@@ -0,0 +1,218 @@
+""" Метрики работы бота в формате Prometheus"""
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable
+
+import dboperator as db
+
+logger = logging.getLogger('__name__')
+
+
+class Metrics:
+    """ Реестр метрик: счётчики, гистограммы и показатели, которые вычисляются в момент запроса.
+        Запись метрики - это одна блокировка и несколько сложений, поэтому метрики можно не отключать
+    """
+
+    # Верхние границы корзин гистограмм в секундах
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, help_text: str = '', **labels) -> None:
+        """ Увеличивает счётчик"""
+        key = self._labels(labels)
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, help_text: str = '', **labels) -> None:
+        """ Добавляет значение в гистограмму"""
+        key = self._labels(labels)
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def total(self, name: str, **labels) -> float:
+        """ Суммарное время по гистограмме для всех наборов меток, содержащих указанные метки"""
+        wanted = set(self._labels(labels))
+        with self._lock:
+            return sum(histogram['sum'] for key, histogram in self._histograms.get(name, {}).items()
+                       if wanted <= set(key))
+
+    def gauge(self, name: str, func: Callable, help_text: str = '') -> None:
+        """ Регистрирует показатель, значение которого вычисляется функцией при каждом запросе метрик"""
+        with self._lock:
+            self._help[name] = help_text
+            self._gauges[name] = func
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def _render_histogram(self, lines: list, name: str, labels: tuple, bucket_counts: list,
+                          total: float, count: int) -> None:
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else str(bound)
+            lines.append(f'{name}_bucket{self._format_labels(labels, (("le", le),))} {cumulative}')
+        lines.append(f'{name}_sum{self._format_labels(labels)} {total}')
+        lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+
+    def render(self) -> str:
+        """ Текст метрик в формате Prometheus"""
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: dict(value, buckets=list(value['buckets'])) for key, value in series.items()}
+                          for name, series in self._histograms.items()}
+            gauges = dict(self._gauges)
+            help_texts = dict(self._help)
+
+        for name, series in counters.items():
+            lines.append(f'# HELP {name} {help_texts.get(name, "")}')
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in series.items():
+                lines.append(f'{name}{self._format_labels(labels)} {value}')
+
+        for name, series in histograms.items():
+            lines.append(f'# HELP {name} {help_texts.get(name, "")}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in series.items():
+                self._render_histogram(lines, name, labels, histogram['buckets'], histogram['sum'],
+                                       histogram['count'])
+
+        for name, func in gauges.items():
+            try:
+                value = func()
+            except Exception as e:
+                logger.critical(f'Невозможно получить значение метрики {name}. Ошибка: {e}')
+                continue
+            lines.append(f'# HELP {name} {help_texts.get(name, "")}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+
+        self._render_db_stats(lines)
+        return '\n'.join(lines) + '\n'
+
+    def _render_db_stats(self, lines: list) -> None:
+        """ Добавляет статистику запросов к базе данных из dboperator"""
+        db_functions = db.db_stats.snapshot()
+        if not db_functions:
+            return
+        counters = (('bot_db_calls_total', 'calls', 'Подключения к базе данных'),
+                    ('bot_db_errors_total', 'errors', 'Ошибки подключения и запросов'),
+                    ('bot_db_connect_seconds_total', 'connect_seconds', 'Время получения соединения'),
+                    ('bot_db_rows_total', 'rows', 'Полученные строки'))
+        for name, field, help_text in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for function, stats in db_functions.items():
+                lines.append(f'{name}{{function="{function}"}} {stats[field]}')
+
+        # Корзины DBStats совпадают с корзинами метрик только частично, поэтому границы выводятся свои
+        name = 'bot_db_execute_seconds'
+        lines.append(f'# HELP {name} Время выполнения запросов')
+        lines.append(f'# TYPE {name} histogram')
+        for function, stats in db_functions.items():
+            cumulative = 0
+            for bound, bucket_count in zip(db.DBStats.buckets, stats['histogram']):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else str(bound)
+                lines.append(f'{name}_bucket{{function="{function}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{function="{function}"}} {stats["execute_seconds"]}')
+            lines.append(f'{name}_count{{function="{function}"}} {stats["queries"]}')
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def measure(name: str, help_text: str = '', **labels):
+    """ Замеряет время выполнения блока кода и записывает его в гистограмму.
+        Если в блоке произошло исключение, дополнительно увеличивается счётчик ошибок (имя без суффикса _seconds)
+    """
+    start = perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc(f'{name.replace("_seconds", "")}_errors_total', help_text=help_text, **labels)
+        raise
+    finally:
+        metrics.observe(name, perf_counter() - start, help_text=help_text, **labels)
+
+
+def timed(name: str, help_text: str = '', **labels):
+    """ Декоратор замера времени выполнения функции (см. measure)"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """ Выполняет функцию с замером времени"""
+            with measure(name, help_text=help_text, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Обработчик HTTP-запросов к метрикам"""
+
+    def do_GET(self) -> None:
+        """ Отдаёт метрики по адресу /metrics"""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        """ Запросы к метрикам не пишутся в лог"""
+        pass
+
+
+def start_metrics_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """ Запускает HTTP-сервер метрик в отдельном потоке
+
+    :param port:
+        Порт сервера
+    :param host:
+        Адрес сервера. По умолчанию метрики доступны только локально
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+    logger.critical(f'Метрики доступны по адресу http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,428 @@
+""" Миграции базы данных под запросы бота: индексы, таблица связи микрозон прогноза с Агро и, по желанию,
+    разбиение WeatherData на помесячные секции.
+    Применённые миграции записываются в таблицу BotMigrations, повторный запуск ничего не меняет.
+
+    Применение (индексы строятся CONCURRENTLY, без блокировки записи показаний):
+        python migrations.py apply
+    Разбиение WeatherData по месяцам (таблица блокируется на время переноса данных, нужен перерыв в работе):
+        python migrations.py apply --partition
+    Проверка по EXPLAIN, что запросы dboperator используют индексы:
+        python migrations.py verify
+    Замер запросов до и после миграций на синтетических данных (тестовая база пересоздаётся):
+        python migrations.py report --dsn "dbname=bench user=postgres" --days 730 --stations-per-agro 20
+"""
+import argparse
+import logging
+import statistics
+from datetime import date, datetime, timedelta
+from time import perf_counter, sleep
+
+import psycopg2
+
+import dboperator as db
+from utils import mult_threading
+
+logger = logging.getLogger('__name__')
+
+# Индексы под запросы dboperator: (название, таблица, определение)
+INDEXES = (
+    # Последние показания метеостанции: ORDER BY id DESC LIMIT 1, водяные знаки снимка и сводных таблиц
+    ('WeatherData_station_id_idx', 'WeatherData', '(weatherstationid, id DESC)'),
+    # Архив погоды и сумма осадков по метеостанции за период
+    ('WeatherData_station_datetime_idx', 'WeatherData', '(weatherstationid, datetime)'),
+    # Выборки по времени без метеостанции. Показания поступают по времени, поэтому BRIN занимает мегабайты
+    ('WeatherData_datetime_brin', 'WeatherData', 'USING brin (datetime)'),
+    ('ForecastDaily_zone_time_idx', 'ForecastDaily', '(forecastzoneid, "time")'),
+    ('WeatherGroupAgro_agro_idx', 'WeatherGroupAgro', '(agroid, weathergroupid)'),
+    ('Layer_agro_set_id_idx', 'Layer', '(agroid, "set", id)'),
+)
+
+SQL_CREATE_MIGRATIONS = 'CREATE TABLE IF NOT EXISTS public."BotMigrations" ' \
+    '(name text PRIMARY KEY, applied timestamp NOT NULL DEFAULT now())'
+SQL_APPLIED = 'SELECT name FROM public."BotMigrations"'
+SQL_MARK_APPLIED = 'INSERT INTO public."BotMigrations" (name) VALUES (%s) ON CONFLICT DO NOTHING'
+
+# Связь микрозон прогноза с Агро. ForecastZoneArea.agroid хранит номера Агро текстом ("1", "1, 3"),
+# по которому LIKE '%1%' находит и Агро 11 и не может использовать индекс. Таблица связи заполняется
+# по существующим записям и поддерживается триггером, поэтому загрузка прогноза не меняется
+SQL_FORECAST_ZONE_AGRO = r'''
+CREATE TABLE IF NOT EXISTS public."ForecastZoneAgro" (
+    forecastzoneid integer NOT NULL REFERENCES public."ForecastZoneArea" (id) ON DELETE CASCADE ON UPDATE CASCADE,
+    agroid integer NOT NULL,
+    PRIMARY KEY (agroid, forecastzoneid)
+);
+CREATE OR REPLACE FUNCTION public.forecast_zone_agro_sync() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM public."ForecastZoneAgro" WHERE forecastzoneid = NEW.id;
+    INSERT INTO public."ForecastZoneAgro" (forecastzoneid, agroid)
+    SELECT DISTINCT NEW.id, token::integer FROM regexp_split_to_table(NEW.agroid::text, '\D+') token
+    WHERE token <> '';
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS forecast_zone_agro_sync ON public."ForecastZoneArea";
+CREATE TRIGGER forecast_zone_agro_sync AFTER INSERT OR UPDATE OF agroid ON public."ForecastZoneArea"
+    FOR EACH ROW EXECUTE FUNCTION public.forecast_zone_agro_sync();
+INSERT INTO public."ForecastZoneAgro" (forecastzoneid, agroid)
+SELECT DISTINCT fza.id, token::integer
+FROM public."ForecastZoneArea" fza, regexp_split_to_table(fza.agroid::text, '\D+') token
+WHERE token <> ''
+ON CONFLICT DO NOTHING;
+'''
+
+# Уникальный индекс по telegram_id: регистрация выполняется с ON CONFLICT DO NOTHING, поэтому одновременные заявки
+# одного пользователя не создают повторных строк. Заменяет прежний неуникальный индекс TelegramBot_telegram_id_idx
+UNIQUE_TELEGRAM_ID = 'TelegramBot_telegram_id_key'
+# Перед построением индекса удаляются повторные строки пользователя: остаётся подтверждённая, а из равных - первая
+SQL_DELETE_DUPLICATE_USERS = '''
+DELETE FROM public."TelegramBot" a USING public."TelegramBot" b
+WHERE a.telegram_id = b.telegram_id AND a.ctid <> b.ctid
+    AND ((b.regcheck IS TRUE) > (a.regcheck IS TRUE)
+         OR ((b.regcheck IS TRUE) = (a.regcheck IS TRUE) AND b.ctid < a.ctid))
+'''
+
+SQL_ROLLUPS_EXIST = 'SELECT to_regclass(\'public."WeatherDataRollupState"\') IS NOT NULL'
+SQL_IS_PARTITIONED = 'SELECT relkind = \'p\' FROM pg_class WHERE oid = \'public."WeatherData"\'::regclass'
+
+
+def connect(dsn: str = None):
+    """ Подключение к базе из settings.DB_CONFIG или по строке подключения. Каждый запрос - отдельная транзакция.
+        Время ожидания подключения то же, что и у запросов бота (DB_CONNECT_TIMEOUT), поэтому при запуске бота
+        недоступная база не задерживает check_migrations
+    """
+    if dsn:
+        conn = psycopg2.connect(dsn, connect_timeout=db.connect_timeout)
+    else:
+        conn = psycopg2.connect(**{'connect_timeout': db.connect_timeout, **db.db_config})
+    conn.autocommit = True
+    return conn
+
+
+def applied_migrations(cur) -> set:
+    """ Названия применённых миграций"""
+    cur.execute(SQL_CREATE_MIGRATIONS)
+    cur.execute(SQL_APPLIED)
+    return {row[0] for row in cur.fetchall()}
+
+
+def create_index(cur, name: str, table: str, definition: str, unique: bool = False) -> None:
+    """ Строит индекс без блокировки записи в таблицу. Недостроенный индекс от прерванной попытки удаляется"""
+    cur.execute('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)', (f'public."{name}"',))
+    row = cur.fetchone()
+    if row is not None and not row[0]:
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS public."{name}"')
+    cur.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY IF NOT EXISTS "{name}" '
+                f'ON public."{table}" {definition}')
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(day: date) -> date:
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def ensure_partitions(cur, months_ahead: int = 3) -> None:
+    """ Создаёт секции WeatherData на текущий и следующие months_ahead месяцев"""
+    month = month_start(date.today())
+    for _ in range(months_ahead + 1):
+        cur.execute(f'CREATE TABLE IF NOT EXISTS public."WeatherData_{month:%Y_%m}" PARTITION OF public."WeatherData" '
+                    f'FOR VALUES FROM (\'{month}\') TO (\'{next_month(month)}\')')
+        month = next_month(month)
+
+
+def partition_weather_data(cur, months_ahead: int = 3) -> None:
+    """ Переносит WeatherData в таблицу, разбитую на помесячные секции по datetime.
+        Строки без даты попадают в секцию по умолчанию. Старая таблица остаётся под именем WeatherData_legacy
+        и удаляется вручную после проверки
+    """
+    cur.execute(SQL_IS_PARTITIONED)
+    if cur.fetchone()[0]:
+        ensure_partitions(cur, months_ahead)
+        return
+
+    cur.execute('BEGIN')
+    try:
+        cur.execute('LOCK TABLE public."WeatherData" IN ACCESS EXCLUSIVE MODE')
+        cur.execute('SELECT pg_get_serial_sequence(\'public."WeatherData"\', \'id\'), '
+                    'MIN(datetime)::date FROM public."WeatherData"')
+        sequence, first_day = cur.fetchone()
+        cur.execute('ALTER TABLE public."WeatherData" RENAME TO "WeatherData_legacy"')
+        # Названия индексов уникальны в схеме, поэтому индексы старой таблицы переименовываются
+        for name, table, _ in INDEXES:
+            if table == 'WeatherData':
+                cur.execute(f'ALTER INDEX IF EXISTS public."{name}" RENAME TO "{name}_legacy"')
+        cur.execute('CREATE TABLE public."WeatherData" (LIKE public."WeatherData_legacy" INCLUDING DEFAULTS) '
+                    'PARTITION BY RANGE (datetime)')
+        if sequence:
+            cur.execute(f'ALTER SEQUENCE {sequence} OWNED BY public."WeatherData".id')
+        cur.execute('CREATE TABLE public."WeatherData_default" PARTITION OF public."WeatherData" DEFAULT')
+
+        month = month_start(first_day or date.today())
+        while month < month_start(date.today()):
+            cur.execute(f'CREATE TABLE public."WeatherData_{month:%Y_%m}" PARTITION OF public."WeatherData" '
+                        f'FOR VALUES FROM (\'{month}\') TO (\'{next_month(month)}\')')
+            month = next_month(month)
+        ensure_partitions(cur, months_ahead)
+
+        cur.execute('INSERT INTO public."WeatherData" SELECT * FROM public."WeatherData_legacy"')
+        # Уникальность id обеспечивает последовательность, уникальный индекс по секциям требовал бы datetime в ключе
+        cur.execute('CREATE INDEX "WeatherData_id_idx" ON public."WeatherData" (id)')
+        cur.execute('COMMIT')
+    except psycopg2.Error:
+        cur.execute('ROLLBACK')
+        raise
+    # Индексы по секциям строятся заново, так как CONCURRENTLY недоступен для разбитой таблицы
+    for name, table, definition in INDEXES:
+        if table == 'WeatherData':
+            cur.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON public."WeatherData" {definition}')
+    cur.execute('ANALYZE public."WeatherData"')
+
+
+def apply(cur, partition: bool = False) -> list:
+    """ Применяет миграции, которые ещё не применены
+
+    :param partition:
+        Разбить WeatherData на помесячные секции
+    :return:
+        Названия применённых за этот вызов миграций
+    """
+    done = applied_migrations(cur)
+    applied = []
+    for name, table, definition in INDEXES:
+        if name not in done:
+            started = perf_counter()
+            create_index(cur, name, table, definition)
+            cur.execute(SQL_MARK_APPLIED, (name,))
+            applied.append(name)
+            logger.critical(f'Миграция {name} применена за {perf_counter() - started:.1f} с')
+    if UNIQUE_TELEGRAM_ID not in done:
+        cur.execute(SQL_DELETE_DUPLICATE_USERS)
+        if cur.rowcount:
+            logger.critical(f'Удалено повторных заявок пользователей: {cur.rowcount}')
+        create_index(cur, UNIQUE_TELEGRAM_ID, 'TelegramBot', '(telegram_id)', unique=True)
+        cur.execute('DROP INDEX CONCURRENTLY IF EXISTS public."TelegramBot_telegram_id_idx"')
+        cur.execute(SQL_MARK_APPLIED, (UNIQUE_TELEGRAM_ID,))
+        applied.append(UNIQUE_TELEGRAM_ID)
+    if 'forecast_zone_agro' not in done:
+        cur.execute('BEGIN')
+        try:
+            cur.execute(SQL_FORECAST_ZONE_AGRO)
+            cur.execute(SQL_MARK_APPLIED, ('forecast_zone_agro',))
+            cur.execute('COMMIT')
+        except psycopg2.Error:
+            cur.execute('ROLLBACK')
+            raise
+        applied.append('forecast_zone_agro')
+    if partition and 'weather_data_partitioned' not in done:
+        partition_weather_data(cur)
+        cur.execute(SQL_MARK_APPLIED, ('weather_data_partitioned',))
+        applied.append('weather_data_partitioned')
+    return applied
+
+
+def sample_params(cur) -> dict:
+    """ Значения параметров запросов из данных базы: последняя метеостанция, её Агро, микрозона и пользователь"""
+    cur.execute('SELECT weatherstationid, datetime::date FROM public."WeatherData" ORDER BY id DESC LIMIT 1')
+    station, day = cur.fetchone() or (1, date.today())
+    cur.execute('SELECT agroid FROM public."WeatherGroupAgro" WHERE weathergroupid = %s LIMIT 1', (station,))
+    agro = (cur.fetchone() or (1,))[0]
+    cur.execute('SELECT forecastzoneid, "time"::date FROM public."ForecastDaily" ORDER BY "time" DESC LIMIT 1')
+    zone, forecast_day = cur.fetchone() or (1, date.today())
+    cur.execute('SELECT telegram_id FROM public."TelegramBot" LIMIT 1')
+    telegram_id = (cur.fetchone() or (1,))[0]
+    return {'station': station, 'day': day - timedelta(days=1), 'agro': agro, 'zone': zone,
+            'forecast_day': forecast_day, 'telegram_id': telegram_id}
+
+
+def checked_queries(params: dict, migrations: set, rollups: bool = False) -> list:
+    """ Запросы dboperator с фильтром, которым нужен индекс: (функция, запрос, параметры, таблица)
+
+    :param rollups:
+        Созданы сводные таблицы (rollup.py): проверяются и варианты запросов по ним, которые бот выполняет
+        вместо запросов к WeatherData
+    """
+    station, day, agro, zone = params['station'], params['day'], params['agro'], params['zone']
+    day_start, day_end = datetime.combine(day, datetime.min.time()), datetime.combine(day, datetime.max.time())
+    forecast_day = datetime.combine(params['forecast_day'], datetime.min.time())
+    if 'forecast_zone_agro' in migrations:
+        zones = ('get_zone_id_from_agro', db.SQL_ZONE_ID_FROM_AGRO, (agro,), 'ForecastZoneAgro')
+    else:
+        zones = ('get_zone_id_from_agro', db.SQL_ZONE_ID_FROM_AGRO_TEXT, (str(agro),), 'ForecastZoneArea')
+    queries = [
+        ('check_user', db.SQL_CHECK_USER, (params['telegram_id'],), 'TelegramBot'),
+        ('get_role', db.SQL_ROLE, (params['telegram_id'],), 'TelegramBot'),
+        ('get_weather_station_id_from_agro', db.SQL_WEATHER_STATION_ID_FROM_AGRO, (agro,), 'WeatherGroupAgro'),
+        ('get_last_weather_data_id', db.SQL_LAST_WEATHER_DATA_ID, None, 'WeatherData'),
+        ('get_weather_data_from_agro', db.SQL_WEATHER_DATA_FROM_AGRO, (agro,), 'WeatherData'),
+        ('get_max_id_from_layer', db.SQL_MAX_ID_FROM_LAYER, (agro, 'visual'), 'Layer'),
+        ('get_amount_of_precipitation_for_the_last_day', db.SQL_PRECIPITATION_SUM,
+         (day_start, day_end, station), 'WeatherData'),
+        ('get_weather_archive_period', db.SQL_WEATHER_ARCHIVE_PERIOD, ('hour', station, day_start, day_end),
+         'WeatherData'),
+        zones,
+        ('get_forecast_data', db.SQL_FORECAST_DATA, (zone,), 'ForecastDaily'),
+        ('get_forecast_dates', db.SQL_FORECAST_DATES, (zone,), 'ForecastDaily'),
+        ('get_forecast_data_with_date', db.SQL_FORECAST_DATA_WITH_DATE,
+         (zone, forecast_day, forecast_day + timedelta(days=1)), 'ForecastDaily'),
+    ]
+    if rollups:
+        queries += [
+            ('get_amount_of_precipitation_for_the_last_day (сводная)', db.SQL_PRECIPITATION_SUM_ROLLUP,
+             (station, day_start, day_end, station, day_start, day_end), 'WeatherDataHourly'),
+            # Показания после водяного знака сводных таблиц досчитываются по WeatherData (SQL_ROLLUP_TAIL)
+            ('get_amount_of_precipitation_for_the_last_day (сводная, новые показания)', db.SQL_PRECIPITATION_SUM_ROLLUP,
+             (station, day_start, day_end, station, day_start, day_end), 'WeatherData'),
+            ('get_weather_archive_period (по часам, сводная)', db.SQL_WEATHER_ARCHIVE_PERIOD_HOURLY,
+             ('hour', station, day_start, day_end, station, day_start, day_end), 'WeatherDataHourly'),
+            ('get_weather_archive_period (по дням, сводная)', db.SQL_WEATHER_ARCHIVE_PERIOD_DAILY,
+             ('day', station, day, day + timedelta(days=1), station, day_start, day_end), 'WeatherDataDaily'),
+            ('get_battery_voltage_period (сводная)', db.SQL_BATTERY_VOLTAGE_PERIOD_ROLLUP,
+             (station, day_start, day_end, station, day_start, day_end), 'WeatherDataHourly'),
+        ]
+    return queries
+
+
+def plan_nodes(plan: dict):
+    """ Все узлы плана запроса"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def uses_index(cur, sql: str, params, table: str) -> tuple:
+    """ Проверяет по EXPLAIN, что запрос читает таблицу (или её секции) по индексу.
+        Последовательное чтение запрещается, чтобы маленькие таблицы проверялись так же, как большие
+
+    :return:
+        (индекс используется, способы чтения таблицы)
+    """
+    cur.execute('BEGIN')
+    try:
+        cur.execute('SET LOCAL enable_seqscan = off')
+        cur.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cur.fetchone()[0][0]['Plan']
+    finally:
+        cur.execute('ROLLBACK')
+    scans = [node['Node Type'] for node in plan_nodes(plan)
+             if node.get('Relation Name', '') == table or node.get('Relation Name', '').startswith(f'{table}_')]
+    return bool(scans) and 'Seq Scan' not in scans, scans
+
+
+def verify(cur) -> list:
+    """ Проверяет все запросы из checked_queries
+
+    :return:
+        Список (функция, индекс используется, способы чтения таблицы)
+    """
+    cur.execute(SQL_ROLLUPS_EXIST)
+    queries = checked_queries(sample_params(cur), applied_migrations(cur), rollups=cur.fetchone()[0])
+    return [(name, *uses_index(cur, sql, params, table)) for name, sql, params, table in queries]
+
+
+def time_queries(cur, params: dict, migrations: set, repeat: int = 5) -> dict:
+    """ Медианное время выполнения каждого запроса в миллисекундах"""
+    timings = {}
+    for name, sql, query_params, _ in checked_queries(params, migrations):
+        durations = []
+        for _ in range(repeat):
+            started = perf_counter()
+            cur.execute(sql, query_params)
+            cur.fetchall()
+            durations.append((perf_counter() - started) * 1000)
+        timings[name] = statistics.median(durations)
+    return timings
+
+
+def report(dsn: str, days: int, stations_per_agro: int, interval: int, repeat: int, partition: bool) -> str:
+    """ Заполняет тестовую базу синтетическими данными и замеряет запросы до и после миграций"""
+    from bench.seed import seed
+
+    started = perf_counter()
+    seed(dsn, stations_per_agro=stations_per_agro, days=days, interval=interval)
+    conn = connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM public."WeatherData"')
+        lines = [f'Показаний метеостанций: {cur.fetchone()[0]}, заполнение базы: {perf_counter() - started:.0f} с']
+        params = sample_params(cur)
+        before = time_queries(cur, params, set(), repeat)
+
+        started = perf_counter()
+        migrations = set(apply(cur, partition=partition))
+        cur.execute('ANALYZE')
+        lines.append(f'Миграции: {", ".join(sorted(migrations))} - {perf_counter() - started:.0f} с\n')
+        after = time_queries(cur, params, migrations, repeat)
+
+        lines.append(f'{"Функция":<46}{"до, мс":>12}{"после, мс":>12}{"ускорение":>11}')
+        for name in before:
+            lines.append(f'{name:<46}{before[name]:>12.2f}{after[name]:>12.2f}'
+                         f'{before[name] / max(after[name], 0.001):>10.0f}x')
+        lines.append('\nПроверка EXPLAIN:')
+        lines.extend(f'{"OK " if ok else "НЕТ"} {name}: {", ".join(scans)}' for name, ok, scans in verify(cur))
+    finally:
+        conn.close()
+    return '\n'.join(lines)
+
+
+@mult_threading
+def keep_partitions(months_ahead: int = 3) -> None:
+    """ Раз в сутки создаёт секции WeatherData на следующие месяцы"""
+    while True:
+        try:
+            conn = connect()
+            try:
+                ensure_partitions(conn.cursor(), months_ahead)
+            finally:
+                conn.close()
+        except psycopg2.Error as e:
+            logger.critical(f'Невозможно создать секции WeatherData. Ошибка: {e}')
+        sleep(86400)
+
+
+def check_migrations() -> set:
+    """ Передаёт в dboperator список применённых миграций. Если WeatherData разбита на секции,
+        запускает создание секций на следующие месяцы
+    """
+    try:
+        conn = connect()
+        try:
+            db.migrations = applied_migrations(conn.cursor())
+        finally:
+            conn.close()
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно получить список миграций базы данных. Ошибка: {e}')
+    if 'weather_data_partitioned' in db.migrations:
+        keep_partitions()
+    return db.migrations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Миграции базы данных бота')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    apply_parser = subparsers.add_parser('apply', help='Применить миграции')
+    apply_parser.add_argument('--partition', action='store_true', help='Разбить WeatherData на секции по месяцам')
+    subparsers.add_parser('verify', help='Проверить по EXPLAIN использование индексов')
+    report_parser = subparsers.add_parser('report', help='Замер до и после миграций на синтетических данных')
+    report_parser.add_argument('--dsn', required=True, help='Строка подключения к тестовой базе PostgreSQL')
+    report_parser.add_argument('--days', type=int, default=730)
+    report_parser.add_argument('--stations-per-agro', type=int, default=20)
+    report_parser.add_argument('--interval', type=int, default=5, help='Интервал показаний в минутах')
+    report_parser.add_argument('--repeat', type=int, default=5)
+    report_parser.add_argument('--partition', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        print(report(args.dsn, days=args.days, stations_per_agro=args.stations_per_agro, interval=args.interval,
+                     repeat=args.repeat, partition=args.partition))
+    else:
+        connection = connect()
+        try:
+            if args.command == 'apply':
+                print('Применены миграции:', ', '.join(apply(connection.cursor(), partition=args.partition)) or 'нет')
+            else:
+                for function, ok, node_types in verify(connection.cursor()):
+                    print(f'{"OK " if ok else "НЕТ"} {function}: {", ".join(node_types)}')
+        finally:
+            connection.close()
@@ -0,0 +1,130 @@
+""" Профилирование работающего бота без перезапуска: выборочный профилировщик по всем потокам,
+    процессорное время потоков и текущие стеки вызовов. Управляется из меню администратора
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from time import perf_counter
+
+logger = logging.getLogger('__name__')
+
+
+def thread_cpu_time(ident: int) -> float or None:
+    """ Процессорное время потока в секундах. None, если платформа не позволяет его получить"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+def frame_key(frame) -> str:
+    """ Название функции кадра стека для отчёта"""
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def thread_cpu_times() -> dict:
+    """ Процессорное время всех живых потоков: {название потока: секунды}"""
+    return {thread.name: thread_cpu_time(thread.ident) for thread in threading.enumerate()}
+
+
+def thread_stacks(limit: int = 8) -> str:
+    """ Список живых потоков с процессорным временем и последними limit кадрами стека"""
+    frames = sys._current_frames()
+    lines = [f'Живых потоков: {threading.active_count()}']
+    for thread in sorted(threading.enumerate(), key=lambda item: item.name):
+        cpu = thread_cpu_time(thread.ident)
+        cpu_text = f'{cpu:.2f} с CPU' if cpu is not None else 'CPU н/д'
+        lines.append(f'\n{thread.name} ({"daemon, " if thread.daemon else ""}{cpu_text})')
+        frame = frames.get(thread.ident)
+        if frame is not None:
+            lines.extend(line.rstrip() for line in traceback.format_stack(frame, limit=limit))
+    return '\n'.join(lines)
+
+
+class SamplingProfiler:
+    """ Выборочный профилировщик: через равные промежутки снимает стеки всех потоков.
+        Учитываются только потоки, которые с прошлого снимка расходовали процессорное время, поэтому потоки,
+        ожидающие в sleep() или на сетевом запросе, не попадают в список горячих функций
+
+    :param interval:
+        Интервал между снимками стеков в секундах
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.running = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self) -> bool:
+        """ Досрочно завершает сеанс профилирования. Возвращает False, если сеанс не запущен"""
+        if not self.running:
+            return False
+        self._stop.set()
+        return True
+
+    def run(self, seconds: float, top: int = 15) -> str or None:
+        """ Профилирует все потоки в течение seconds секунд (или до вызова stop)
+
+        :return:
+            Отчёт с горячими функциями и процессорным временем потоков. None, если сеанс уже запущен
+        """
+        with self._lock:
+            if self.running:
+                return None
+            self.running = True
+            self._stop.clear()
+
+        own_ident = threading.get_ident()
+        self_samples = Counter()
+        total_samples = Counter()
+        samples = 0
+        last_cpu = {}
+        cpu_before = thread_cpu_times()
+        started = perf_counter()
+        logger.critical(f'Запущено профилирование на {seconds} с')
+        try:
+            while not self._stop.wait(self.interval) and perf_counter() - started < seconds:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    cpu = thread_cpu_time(ident)
+                    busy = cpu is None or ident not in last_cpu or cpu > last_cpu[ident]
+                    last_cpu[ident] = cpu
+                    if not busy:
+                        continue
+                    samples += 1
+                    self_samples[frame_key(frame)] += 1
+                    seen = set()
+                    while frame is not None:
+                        key = frame_key(frame)
+                        if key not in seen:
+                            total_samples[key] += 1
+                            seen.add(key)
+                        frame = frame.f_back
+        finally:
+            self.running = False
+        elapsed = perf_counter() - started
+        cpu_after = thread_cpu_times()
+
+        lines = [f'Профилирование: {elapsed:.1f} с, снимков потоков на CPU: {samples}',
+                 '', f'Собственное время (топ {top}):']
+        lines.extend(f'{count / samples:>7.1%}  {key}' for key, count in self_samples.most_common(top)
+                     if samples)
+        lines.extend(['', f'Включая вызванные функции (топ {top}):'])
+        lines.extend(f'{count / samples:>7.1%}  {key}' for key, count in total_samples.most_common(top)
+                     if samples)
+        lines.extend(['', 'Процессорное время потоков за сеанс:'])
+        used = {name: cpu_after[name] - (cpu_before.get(name) or 0)
+                for name in cpu_after if cpu_after[name] is not None}
+        lines.extend(f'{seconds_:>8.3f} с  {name}'
+                     for name, seconds_ in sorted(used.items(), key=lambda item: item[1], reverse=True))
+        return '\n'.join(lines)
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,266 @@
+""" Запись входящих обновлений и результатов запросов к базе данных с последующим воспроизведением.
+    Запись включается константой RECORD_UPDATES_PATH в settings.py. Файл пополняется строками JSON:
+        {"t": 12.5, "k": "c", "u": 93816342, "d": "button:weather,agro:1"}  - нажатие кнопки
+        {"t": 12.6, "k": "m", "u": 93816342, "d": "/menu"}                  - сообщение
+        {"t": 12.7, "k": "db", "f": "get_role", "a": [93816342], "r": 2}    - результат запроса к базе
+    Идентификаторы пользователей (в том числе в данных кнопок, например user:<id> в кнопках подтверждения
+    регистрации) заменяются обезличенными, координаты местоположения округляются до RECORD_LOCATION_DIGITS
+    знаков (по умолчанию 1 - около 10 км).
+
+    Воспроизведение с поддельным Telegram API и подменёнными запросами к базе (ускорение в 10 раз):
+        python recorder.py replay updates.jsonl --speed 10
+"""
+import argparse
+import gzip
+import hashlib
+import inspect
+import json
+import logging
+import re
+import threading
+from collections import deque
+from datetime import date, datetime
+from decimal import Decimal
+from functools import wraps
+from time import perf_counter, sleep, time
+
+import dboperator as db
+import settings
+
+logger = logging.getLogger('__name__')
+
+# Параметры функций dboperator, содержащие идентификатор пользователя telegram
+USER_ID_PARAMS = ('telegram_id', 'users')
+# Идентификатор пользователя в данных кнопки
+USER_ID_DATA = re.compile(r'(?<=user:)\d+')
+# Количество знаков после запятой в записанных координатах
+LOCATION_DIGITS = getattr(settings, 'RECORD_LOCATION_DIGITS', 1)
+
+# Функции, результаты которых не записываются, так как содержат персональные данные
+SKIP_FUNCTIONS = ('get_list_users', 'registration_users')
+
+
+def encode_value(value):
+    """ Преобразует значения из базы данных в формат JSON"""
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'$d': value.isoformat()}
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'Невозможно записать значение типа {type(value).__name__}')
+
+
+def decode_value(obj: dict):
+    """ Восстанавливает даты, записанные encode_value"""
+    if '$dt' in obj:
+        return datetime.fromisoformat(obj['$dt'])
+    if '$d' in obj:
+        return date.fromisoformat(obj['$d'])
+    return obj
+
+
+def db_functions() -> dict:
+    """ Публичные функции доступа к данным из dboperator"""
+    return {name: func for name, func in vars(db).items()
+            if inspect.isfunction(func) and not name.startswith('_') and func.__module__ == db.__name__
+            and not inspect.isgeneratorfunction(func) and name not in ('single_flight', 'redact_params')
+            and not name.endswith('_query')}
+
+
+class UpdateRecorder:
+    """ Запись входящих обновлений и результатов запросов к базе данных в файл
+
+    :param path:
+        Путь к файлу записи. Если путь оканчивается на .gz - файл сжимается
+    :param salt:
+        Соль для обезличивания идентификаторов пользователей
+    """
+
+    def __init__(self, path: str, salt: str = '') -> None:
+        self.path = path
+        self.salt = salt
+        self.started = time()
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'at', encoding='utf-8') if path.endswith('.gz') \
+            else open(path, 'a', encoding='utf-8')
+
+    def anonymize(self, user_id) -> int:
+        """ Постоянный обезличенный идентификатор пользователя"""
+        digest = hashlib.sha256(f'{self.salt}:{user_id}'.encode('utf-8')).hexdigest()
+        return int(digest[:12], 16)
+
+    def anonymize_data(self, data: str or None) -> str or None:
+        """ Данные кнопки с обезличенными идентификаторами пользователей"""
+        if not data:
+            return data
+        return USER_ID_DATA.sub(lambda match: str(self.anonymize(match.group())), data)
+
+    def write(self, line: dict) -> None:
+        """ Добавляет строку в файл записи"""
+        line['t'] = round(time() - self.started, 3)
+        text = json.dumps(line, ensure_ascii=False, default=encode_value, separators=(',', ':'))
+        with self._lock:
+            self._file.write(text + '\n')
+            self._file.flush()
+
+    def record_updates(self, updates: list) -> list:
+        """ Функция приёма обновлений (IntakeTeleBot.intake): записывает сообщения и нажатия кнопок"""
+        for update in updates:
+            try:
+                if update.callback_query and update.callback_query.message:
+                    query = update.callback_query
+                    self.write({'k': 'c', 'u': self.anonymize(query.message.chat.id),
+                                'd': self.anonymize_data(query.data)})
+                elif update.message:
+                    message = update.message
+                    line = {'k': 'm', 'u': self.anonymize(message.chat.id), 'd': message.text,
+                            'ct': message.content_type}
+                    if message.location:
+                        line['loc'] = [round(message.location.latitude, LOCATION_DIGITS),
+                                       round(message.location.longitude, LOCATION_DIGITS)]
+                    self.write(line)
+            except Exception as e:
+                logger.critical(f'Невозможно записать обновление {update.update_id}. Ошибка: {e}')
+        return updates
+
+    def wrap_db_function(self, name: str, func):
+        """ Обёртка функции dboperator, записывающая аргументы и результат вызова"""
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if name not in SKIP_FUNCTIONS:
+                try:
+                    bound = signature.bind(*args, **kwargs)
+                    arguments = [self.anonymize(value) if param in USER_ID_PARAMS else value
+                                 for param, value in bound.arguments.items()]
+                    self.write({'k': 'db', 'f': name, 'a': arguments, 'r': result})
+                except Exception as e:
+                    logger.critical(f'Невозможно записать результат {name}. Ошибка: {e}')
+            return result
+
+        return wrapper
+
+    def install(self, bot) -> None:
+        """ Подключает запись к боту и к функциям dboperator"""
+        bot.intake.append(self.record_updates)
+        for name, func in db_functions().items():
+            setattr(db, name, self.wrap_db_function(name, func))
+        logger.critical(f'Включена запись входящих обновлений в файл {self.path}')
+
+
+def start_recorder(bot) -> UpdateRecorder or None:
+    """ Включает запись входящих обновлений, если в settings.py задан RECORD_UPDATES_PATH
+
+    :param bot:
+        Бот с функциями приёма обновлений (utils.IntakeTeleBot или async_runtime.IntakeAsyncTeleBot)
+    """
+    path = getattr(settings, 'RECORD_UPDATES_PATH', None)
+    if not path:
+        return None
+    recorder = UpdateRecorder(path, salt=getattr(settings, 'RECORD_UPDATES_SALT', ''))
+    recorder.install(bot)
+    return recorder
+
+
+def read_records(path: str) -> list:
+    """ Читает файл записи"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as file:
+        return [json.loads(line, object_hook=decode_value) for line in file if line.strip()]
+
+
+class ReplayDB:
+    """ Подмена функций dboperator записанными результатами.
+        Результаты одной функции с одинаковыми аргументами выдаются в порядке записи, последний повторяется
+    """
+
+    def __init__(self, records: list) -> None:
+        self._results = {}
+        self._lock = threading.Lock()
+        self.misses = 0
+        for record in records:
+            if record['k'] == 'db':
+                self._results.setdefault(self._key(record['f'], record['a']), deque()).append(record['r'])
+
+    @staticmethod
+    def _key(name: str, arguments: list) -> str:
+        return name + json.dumps([str(argument) for argument in arguments])
+
+    def stub(self, name: str, func):
+        """ Функция-заглушка вместо функции dboperator"""
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            key = self._key(name, list(bound.arguments.values()))
+            with self._lock:
+                results = self._results.get(key)
+                if not results:
+                    self.misses += 1
+                    return None
+                return results.popleft() if len(results) > 1 else results[0]
+
+        return wrapper
+
+    def install(self) -> None:
+        """ Подменяет функции dboperator"""
+        for name, func in db_functions().items():
+            setattr(db, name, self.stub(name, func))
+
+
+def replay(path: str, speed: float = 1.0, latency: float = 0.0) -> str:
+    """ Воспроизводит записанные обновления с поддельным Telegram API и подменёнными запросами к базе
+
+    :param speed:
+        Ускорение воспроизведения. 0 - без пауз между обновлениями
+    :param latency:
+        Задержка ответа поддельного Telegram API в секундах
+    :return:
+        Отчёт о задержках обработки по видам обновлений
+    """
+    from bench.fake_telegram import FakeTelegramServer
+    from bench.harness import BotDriver, format_report, make_callback, make_message
+
+    records = read_records(path)
+    replay_db = ReplayDB(records)
+    replay_db.install()
+    server = FakeTelegramServer(latency=latency).start()
+    driver = BotDriver(dsn=None)
+
+    results = {}
+    started = perf_counter()
+    for record in records:
+        if record['k'] not in ('m', 'c'):
+            continue
+        if speed:
+            delay = record['t'] / speed - (perf_counter() - started)
+            if delay > 0:
+                sleep(delay)
+        if record['k'] == 'c':
+            update = make_callback(record['u'], record['d'])
+            name = record['d'].split(',')[0].replace('button:', 'callback:')
+        elif record.get('d'):
+            update = make_message(record['u'], record['d'])
+            name = record['d'].split()[0] if record['d'].startswith('/') else 'text'
+        else:
+            continue
+        results.setdefault(name, []).append(driver.process(update))
+
+    report = format_report(results, perf_counter() - started, server)
+    server.stop()
+    return report + f'\nЗапросов к базе без записанного результата: {replay_db.misses}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных обновлений бота')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('path', help='Файл записи')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='Ускорение, 0 - без пауз')
+    replay_parser.add_argument('--latency-ms', type=float, default=0, help='Задержка ответа Telegram API')
+    args = parser.parse_args()
+    print(replay(args.path, speed=args.speed, latency=args.latency_ms / 1000))
@@ -0,0 +1,199 @@
+""" Сводные таблицы показаний метеостанций по часам (WeatherDataHourly) и по дням (WeatherDataDaily).
+    Архив погоды и сумма осадков читают несколько строк сводных таблиц вместо тысяч строк WeatherData.
+
+    Таблицы пополняются в фоновом потоке раз в ROLLUP_REFRESH_SECONDS секунд: обрабатываются только строки
+    WeatherData с id больше сохранённого водяного знака, затронутые ими часы и дни пересчитываются целиком.
+    Показания, записанные транзакциями не в порядке id, могут появиться уже ниже водяного знака, поэтому вместе
+    с новыми строками каждый раз заново просматриваются последние ROLLUP_OVERLAP_IDS id до водяного знака.
+    Строки, ещё не попавшие в сводные таблицы, запросы dboperator досчитывают по WeatherData, поэтому результат
+    не зависит от отставания фонового пересчёта.
+
+    Заполнение сводных таблиц по всей истории показаний (можно запускать при работающем боте):
+        python rollup.py backfill
+"""
+import argparse
+import logging
+from time import perf_counter, sleep
+
+import psycopg2
+
+import dboperator as db
+import settings
+from utils import mult_threading
+
+logger = logging.getLogger('__name__')
+
+# Количество строк WeatherData, обрабатываемых в одной транзакции
+BATCH = 50000
+# Количество id ниже водяного знака, которые просматриваются повторно (около двух часов показаний)
+OVERLAP_IDS = getattr(settings, 'ROLLUP_OVERLAP_IDS', 1000)
+
+# Агрегаты одного интервала: средние значения считаются как сумма / количество, чтобы их можно было складывать
+AGGREGATE_COLUMNS = ('temperaturemax', 'temperaturemin', 'temperaturesum', 'temperaturecount', 'rain',
+                     'consbatteryvoltagemin', 'consbatteryvoltagesum', 'consbatteryvoltagecount', 'readings')
+
+SQL_CREATE_TABLES = '''
+CREATE TABLE IF NOT EXISTS public."WeatherDataHourly" (
+    weatherstationid integer NOT NULL,
+    hour timestamp NOT NULL,
+    temperaturemax double precision,
+    temperaturemin double precision,
+    temperaturesum double precision,
+    temperaturecount integer NOT NULL,
+    rain double precision,
+    consbatteryvoltagemin double precision,
+    consbatteryvoltagesum double precision,
+    consbatteryvoltagecount integer NOT NULL,
+    readings integer NOT NULL,
+    PRIMARY KEY (weatherstationid, hour)
+);
+CREATE TABLE IF NOT EXISTS public."WeatherDataDaily" (
+    weatherstationid integer NOT NULL,
+    day date NOT NULL,
+    temperaturemax double precision,
+    temperaturemin double precision,
+    temperaturesum double precision,
+    temperaturecount integer NOT NULL,
+    rain double precision,
+    consbatteryvoltagemin double precision,
+    consbatteryvoltagesum double precision,
+    consbatteryvoltagecount integer NOT NULL,
+    readings integer NOT NULL,
+    PRIMARY KEY (weatherstationid, day)
+);
+CREATE TABLE IF NOT EXISTS public."WeatherDataRollupState" (
+    name text PRIMARY KEY,
+    lastid bigint NOT NULL
+);
+INSERT INTO public."WeatherDataRollupState" (name, lastid) VALUES ('WeatherData', 0) ON CONFLICT DO NOTHING;
+'''
+
+SQL_LOCK_WATERMARK = 'SELECT lastid FROM public."WeatherDataRollupState" WHERE name = \'WeatherData\' FOR UPDATE'
+SQL_NEXT_BATCH = 'SELECT MAX(id) FROM (SELECT id FROM public."WeatherData" WHERE id > %s ORDER BY id LIMIT %s) t'
+SQL_SET_WATERMARK = 'UPDATE public."WeatherDataRollupState" SET lastid = %s WHERE name = \'WeatherData\''
+SQL_LAG = 'SELECT (SELECT MAX(id) FROM public."WeatherData") - lastid FROM public."WeatherDataRollupState" ' \
+    'WHERE name = \'WeatherData\''
+
+UPSERT = 'ON CONFLICT ({key}) DO UPDATE SET ' + ', '.join(f'{column} = EXCLUDED.{column}'
+                                                        for column in AGGREGATE_COLUMNS)
+
+# Часы, в которые попали новые показания, пересчитываются по всем показаниям до нового водяного знака включительно
+SQL_ROLLUP_HOURLY = 'WITH changed AS (SELECT DISTINCT weatherstationid, date_trunc(\'hour\', datetime) AS hour ' \
+    'FROM public."WeatherData" WHERE id > %s AND id <= %s AND datetime IS NOT NULL) ' \
+    'INSERT INTO public."WeatherDataHourly" (weatherstationid, hour, ' + ', '.join(AGGREGATE_COLUMNS) + ') ' \
+    'SELECT c.weatherstationid, c.hour, MAX(wd.temperature), MIN(wd.temperature), SUM(wd.temperature), ' \
+    'COUNT(wd.temperature), SUM(wd.rain), MIN(wd.consbatteryvoltage), SUM(wd.consbatteryvoltage), ' \
+    'COUNT(wd.consbatteryvoltage), COUNT(*) ' \
+    'FROM changed c JOIN public."WeatherData" wd ON wd.weatherstationid = c.weatherstationid ' \
+    'AND wd.datetime >= c.hour AND wd.datetime < c.hour + interval \'1 hour\' AND wd.id <= %s ' \
+    'GROUP BY c.weatherstationid, c.hour ' + UPSERT.format(key='weatherstationid, hour')
+
+# Дни, в которые попали новые показания, пересчитываются по часовой таблице
+SQL_ROLLUP_DAILY = 'WITH changed AS (SELECT DISTINCT weatherstationid, datetime::date AS day ' \
+    'FROM public."WeatherData" WHERE id > %s AND id <= %s AND datetime IS NOT NULL) ' \
+    'INSERT INTO public."WeatherDataDaily" (weatherstationid, day, ' + ', '.join(AGGREGATE_COLUMNS) + ') ' \
+    'SELECT c.weatherstationid, c.day, MAX(h.temperaturemax), MIN(h.temperaturemin), SUM(h.temperaturesum), ' \
+    'SUM(h.temperaturecount), SUM(h.rain), MIN(h.consbatteryvoltagemin), SUM(h.consbatteryvoltagesum), ' \
+    'SUM(h.consbatteryvoltagecount), SUM(h.readings) ' \
+    'FROM changed c JOIN public."WeatherDataHourly" h ON h.weatherstationid = c.weatherstationid ' \
+    'AND h.hour >= c.day AND h.hour < c.day + interval \'1 day\' ' \
+    'GROUP BY c.weatherstationid, c.day ' + UPSERT.format(key='weatherstationid, day')
+
+
+def create_tables() -> bool:
+    """ Создаёт сводные таблицы, если их нет"""
+    try:
+        with db.DBConnector(db.db_config, use_snapshot=False, background=True) as cur:
+            cur.execute(SQL_CREATE_TABLES)
+        return True
+    except psycopg2.Error as e:
+        logger.critical(f'Невозможно создать сводные таблицы показаний метеостанций. Ошибка: {e}')
+        return False
+
+
+def refresh_batch(batch: int = BATCH) -> int:
+    """ Добавляет в сводные таблицы следующие batch строк WeatherData. Водяной знак блокируется на время
+        транзакции, поэтому фоновый пересчёт и backfill можно запускать одновременно
+
+    :return:
+        Количество обработанных id (0 - сводные таблицы актуальны)
+    """
+    with db.DBConnector(db.db_config, use_snapshot=False, background=True) as cur:
+        cur.execute(SQL_LOCK_WATERMARK)
+        last_id = cur.fetchall()[0][0]
+        cur.execute(SQL_NEXT_BATCH, (last_id, batch))
+        # Без новых строк перепроверяется только перекрытие ниже водяного знака
+        upper_id = cur.fetchall()[0][0] or last_id
+        lower_id = max(last_id - OVERLAP_IDS, 0)
+        if upper_id > lower_id:
+            cur.execute(SQL_ROLLUP_HOURLY, (lower_id, upper_id, upper_id))
+            cur.execute(SQL_ROLLUP_DAILY, (lower_id, upper_id))
+        if upper_id == last_id:
+            return 0
+        cur.execute(SQL_SET_WATERMARK, (upper_id,))
+        return upper_id - last_id
+
+
+def refresh(max_batches: int = 20) -> int:
+    """ Пополняет сводные таблицы, обрабатывая не более max_batches пакетов за вызов
+
+    :return:
+        Количество обработанных id
+    """
+    processed = 0
+    for _ in range(max_batches):
+        step = refresh_batch()
+        processed += step
+        if not step:
+            break
+    return processed
+
+
+@mult_threading
+def keep_rollups(interval: float) -> None:
+    """ Фоновое пополнение сводных таблиц"""
+    while True:
+        if db.circuit.closed:
+            try:
+                refresh()
+            except psycopg2.Error as e:
+                logger.critical(f'Невозможно обновить сводные таблицы показаний метеостанций. Ошибка: {e}')
+        sleep(interval)
+
+
+def start_rollups() -> bool:
+    """ Включает чтение архива и осадков из сводных таблиц, если это не отключено в settings.py (WEATHER_ROLLUPS)"""
+    if not getattr(settings, 'WEATHER_ROLLUPS', True) or not create_tables():
+        return False
+    db.rollups = True
+    keep_rollups(getattr(settings, 'ROLLUP_REFRESH_SECONDS', 60))
+    return True
+
+
+def backfill(batch: int = BATCH) -> None:
+    """ Заполняет сводные таблицы по всей истории показаний с выводом хода работы"""
+    if not create_tables():
+        return
+    with db.DBConnector(db.db_config, use_snapshot=False, background=True) as cur:
+        cur.execute(SQL_LAG)
+        total = cur.fetchall()[0][0] or 0
+    processed = 0
+    started = perf_counter()
+    while True:
+        step = refresh_batch(batch)
+        if not step:
+            break
+        processed += step
+        elapsed = perf_counter() - started
+        print(f'Обработано id: {processed} из {total} ({processed / max(total, 1):.0%}), '
+              f'{processed / elapsed:.0f} id/с', flush=True)
+    print(f'Сводные таблицы заполнены за {perf_counter() - started:.1f} с')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сводные таблицы показаний метеостанций')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help='Заполнить сводные таблицы по всей истории')
+    backfill_parser.add_argument('--batch', type=int, default=BATCH, help='Строк WeatherData в одной транзакции')
+    args = parser.parse_args()
+    backfill(batch=args.batch)
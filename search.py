@@ -0,0 +1,183 @@
+""" Поиск метеостанций, микрозон прогноза и камер видеонаблюдения во встроенном режиме бота (@бот запрос).
+    Названия загружаются из базы данных при запуске в индекс в памяти: по началам слов (префиксам) находятся
+    точные совпадения, по триграммам (тройкам символов) - названия с опечатками и совпадения внутри слова.
+    Каждый результат содержит ссылку t.me/<бот>?start=<параметр>, которая открывает нужный экран бота сразу,
+    без перехода по меню (см. parse_payload)
+
+    Виды результатов: station (метеостанция), zone (микрозона прогноза), camera (камера видеонаблюдения)
+"""
+import re
+import threading
+from time import monotonic
+
+import dboperator as db
+import settings
+from subscriptions import AGRO_LIST
+
+# Наибольшее количество результатов (ограничение Telegram - 50)
+MAX_RESULTS = 20
+# Доля совпавших триграмм запроса, при которой название считается похожим
+TRIGRAM_THRESHOLD = 0.4
+# Время в секундах, в течение которого роль пользователя берётся из памяти
+ROLE_SECONDS = getattr(settings, 'SEARCH_ROLE_SECONDS', 300)
+
+KIND_TITLES = {'station': 'Метеостанция', 'zone': 'Микрозона прогноза', 'camera': 'Камера видеонаблюдения'}
+PAYLOAD = re.compile(r'^(st|zn|cm)_(\d+)(?:_(\d+))?$')
+
+
+def normalize(text: str) -> str:
+    """ Текст для поиска: строчные буквы, ё заменена на е, знаки препинания заменены пробелами"""
+    return ' '.join(re.sub(r'[\W_]+', ' ', str(text).lower().replace('ё', 'е')).split())
+
+
+def trigrams(text: str) -> set:
+    """ Триграммы слов текста. Слова дополняются пробелами, чтобы учитывались начала и концы слов"""
+    result = set()
+    for word in text.split():
+        padded = f'  {word} '
+        result.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return result
+
+
+def make_payload(kind: str, item_id: int, agro_id: int = None) -> str:
+    """ Параметр ссылки t.me/<бот>?start=... (латиница, цифры и _, не длиннее 64 символов)"""
+    prefix = {'station': 'st', 'zone': 'zn', 'camera': 'cm'}[kind]
+    return f'{prefix}_{item_id}' + (f'_{agro_id}' if agro_id is not None else '')
+
+
+def parse_payload(payload: str) -> tuple or None:
+    """ Разбирает параметр ссылки
+
+    :return:
+        Кортеж (вид, id, номер Агро или None) или None, если параметр не относится к поиску
+    """
+    match = PAYLOAD.match(payload or '')
+    if not match:
+        return None
+    kind = {'st': 'station', 'zn': 'zone', 'cm': 'camera'}[match.group(1)]
+    return kind, int(match.group(2)), int(match.group(3)) if match.group(3) else None
+
+
+class SearchIndex:
+    """ Индекс названий. Запись индекса - словарь с ключами kind, id, agro, title, description, payload
+        (у камер также location - широта и долгота)
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.prefixes = {}
+        self.trigrams = {}
+        self.loaded = False
+        self._roles = {}
+        self._lock = threading.Lock()
+
+    def build(self, entries: list) -> None:
+        """ Строит индекс по списку записей"""
+        prefixes, grams = {}, {}
+        for number, entry in enumerate(entries):
+            text = normalize(entry['title'])
+            for word in text.split():
+                for length in range(1, len(word) + 1):
+                    prefixes.setdefault(word[:length], set()).add(number)
+            for gram in trigrams(text):
+                grams.setdefault(gram, set()).add(number)
+        with self._lock:
+            self.entries, self.prefixes, self.trigrams = entries, prefixes, grams
+
+    def load(self) -> bool:
+        """ Загружает названия метеостанций, микрозон и камер из базы данных
+
+        :return:
+            False, если названия получить не удалось (остаётся прежний индекс)
+        """
+        stations = db.get_weather_groups()
+        station_agro = db.get_station_agro()
+        cameras = db.get_camera_locations()
+        zones = {agro_id: db.get_zone_id_from_agro(agro_id=agro_id) for agro_id in AGRO_LIST}
+        if stations is None or station_agro is None or cameras is None or None in zones.values():
+            return False
+
+        agro = {}
+        for station_id, agro_id in station_agro:
+            agro.setdefault(station_id, agro_id)
+        entries = []
+        for station_id, name in stations:
+            if station_id in agro:
+                entries.append({'kind': 'station', 'id': station_id, 'agro': agro[station_id],
+                                'title': name or f'Метеостанция {station_id}',
+                                'description': f'Метеостанция, Гелио-Пакс Агро {agro[station_id]}',
+                                'payload': make_payload('station', station_id, agro[station_id])})
+        for agro_id, agro_zones in zones.items():
+            for zone_id, name in agro_zones:
+                entries.append({'kind': 'zone', 'id': zone_id, 'agro': agro_id, 'title': name or f'Микрозона {zone_id}',
+                                'description': f'Микрозона прогноза, Гелио-Пакс Агро {agro_id}',
+                                'payload': make_payload('zone', zone_id, agro_id)})
+        for camera_id, name, agro_id, lat, lon in cameras:
+            entries.append({'kind': 'camera', 'id': camera_id, 'agro': agro_id, 'title': name or f'Камера {camera_id}',
+                            'description': f'Камера видеонаблюдения, Гелио-Пакс Агро {agro_id}',
+                            'payload': make_payload('camera', camera_id), 'location': (float(lat), float(lon))})
+        self.build(entries)
+        self.loaded = True
+        return True
+
+    def search(self, query: str, kinds: tuple, limit: int = MAX_RESULTS) -> list:
+        """ Записи, подходящие под запрос
+
+        :param kinds:
+            Виды записей, доступные пользователю
+        :return:
+            Сначала записи, в которых каждое слово запроса является началом одного из слов названия,
+            затем похожие по триграммам. Пустой запрос - первые limit записей
+        """
+        if not self.loaded:
+            self.load()
+        with self._lock:
+            entries, prefixes, grams = self.entries, self.prefixes, self.trigrams
+        text = normalize(query)
+        if not text:
+            return [entry for entry in entries if entry['kind'] in kinds][:limit]
+
+        words = text.split()
+        exact = set.intersection(*(prefixes.get(word, set()) for word in words))
+        found = [entries[number] for number in sorted(exact) if entries[number]['kind'] in kinds]
+        if len(found) >= limit:
+            return found[:limit]
+
+        query_grams = trigrams(text)
+        hits = {}
+        for gram in query_grams:
+            for number in grams.get(gram, ()):
+                if number not in exact:
+                    hits[number] = hits.get(number, 0) + 1
+        similar = sorted((-count / len(query_grams), number) for number, count in hits.items()
+                         if count / len(query_grams) >= TRIGRAM_THRESHOLD)
+        found.extend(entries[number] for _, number in similar if entries[number]['kind'] in kinds)
+        return found[:limit]
+
+    def get(self, kind: str, item_id: int, agro_id: int = None) -> dict or None:
+        """ Запись по параметрам ссылки (см. parse_payload)"""
+        if not self.loaded:
+            self.load()
+        with self._lock:
+            return next((entry for entry in self.entries if entry['kind'] == kind and entry['id'] == item_id and
+                         (agro_id is None or entry['agro'] == agro_id)), None)
+
+    def role(self, telegram_id: int) -> int or None:
+        """ Роль пользователя с подтверждённой регистрацией. Запоминается на ROLE_SECONDS секунд, чтобы поиск
+            при наборе запроса не обращался к базе данных на каждую букву
+        """
+        now = monotonic()
+        with self._lock:
+            cached = self._roles.get(telegram_id)
+            if cached and cached[0] > now:
+                return cached[1]
+        role = db.get_confirmed_role(telegram_id=telegram_id)
+        if role is not None:
+            with self._lock:
+                if len(self._roles) > 10000:
+                    self._roles = {user: value for user, value in self._roles.items() if value[0] > now}
+                self._roles[telegram_id] = (now + ROLE_SECONDS, role)
+        return role
+
+
+search_index = SearchIndex()
@@ -0,0 +1,269 @@
+""" Локальный снимок часто читаемых таблиц в SQLite для работы без связи с основной базой данных.
+    Включается константой SNAPSHOT_PATH в settings.py (путь к файлу SQLite).
+
+    Снимок обновляется в фоновом потоке без полной перезагрузки:
+        WeatherData, Layer - только новые строки по id (из WeatherData хранятся последние SNAPSHOT_WEATHER_DAYS дней
+        и последняя запись каждой метеостанции)
+        ForecastDaily - прогноз начиная с текущего дня, перезагружается при смене версии прогноза
+        Небольшие справочники (пользователи, метеостанции, микрозоны, камеры) - перезагружаются только при изменении
+        их контрольной суммы
+    Пока основная база недоступна или отвечает слишком долго (см. dboperator.CircuitBreaker), запросы на чтение
+    из dboperator выполняются по снимку
+"""
+import logging
+import sqlite3
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from threading import Lock
+from time import sleep
+
+import psycopg2
+
+import dboperator as db
+import settings
+from utils import mult_threading
+
+logger = logging.getLogger('__name__')
+
+# Справочники, которые перезагружаются целиком при изменении контрольной суммы
+REFERENCE_TABLES = ('TelegramBot', 'WeatherGroup', 'WeatherGroupAgro', 'WeatherStation', 'SecurityCam',
+                    'ForecastZoneArea')
+
+# Типы колонок PostgreSQL (oid), которым нужен тип с преобразованием в SQLite
+PG_TYPES = {1114: 'timestamp', 1184: 'timestamp', 1082: 'date', 16: 'boolean', 20: 'integer', 21: 'integer',
+            23: 'integer', 700: 'real', 701: 'real', 1700: 'real'}
+
+# Запросы dboperator, которые в SQLite записываются иначе
+SQLITE_QUERIES = {
+    db.SQL_WEATHER_DATA_FROM_AGRO:
+        'SELECT wd.datetime, wd.temperature, wd.humidity, wd.barometer, wd.rain, wd.windspeed, '
+        'wd.windgust, wd.winddegrees, wd.winddirection, wd.weatherstationid, wd.consbatteryvoltage '
+        'FROM public."WeatherGroupAgro" wga '
+        'JOIN public."WeatherData" wd ON wd.id = (SELECT MAX(id) FROM public."WeatherData" '
+        'WHERE weatherstationid = wga.weathergroupid) '
+        'WHERE wga.agroid in (%s) ORDER BY wga.weathergroupid;',
+    db.SQL_MAX_ID_FROM_LAYER: 'SELECT MAX(id) FROM public."Layer" WHERE agroid in (%s) and "set" in (%s)',
+    db.SQL_ZONE_ID_FROM_AGRO_TEXT:
+        'SELECT id, forecastareaname FROM public."ForecastZoneArea" '
+        'WHERE \',\' || replace(agroid, \' \', \'\') || \',\' LIKE \'%,\' || %s || \',%\' ORDER BY id',
+}
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_adapter(Decimal, float)
+sqlite3.register_converter('timestamp', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('date', lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter('boolean', lambda value: bool(int(value)))
+
+
+class SnapshotCursor:
+    """ Курсор снимка с тем же интерфейсом, что и курсор psycopg2. Только для чтения"""
+
+    def __init__(self, snapshot: 'Snapshot') -> None:
+        self._conn = snapshot.connect()
+        self._cursor = self._conn.cursor()
+
+    def execute(self, sql: str, params=None) -> None:
+        """ Выполняет запрос dboperator по снимку"""
+        sql = SQLITE_QUERIES.get(sql, sql)
+        if not sql.lstrip().upper().startswith('SELECT'):
+            raise db.CircuitOpenError('База данных недоступна, изменение данных невозможно')
+        try:
+            self._cursor.execute(sql.replace('%s', '?'), params or ())
+        except sqlite3.Error as e:
+            raise db.CircuitOpenError(f'Запрос не может быть выполнен по локальному снимку: {e}')
+
+    def fetchall(self) -> list:
+        return self._cursor.fetchall()
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    @property
+    def closed(self) -> bool:
+        return self._conn is None
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class Snapshot:
+    """ Локальный снимок таблиц в файле SQLite
+
+    :param path:
+        Путь к файлу снимка
+    :param weather_days:
+        Глубина хранения показаний метеостанций в днях
+    """
+
+    def __init__(self, path: str, weather_days: int = 2, batch: int = 50000) -> None:
+        self.path = path
+        self.weather_days = weather_days
+        self.batch = batch
+        self.ready = False
+        self.refreshed_at = None
+        self._write_lock = Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """ Соединение со снимком. Файл снимка подключается как схема public, поэтому запросы dboperator
+            с именами таблиц вида public."WeatherData" выполняются без изменений
+        """
+        conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES, timeout=10)
+        conn.execute('ATTACH DATABASE ? AS public', (self.path,))
+        return conn
+
+    def cursor(self) -> SnapshotCursor:
+        return SnapshotCursor(self)
+
+    def _state(self, conn: sqlite3.Connection, name: str) -> str or None:
+        row = conn.execute('SELECT value FROM public._snapshot_state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_state(conn: sqlite3.Connection, name: str, value) -> None:
+        conn.execute('INSERT OR REPLACE INTO public._snapshot_state (name, value) VALUES (?, ?)', (name, str(value)))
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection, table: str, description) -> tuple:
+        """ Создаёт таблицу снимка с колонками в том же порядке, что и в основной базе. Если колонки таблицы
+            снимка отличаются от колонок основной базы (изменилась схема), таблица пересоздаётся
+
+        :return:
+            Список колонок и признак того, что таблица была пересоздана
+        """
+        columns = [(column.name, PG_TYPES.get(column.type_code, 'text')) for column in description]
+        existing = [(row[1], row[2].lower()) for row in conn.execute(f'PRAGMA public.table_info("{table}")')]
+        recreated = bool(existing) and existing != columns
+        if recreated:
+            logger.critical(f'Схема таблицы {table} изменилась, таблица локального снимка пересоздаётся')
+            conn.execute(f'DROP TABLE public."{table}"')
+            conn.execute('DELETE FROM public._snapshot_state WHERE name = ?', (table,))
+        definition = ', '.join(f'"{name}" {column_type}' for name, column_type in columns)
+        conn.execute(f'CREATE TABLE IF NOT EXISTS public."{table}" ({definition})')
+        return [name for name, _ in columns], recreated
+
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, table: str, columns: list, rows: list) -> None:
+        names = ', '.join(f'"{column}"' for column in columns)
+        marks = ', '.join('?' * len(columns))
+        conn.executemany(f'INSERT OR REPLACE INTO public."{table}" ({names}) VALUES ({marks})', rows)
+
+    def _refresh_reference(self, conn: sqlite3.Connection, table: str) -> None:
+        """ Перезагружает справочник, если изменилась его контрольная сумма"""
+        with db.DBConnector(db.db_config, use_snapshot=False, background=True) as cur:
+            cur.execute(f'SELECT md5(string_agg(t::text, \',\' ORDER BY t::text)) FROM public."{table}" t')
+            checksum = cur.fetchall()[0][0]
+            if checksum == self._state(conn, table) and checksum is not None:
+                return
+            cur.execute(f'SELECT * FROM public."{table}"')
+            rows = cur.fetchall()
+            description = cur.description
+        columns, _ = self._create_table(conn, table, description)
+        conn.execute(f'DELETE FROM public."{table}"')
+        self._insert(conn, table, columns, rows)
+        self._set_state(conn, table, checksum)
+
+    def _refresh_by_id(self, conn: sqlite3.Connection, table: str, first_load: str = None) -> int:
+        """ Добавляет строки с id больше сохранённого водяного знака
+
+        :param first_load:
+            Условие отбора строк при первой загрузке
+        :return:
+            Количество добавленных строк
+        """
+        watermark = self._state(conn, table)
+        with db.DBConnector(db.db_config, use_snapshot=False, background=True) as cur:
+            if watermark is None:
+                cur.execute(f'SELECT * FROM public."{table}" WHERE {first_load or "TRUE"} ORDER BY id')
+            else:
+                cur.execute(f'SELECT * FROM public."{table}" WHERE id > %s ORDER BY id LIMIT %s',
+                            (int(watermark), self.batch))
+            rows = cur.fetchall()
+            description = cur.description
+        columns, recreated = self._create_table(conn, table, description)
+        if recreated and watermark is not None:
+            # Строки до водяного знака удалены вместе со старой таблицей, загрузка начинается заново
+            return self._refresh_by_id(conn, table, first_load)
+        if rows:
+            self._insert(conn, table, columns, rows)
+            self._set_state(conn, table, rows[-1][columns.index('id')])
+        elif watermark is None:
+            self._set_state(conn, table, 0)
+        return len(rows)
+
+    def _refresh_forecast(self, conn: sqlite3.Connection) -> None:
+        """ Перезагружает прогноз начиная с текущего дня, если версия прогноза изменилась"""
+        version = db.get_forecast_version()
+        if version is None or str(version) == self._state(conn, 'ForecastDaily'):
+            return
+        with db.DBConnector(db.db_config, use_snapshot=False, background=True) as cur:
+            cur.execute('SELECT * FROM public."ForecastDaily" WHERE "time" >= current_date')
+            rows = cur.fetchall()
+            description = cur.description
+        columns, _ = self._create_table(conn, 'ForecastDaily', description)
+        conn.execute('DELETE FROM public."ForecastDaily"')
+        self._insert(conn, 'ForecastDaily', columns, rows)
+        self._set_state(conn, 'ForecastDaily', version)
+
+    def _trim_weather(self, conn: sqlite3.Connection) -> None:
+        """ Удаляет старые показания, оставляя последнюю запись каждой метеостанции"""
+        conn.execute('DELETE FROM public."WeatherData" WHERE datetime < ? AND id NOT IN '
+                     '(SELECT MAX(id) FROM public."WeatherData" GROUP BY weatherstationid)',
+                     (datetime.now() - timedelta(days=self.weather_days),))
+
+    def refresh(self) -> None:
+        """ Обновляет снимок. Каждая таблица обновляется в отдельной транзакции SQLite,
+            поэтому читающие запросы видят либо старые, либо новые данные таблицы целиком
+        """
+        with self._write_lock:
+            conn = self.connect()
+            try:
+                conn.execute('PRAGMA public.journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS public._snapshot_state (name text PRIMARY KEY, value text)')
+                tables = REFERENCE_TABLES + (('ForecastZoneAgro',) if 'forecast_zone_agro' in db.migrations else ())
+                for table in tables:
+                    with conn:
+                        self._refresh_reference(conn, table)
+                with conn:
+                    self._refresh_by_id(conn, 'Layer')
+                first_load = f'datetime >= now() - interval \'{int(self.weather_days)} days\''
+                while True:
+                    with conn:
+                        added = self._refresh_by_id(conn, 'WeatherData', first_load=first_load)
+                    if added < self.batch:
+                        break
+                with conn:
+                    conn.execute('CREATE INDEX IF NOT EXISTS public."WeatherData_station_id" '
+                                 'ON "WeatherData" (weatherstationid, id)')
+                    self._trim_weather(conn)
+                with conn:
+                    self._refresh_forecast(conn)
+            finally:
+                conn.close()
+        self.ready = True
+        self.refreshed_at = datetime.now()
+
+
+@mult_threading
+def keep_fresh(snapshot: Snapshot, interval: float) -> None:
+    """ Фоновое обновление снимка. Пока основная база недоступна, обновление пропускается"""
+    while True:
+        if db.circuit.closed:
+            try:
+                snapshot.refresh()
+            except (psycopg2.Error, sqlite3.Error) as e:
+                logger.critical(f'Невозможно обновить локальный снимок базы данных. Ошибка: {e}')
+        sleep(interval)
+
+
+def start_snapshot() -> Snapshot or None:
+    """ Включает работу по локальному снимку, если в settings.py задан SNAPSHOT_PATH"""
+    path = getattr(settings, 'SNAPSHOT_PATH', None)
+    if not path:
+        return None
+    snapshot = Snapshot(path, weather_days=getattr(settings, 'SNAPSHOT_WEATHER_DAYS', 2))
+    db.snapshot = snapshot
+    keep_fresh(snapshot, getattr(settings, 'SNAPSHOT_REFRESH_SECONDS', 60))
+    return snapshot
@@ -0,0 +1,197 @@
+""" Подписки пользователей на автоматические уведомления (таблица TelegramBotSubscription).
+    Получатели уведомлений берутся из индекса в памяти {(вид уведомления, номер Агро): id пользователей},
+    который загружается при запуске и изменяется вместе с таблицей при подписке и отписке через меню бота.
+
+    Номер Агро 0 означает подписку на уведомления по всем хозяйствам. При первом создании таблицы в неё
+    переносятся получатели из списков ALERTS_* в settings.py. Пока индекс не загружен (нет соединения
+    с базой данных), уведомления отправляются по этим спискам, а загрузка повторяется не чаще раза
+    в SUBSCRIPTIONS_RETRY_SECONDS секунд
+"""
+import logging
+import threading
+from time import monotonic
+
+import psycopg2
+import telebot
+from telebot import types
+
+import dboperator as db
+import settings
+
+logger = logging.getLogger('__name__')
+
+# Номер Агро, означающий все хозяйства
+ALL_AGRO = 0
+# Список Агро
+AGRO_LIST = [1, 3, 4, 5, 6]
+# Роли, которым доступны камеры видеонаблюдения
+CAMERA_ROLES = (2, 3, 4)
+# Время в секундах между попытками загрузить индекс, если при запуске не было соединения с базой данных
+RETRY_SECONDS = getattr(settings, 'SUBSCRIPTIONS_RETRY_SECONDS', 300)
+
+# Вид уведомления: (название, выбирается ли Агро, роли с доступом (None - все), список получателей в settings.py)
+EVENTS = {
+    'sentinel': ('Новые спутниковые снимки', True, None, 'ALERTS_SENTINEL'),
+    'rain': ('Осадки за прошедшие сутки', True, None, 'ALERTS_RAIN'),
+    'weather': ('Заморозки, сильный дождь и ветер', True, None, 'ALERTS_WEATHERSTATIONS'),
+    'forecast_vlg': ('Прогноз погоды в Волгограде', False, None, 'ALERTS_FORECAST_VLG'),
+    'weather_stations': ('Неработающие метеостанции', False, (2, 3), 'ALERTS_WEATHERSTATIONS'),
+    'battery': ('Разряд батарей метеостанций', False, (2, 3), 'ALERTS_WEATHERSTATIONS'),
+    'cameras': ('Неработающие камеры видеонаблюдения', False, CAMERA_ROLES, 'ALERTS_CAMERAS'),
+}
+
+SQL_CREATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS public."TelegramBotSubscription" (
+    telegram_id bigint NOT NULL,
+    event text NOT NULL,
+    agroid integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (telegram_id, event, agroid)
+)
+'''
+SQL_TABLE_EXISTS = 'SELECT to_regclass(\'public."TelegramBotSubscription"\') IS NOT NULL'
+SQL_SUBSCRIPTIONS = 'SELECT telegram_id, event, agroid FROM public."TelegramBotSubscription"'
+SQL_SUBSCRIBE = 'INSERT INTO public."TelegramBotSubscription" (telegram_id, event, agroid) VALUES (%s, %s, %s) ' \
+    'ON CONFLICT DO NOTHING'
+SQL_UNSUBSCRIBE = 'DELETE FROM public."TelegramBotSubscription" WHERE telegram_id = %s AND event = %s AND agroid = %s'
+
+
+def legacy_recipients(event: str) -> list:
+    """ Получатели уведомления из списка ALERTS_* в settings.py"""
+    users = getattr(settings, EVENTS[event][3], [])
+    return list(users) if isinstance(users, (list, tuple)) else [users]
+
+
+class SubscriptionIndex:
+    """ Индекс подписок: получатели по виду уведомления и Агро, подписки по пользователю"""
+
+    def __init__(self):
+        self.loaded = False
+        self._next_attempt = 0.0
+        self._recipients = {}
+        self._user_subscriptions = {}
+        self._lock = threading.Lock()
+
+    def _add(self, telegram_id: int, event: str, agro_id: int) -> None:
+        self._recipients.setdefault((event, agro_id), set()).add(telegram_id)
+        self._user_subscriptions.setdefault(telegram_id, set()).add((event, agro_id))
+
+    def _remove(self, telegram_id: int, event: str, agro_id: int) -> None:
+        self._recipients.get((event, agro_id), set()).discard(telegram_id)
+        self._user_subscriptions.get(telegram_id, set()).discard((event, agro_id))
+
+    def load(self) -> bool:
+        """ Создаёт таблицу подписок (с переносом получателей из settings.py) и загружает индекс"""
+        self._next_attempt = monotonic() + RETRY_SECONDS
+        try:
+            with db.DBConnector(db.db_config, use_snapshot=False) as cur:
+                cur.execute(SQL_TABLE_EXISTS)
+                exists = cur.fetchall()[0][0]
+                cur.execute(SQL_CREATE_TABLE)
+                # Получатели переносятся только при создании таблицы: если все пользователи отписались,
+                # списки из settings.py не должны подписать их снова
+                if not exists:
+                    for event in EVENTS:
+                        for telegram_id in legacy_recipients(event):
+                            cur.execute(SQL_SUBSCRIBE, (telegram_id, event, ALL_AGRO))
+                cur.execute(SQL_SUBSCRIPTIONS)
+                rows = cur.fetchall()
+        except psycopg2.Error as e:
+            logger.critical(f'Невозможно загрузить подписки на уведомления. Ошибка: {e}')
+            return False
+        with self._lock:
+            self._recipients, self._user_subscriptions = {}, {}
+            for telegram_id, event, agro_id in rows:
+                self._add(telegram_id, event, agro_id)
+            self.loaded = True
+        return True
+
+    def ensure_loaded(self) -> bool:
+        """ Повторяет загрузку индекса, если она не удалась и с прошлой попытки прошло RETRY_SECONDS секунд"""
+        if not self.loaded and monotonic() >= self._next_attempt:
+            self.load()
+        return self.loaded
+
+    def recipients(self, event: str, *agro: int) -> list:
+        """ Получатели уведомления: подписанные на все хозяйства и на любое из переданных Агро"""
+        if not self.ensure_loaded():
+            return legacy_recipients(event)
+        with self._lock:
+            users = set(self._recipients.get((event, ALL_AGRO), ()))
+            for agro_id in agro:
+                users |= self._recipients.get((event, agro_id), set())
+        return sorted(users)
+
+    def recipients_by_agro(self, event: str) -> dict:
+        """ Получатели уведомления с Агро, на которые они подписаны
+
+        :return:
+            Словарь {id пользователя: множество номеров Агро}. ALL_AGRO в множестве - подписка на все хозяйства
+        """
+        if not self.ensure_loaded():
+            return {telegram_id: {ALL_AGRO} for telegram_id in legacy_recipients(event)}
+        users = {}
+        with self._lock:
+            for (name, agro_id), telegram_ids in self._recipients.items():
+                if name == event:
+                    for telegram_id in telegram_ids:
+                        users.setdefault(telegram_id, set()).add(agro_id)
+        return users
+
+    def subscriptions(self, telegram_id: int) -> set:
+        """ Подписки пользователя: множество пар (вид уведомления, номер Агро)"""
+        self.ensure_loaded()
+        with self._lock:
+            return set(self._user_subscriptions.get(telegram_id, ()))
+
+    def toggle(self, telegram_id: int, event: str, agro_id: int) -> bool or None:
+        """ Подписывает пользователя на уведомление или отменяет подписку
+
+        :return:
+            True - подписка оформлена, False - отменена, None - нет соединения с базой данных
+        """
+        subscribed = (event, agro_id) in self.subscriptions(telegram_id)
+        try:
+            with db.DBConnector(db.db_config, use_snapshot=False) as cur:
+                cur.execute(SQL_UNSUBSCRIBE if subscribed else SQL_SUBSCRIBE, (telegram_id, event, agro_id))
+        except psycopg2.Error as e:
+            logger.critical(f'Невозможно изменить подписку пользователя {telegram_id}. Ошибка: {e}')
+            return None
+        with self._lock:
+            if subscribed:
+                self._remove(telegram_id, event, agro_id)
+            else:
+                self._add(telegram_id, event, agro_id)
+        return not subscribed
+
+
+def available_events(role: int) -> list:
+    """ Виды уведомлений, доступные пользователю с ролью role"""
+    return [event for event, (_, _, roles, _) in EVENTS.items() if roles is None or role in roles]
+
+
+def events_keyboard(telegram_id: int, role: int) -> telebot.types.InlineKeyboardMarkup:
+    """ Клавиатура со списком уведомлений. Отмечены уведомления, на которые пользователь подписан"""
+    subscribed = {event for event, _ in subscription_index.subscriptions(telegram_id)}
+    keyboard = types.InlineKeyboardMarkup()
+    for event in available_events(role):
+        title, per_agro, _, _ = EVENTS[event]
+        mark = '✓ ' if event in subscribed else ''
+        data = f'button:subs_event,e:{event}' if per_agro else f'button:subs_toggle,e:{event},a:{ALL_AGRO}'
+        keyboard.add(types.InlineKeyboardButton(text=f'{mark}{title}', callback_data=data))
+    return keyboard
+
+
+def agro_keyboard(telegram_id: int, event: str) -> telebot.types.InlineKeyboardMarkup:
+    """ Клавиатура выбора Агро для уведомления. Отмечены Агро, на которые пользователь подписан"""
+    subscribed = {agro_id for name, agro_id in subscription_index.subscriptions(telegram_id) if name == event}
+    keyboard = types.InlineKeyboardMarkup()
+    for agro_id in [ALL_AGRO] + AGRO_LIST:
+        mark = '✓ ' if agro_id in subscribed else ''
+        text = 'Все хозяйства' if agro_id == ALL_AGRO else f'Гелио-Пакс Агро {agro_id}'
+        keyboard.add(types.InlineKeyboardButton(text=f'{mark}{text}',
+                                                callback_data=f'button:subs_toggle,e:{event},a:{agro_id}'))
+    keyboard.add(types.InlineKeyboardButton(text='« Назад к списку уведомлений', callback_data='button:subs'))
+    return keyboard
+
+
+subscription_index = SubscriptionIndex()
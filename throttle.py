@@ -0,0 +1,86 @@
+""" Ограничение частоты тяжёлых запросов одного пользователя.
+    Для каждого пользователя и действия (кнопки или команды) из THROTTLE_RULES действует ведро токенов:
+    не больше burst запросов подряд, дальше - не чаще rate запросов в минуту. Кроме того, повторное нажатие
+    той же кнопки, пока предыдущее ещё обрабатывается, отклоняется для любых кнопок.
+
+    Правила задаются в settings.py словарём THROTTLE_RULES {действие: (rate, burst)} (по умолчанию - RULES)
+"""
+import threading
+from time import monotonic
+
+import settings
+from metrics import metrics
+
+# Тяжёлые действия: проверка камер и метеостанций (ping), архив и графики (агрегаты за период), выгрузка
+RULES = {
+    'cameras': (2, 2),
+    'weather_stations': (2, 2),
+    'archive_stations_date': (6, 3),
+    'arc_day': (6, 3),
+    'arc_page': (10, 5),
+    'arc_chart': (4, 2),
+    'battery_chart': (4, 2),
+    'archive_export': (2, 1),
+    'export': (2, 1),
+}
+
+BUSY_TEXT = 'Уже загружается, подождите...'
+LIMITED_TEXT = 'Слишком частые запросы. Повторите через минуту'
+
+
+class Throttle:
+    """ Ведра токенов по паре (пользователь, действие) и множество обрабатываемых запросов
+
+    :param rules:
+        Словарь {действие: (запросов в минуту, запросов подряд)}
+    :param maxsize:
+        Количество вёдер, при превышении которого удаляются давно не использованные
+    """
+
+    def __init__(self, rules: dict, maxsize: int = 10000):
+        self.rules = rules
+        self.maxsize = maxsize
+        self._buckets = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def _take_token(self, user: int, action: str) -> bool:
+        rate, burst = self.rules[action]
+        now = monotonic()
+        tokens, updated = self._buckets.get((user, action), (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate / 60)
+        allowed = tokens >= 1
+        self._buckets[(user, action)] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > self.maxsize:
+            # Ведро, не использованное дольше минуты, успевает наполниться, его можно не хранить
+            for key in [key for key, (_, used) in self._buckets.items() if now - used > 60]:
+                del self._buckets[key]
+        return allowed
+
+    def acquire(self, user: int, action: str, key: str = None) -> str or None:
+        """ Проверяет, можно ли выполнить запрос. Разрешённый запрос нужно завершить вызовом release
+
+        :param key:
+            Данные запроса (например, query.data). Тот же запрос не выполняется, пока не завершён предыдущий
+        :return:
+            None - запрос разрешён, иначе текст для пользователя
+        """
+        with self._lock:
+            if (user, key or action) in self._in_flight:
+                refusal, reason = BUSY_TEXT, 'in_flight'
+            elif action in self.rules and not self._take_token(user, action):
+                refusal, reason = LIMITED_TEXT, 'rate'
+            else:
+                self._in_flight.add((user, key or action))
+                return None
+        metrics.inc('bot_throttled_total', help_text='Запросы, отклонённые ограничением частоты', action=action,
+                    reason=reason)
+        return refusal
+
+    def release(self, user: int, action: str, key: str = None) -> None:
+        """ Отмечает завершение запроса"""
+        with self._lock:
+            self._in_flight.discard((user, key or action))
+
+
+throttle = Throttle(getattr(settings, 'THROTTLE_RULES', RULES))
@@ -1,19 +1,41 @@
 """ Утилиты для бота"""
 import logging
+from collections import OrderedDict
 from datetime import datetime
 from functools import wraps
-from threading import Thread, Timer
+from threading import Lock, Thread, Timer
+from time import monotonic, sleep
+from typing import Callable
 
 import telebot
 from decouple import config
 from telebot import types
 
 import dboperator as db
+import settings
+from metrics import measure, metrics, timed
 
 logger = logging.getLogger('__name__')
 bot = telebot.TeleBot(config('TOKEN', default=''))
 
 
+class IntakeTeleBot(telebot.TeleBot):
+    """ TeleBot, который пропускает входящие обновления через функции приёма (intake) до обработчиков.
+        Функция приёма получает список обновлений и возвращает список обновлений для дальнейшей обработки
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.intake = []
+
+    def process_new_updates(self, updates: list) -> None:
+        """ Передаёт обновления функциям приёма, а затем обработчикам"""
+        for hook in self.intake:
+            updates = hook(updates)
+        if updates:
+            super().process_new_updates(updates)
+
+
 class RepeatedTimer(object):
     """ Класс, запускающий и перезапускающий функцию в указанное время"""
     nruns = 0
@@ -49,6 +71,267 @@ class RepeatedTimer(object):
         self.is_running = False
 
 
+class RenderCache:
+    """ Кэш готовых экранов бота (текст сообщения и клавиатура).
+        В ключ экрана входит версия данных, поэтому после поступления новых данных экран строится заново.
+        Пока база данных недоступна, отдаётся последний построенный экран с отметкой о времени данных
+    """
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._screens = OrderedDict()
+        self._latest = OrderedDict()
+
+    def get(self, key: tuple) -> tuple or None:
+        """ Возвращает готовый экран или None"""
+        with self._lock:
+            screen = self._screens.get(key)
+            if screen is not None:
+                self._screens.move_to_end(key)
+            return screen
+
+    def set(self, key: tuple, screen: tuple) -> None:
+        """ Сохраняет экран. При переполнении удаляются самые старые экраны"""
+        with self._lock:
+            self._screens[key] = screen
+            self._screens.move_to_end(key)
+            while len(self._screens) > self.maxsize:
+                self._screens.popitem(last=False)
+            # Последний экран без учёта версии данных - на случай недоступности базы данных
+            self._latest[key[:-1]] = (datetime.now(), screen)
+            self._latest.move_to_end(key[:-1])
+            while len(self._latest) > self.maxsize:
+                self._latest.popitem(last=False)
+
+    def get_stale(self, key: tuple) -> tuple or None:
+        """ Последний построенный экран с любой версией данных и отметкой о времени, на которое даны данные"""
+        with self._lock:
+            latest = self._latest.get(key)
+        if latest is None:
+            return None
+        built_at, screen = latest
+        return self.stale_note(screen, built_at)
+
+    @staticmethod
+    def stale_note(screen: tuple, data_at: datetime) -> tuple:
+        """ Экран с отметкой о времени, на которое даны данные"""
+        text, keyboard = screen
+        return text + f'\n\n_Данные на {data_at:%d.%m.%Y %H:%M}: база данных временно недоступна_', keyboard
+
+    def __len__(self) -> int:
+        return len(self._screens)
+
+    def invalidate(self, screen_name: str = None) -> None:
+        """ Удаляет все экраны с указанным названием (или все экраны, если название не передано)"""
+        with self._lock:
+            if screen_name is None:
+                self._screens.clear()
+                self._latest.clear()
+            else:
+                for key in [key for key in self._screens if key[0] == screen_name]:
+                    del self._screens[key]
+                for key in [key for key in self._latest if key[0] == screen_name]:
+                    del self._latest[key]
+
+    def cached(self, screen_name: str, version: Callable = None):
+        """ Декоратор функций, которые строят экран бота и возвращают кортеж (текст, клавиатура)
+
+        :param screen_name:
+            Название экрана
+        :param version:
+            Функция, возвращающая текущую версию данных экрана
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                """ Возвращает готовый экран из кэша или строит его заново"""
+                if not db.circuit.closed and not (db.snapshot and db.snapshot.ready):
+                    stale = self.get_stale((screen_name, args, tuple(sorted(kwargs.items()))))
+                    if stale is not None:
+                        metrics.inc('bot_render_cache_stale_total', help_text='Экраны, отданные из кэша при '
+                                    'недоступной базе данных', screen=screen_name)
+                        return stale
+
+                db.snapshot_reads.refreshed_at = None
+                key = (screen_name, args, tuple(sorted(kwargs.items())), version() if version else None)
+                screen = self.lookup(key)
+                if screen is None:
+                    with measure('bot_stage_seconds', help_text='Время этапов обработки запроса', stage='render'):
+                        screen = func(*args, **kwargs)
+                if screen is None:
+                    # Пустой экран означает ошибку получения данных, его не сохраняем
+                    return None
+
+                # Данные прочитаны по локальному снимку: экран отдаётся с отметкой о времени снимка и не сохраняется,
+                # чтобы после восстановления базы данных не отдавать его без отметки
+                snapshot_at = db.snapshot_reads.refreshed_at
+                if snapshot_at is None and not db.circuit.closed and db.snapshot and db.snapshot.ready:
+                    snapshot_at = db.snapshot.refreshed_at
+                if snapshot_at is not None:
+                    metrics.inc('bot_render_cache_snapshot_total', help_text='Экраны, построенные по локальному '
+                                'снимку базы данных', screen=screen_name)
+                    return self.stale_note(screen, snapshot_at)
+                self.set(key, screen)
+                return screen
+
+            wrapper.screen_name = screen_name
+            wrapper.version = version
+            return wrapper
+
+        return decorator
+
+    def lookup(self, key: tuple) -> tuple or None:
+        """ Готовый экран из кэша с учётом в метриках попаданий и промахов"""
+        screen = self.get(key)
+        if screen is not None:
+            metrics.inc('bot_render_cache_hits_total', help_text='Экраны, взятые из кэша', screen=key[0])
+        else:
+            metrics.inc('bot_render_cache_misses_total', help_text='Экраны, построенные заново', screen=key[0])
+        return screen
+
+    def acached(self, screen_name: str, version: Callable = None):
+        """ Декоратор сопрограмм асинхронного режима, которые строят экран бота (см. cached).
+            Ключи экранов общие с cached, поэтому экран, построенный синхронным обработчиком, отдаётся и из
+            сопрограммы. Данные читаются через async_dboperator без локального снимка, поэтому при недоступной
+            базе данных экран нужно строить синхронной функцией
+
+        :param screen_name:
+            Название экрана
+        :param version:
+            Функция, возвращающая текущую версию данных экрана (без обращения к базе данных)
+        """
+
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                """ Возвращает готовый экран из кэша или строит его заново"""
+                key = (screen_name, args, tuple(sorted(kwargs.items())), version() if version else None)
+                screen = self.lookup(key)
+                if screen is None:
+                    with measure('bot_stage_seconds', help_text='Время этапов обработки запроса', stage='render'):
+                        screen = await func(*args, **kwargs)
+                    if screen is not None:
+                        self.set(key, screen)
+                return screen
+
+            return wrapper
+
+        return decorator
+
+
+render_cache = RenderCache()
+
+
+class ForecastIndex:
+    """ Индекс прогноза погоды в памяти: (микрозона, дата) -> запись прогноза.
+        Строится одним запросом после ночного обновления ForecastDaily, вместе с ним заранее
+        создаются клавиатуры выбора даты для каждой микрозоны
+    """
+
+    def __init__(self) -> None:
+        self.version = 0
+        self._forecasts = {}
+        self._dates = {}
+        self._names = {}
+        self._zones = {}
+        self._keyboards = {}
+
+    def rebuild(self, agro_list: list) -> bool:
+        """ Перестраивает индекс по всем микрозонам
+        :param agro_list:
+            Список номеров Агро, для которых строятся меню микрозон
+        :return:
+            True, если индекс построен
+        """
+        rows = db.get_all_forecast_data()
+        if rows is None:
+            return False
+
+        forecasts, dates, names = {}, {}, {}
+        for row in rows:
+            zone_id, zone_name, record = row[0], row[1], row[2:]
+            forecasts[(zone_id, str(record[0].date()))] = record
+            dates.setdefault(zone_id, []).append((record[0],))
+            names[zone_id] = zone_name
+
+        zones = {}
+        for agro_id in agro_list:
+            agro_zones = db.get_zone_id_from_agro(agro_id=agro_id)
+            if agro_zones is None:
+                return False
+            zones[agro_id] = agro_zones
+
+        # Новые словари подменяются целиком, поэтому читатели всегда видят согласованный индекс
+        self._forecasts, self._dates, self._names, self._zones = forecasts, dates, names, zones
+        self._keyboards = {(zone[0], agro_id): create_button('forecast_zones_date', 'back_to_forecast_zones',
+                                                             'back_to_forecast_agro_menu', 'back_to_menu',
+                                                             zone_id=zone[0], agro_id=agro_id)
+                           for agro_id, agro_zones in zones.items() for zone in agro_zones}
+        self.version += 1
+        return True
+
+    def get_forecast(self, zone_id: int or str, forecast_date: str) -> tuple or None:
+        """ Запись прогноза по микрозоне на дату в формате ГГГГ-ММ-ДД"""
+        return self._forecasts.get((int(zone_id), str(forecast_date)))
+
+    def get_dates(self, zone_id: int or str) -> list or None:
+        """ Список кортежей с датами прогноза по микрозоне (как в db.get_forecast_dates)"""
+        return self._dates.get(int(zone_id))
+
+    def get_zone_name(self, zone_id: int or str) -> str or None:
+        """ Название микрозоны"""
+        return self._names.get(int(zone_id))
+
+    def get_zones(self, agro_id: int or str) -> list or None:
+        """ Список микрозон Агро (как в db.get_zone_id_from_agro)"""
+        return self._zones.get(int(agro_id))
+
+    def get_keyboard(self, zone_id: int or str, agro_id: int or str) -> types.InlineKeyboardMarkup or None:
+        """ Готовая клавиатура выбора даты прогноза по микрозоне"""
+        return self._keyboards.get((int(zone_id), int(agro_id)))
+
+
+forecast_index = ForecastIndex()
+
+
+class DataVersion:
+    """ Версия данных в памяти (например, последний id WeatherData) для ключей кэша экранов.
+        Пока работает фоновый опрос (keep_version), чтение версии не обращается к базе данных.
+        Без фонового опроса версия перечитывается не чаще раза в ttl секунд
+
+    :param load:
+        Функция получения текущей версии из базы данных. None означает ошибку получения
+    """
+
+    def __init__(self, load: Callable, ttl: float = 2) -> None:
+        self.load = load
+        self.ttl = ttl
+        self.polling = False
+        self._value = None
+        self._loaded_at = 0.0
+        self._lock = Lock()
+
+    def refresh(self) -> None:
+        """ Перечитывает версию. При ошибке сохраняется последняя известная версия"""
+        value = self.load()
+        with self._lock:
+            self._loaded_at = monotonic()
+            if value is not None:
+                self._value = value
+
+    def get(self):
+        """ Текущая версия данных"""
+        if self._value is None or not self.polling and monotonic() - self._loaded_at > self.ttl:
+            self.refresh()
+        return self._value
+
+
+weather_version = DataVersion(lambda: db.get_last_weather_data_id())
+
+
+@timed('bot_stage_seconds', help_text='Время этапов обработки запроса', stage='parse')
 def parse_query(query) -> dict:
     """ Обрабатывает запрос query и разбивает данные на ключ/значение если есть разделитель"""
     parts = query.data.split(",")
@@ -92,6 +375,23 @@ def mult_threading(func):
     return wrapper
 
 
+@mult_threading
+def keep_version(version: DataVersion, interval: float) -> None:
+    """ Фоновый опрос версии данных"""
+    version.polling = True
+    while True:
+        try:
+            version.refresh()
+        except Exception as e:
+            logger.critical(f'Невозможно обновить версию данных. Ошибка: {e}')
+        sleep(interval)
+
+
+def start_weather_version() -> None:
+    """ Запускает фоновый опрос последнего id WeatherData раз в WEATHER_VERSION_SECONDS секунд"""
+    keep_version(weather_version, getattr(settings, 'WEATHER_VERSION_SECONDS', 2))
+
+
 def retry_send_msg(func):
     """ Декоратор отправки сообщений с бесконечным количеством попыток"""
     @wraps(func)
@@ -102,7 +402,8 @@ def retry_send_msg(func):
                 result = func(*args, **kwargs)
                 return result
             except Exception:
-                pass
+                metrics.inc('bot_telegram_api_retries_total', help_text='Повторные попытки отправки сообщений',
+                            function=func.__name__)
     return wrapper
 
 
@@ -111,7 +412,8 @@ def retry_send_msg(func):
 def send_bot_message(users: int or list, text: str, keyboard: telebot.types.InlineKeyboardMarkup = None,
                      back: bool = False) -> None:
     """ Отправляет сообщение с заданными параметрами"""
-    bot.send_message(chat_id=users, text=text, parse_mode='Markdown', reply_markup=keyboard)
+    with measure('bot_telegram_api_seconds', help_text='Время запросов к Telegram API', method='send_message'):
+        bot.send_message(chat_id=users, text=text, parse_mode='Markdown', reply_markup=keyboard)
     # Если был передан флаг back - True, бот дополнительно присылает сообщение о возврате в главное меню
     if back:
         back_message(users=users)
@@ -121,7 +423,8 @@ def send_bot_message(users: int or list, text: str, keyboard: telebot.types.Inli
 @retry_send_msg
 def send_bot_location(users: int or list, lon: float, lat: float, back: bool = False) -> None:
     """ Отправляет местоположение с заданными параметрами"""
-    bot.send_location(chat_id=users, longitude=lon, latitude=lat)
+    with measure('bot_telegram_api_seconds', help_text='Время запросов к Telegram API', method='send_location'):
+        bot.send_location(chat_id=users, longitude=lon, latitude=lat)
     # Если был передан флаг back - True, бот дополнительно присылает сообщение о возврате в главное меню
     if back:
         back_message(users=users)
@@ -137,16 +440,18 @@ def back_message(users: int or list) -> None:
     role = db.get_role(telegram_id=users)
     keyboard = create_button('menu')
     if role != 9999:
-        bot.send_message(chat_id=users,
-                         text='Возврат в _основное меню_:',
-                         reply_markup=keyboard,
-                         parse_mode='Markdown')
+        with measure('bot_telegram_api_seconds', help_text='Время запросов к Telegram API', method='send_message'):
+            bot.send_message(chat_id=users,
+                             text='Возврат в _основное меню_:',
+                             reply_markup=keyboard,
+                             parse_mode='Markdown')
 
 
 def delete_message(query) -> None:
     """ Попытка удаления сообщения. В случае ошибки - сообщение будет оставлено"""
     try:
-        bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.id)
+        with measure('bot_telegram_api_seconds', help_text='Время запросов к Telegram API', method='delete_message'):
+            bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.id)
     except Exception as e:
         logger.critical(f'Ошибка при удалении сообщения: {e}')
         pass
@@ -160,8 +465,13 @@ def check_registration(func):
     def wrapper(message, *args, **kwargs):
         """ Проверяет регистрацию пользователя и делает соответствующее предложение зарегистрироваться"""
         user = message.chat.id
+        registered = db.check_user(user)
+
+        if registered is None:
+            send_bot_message(users=user, text='Нет соединения с базой данных. Пожалуйста, повторите попытку позже')
+            return
 
-        if not db.check_user(user):
+        elif not registered:
             bot.send_chat_action(chat_id=user, action='typing')
             keyboard = create_button('reg')
             send_bot_message(users=user, text="Вы ещё не подавали заявку на регистрацию, для работы с ботом. "
@@ -170,7 +480,12 @@ def check_registration(func):
                              keyboard=keyboard)
             return
 
-        elif not db.check_reg_status(user):
+        status = db.check_reg_status(user)
+        if status is None:
+            send_bot_message(users=user, text='Нет соединения с базой данных. Пожалуйста, повторите попытку позже')
+            return
+
+        elif not status:
             keyboard = create_button('contact')
             send_bot_message(users=user, text="Вы уже отправили запрос на регистрацию. Ожидайте подтверждения. "
                                               "Вам придёт автоматическое уведомление, "
@@ -189,23 +504,18 @@ def check_permission(func):
     """ Декоратор проверки доступа к функции"""
     @wraps(func)
     def wrapper(*args, **kwargs):
-        """ Проверяет, что у пользователя имеется доступ (пока только для админки)"""
-        if kwargs['query']:
-            if db.get_role(telegram_id=kwargs['query'].message.chat.id) == 2:
-                return func(*args, **kwargs)
-            else:
-                send_bot_message(users=kwargs['query'].message.chat.id,
-                                 text='У вас нет доступа к этой команде',
-                                 back=True)
-                return
-        elif kwargs['message']:
-            if db.get_role(telegram_id=kwargs['message'].chat.id) == 2:
-                return func(*args, **kwargs)
-            else:
-                send_bot_message(users=kwargs['message'].chat.id,
-                                 text='У вас нет доступа к этой команде',
-                                 back=True)
-                return
+        """ Проверяет, что у пользователя имеется доступ (пока только для админки).
+            Сообщение берётся из query, message или первого позиционного аргумента
+        """
+        query = kwargs.get('query')
+        message = query.message if query else kwargs.get('message', args[0] if args else None)
+        if message is None:
+            return
+        if db.get_role(telegram_id=message.chat.id) == 2:
+            return func(*args, **kwargs)
+        send_bot_message(users=message.chat.id,
+                         text='У вас нет доступа к этой команде',
+                         back=True)
     return wrapper
 
 
@@ -247,6 +557,7 @@ def get_agro_from_user(func):
     return wrapper
 
 
+@timed('bot_stage_seconds', help_text='Время этапов обработки запроса', stage='keyboard')
 def create_button(*args: str,
                   agro_id: int = None,
                   zone_id: int = None,
@@ -361,6 +672,32 @@ def create_button(*args: str,
                                                                     f'agro:{agro_id}')
                 keyboard.add(key_date)
 
+        # Открывает календарь выбора периода архива (см. archive.calendar_keyboard)
+        elif button == 'archive_calendar' and station_id and agro_id:
+            key_calendar = types.InlineKeyboardButton(text='Выбрать период в календаре',
+                                                      callback_data=f'button:arc_cal,'
+                                                                    f'm:{datetime.now():%Y%m%d},'
+                                                                    f's:{station_id},'
+                                                                    f'a:{agro_id}')
+            keyboard.add(key_calendar)
+
+        # График напряжения батарей метеостанций Агро (см. charts.battery_chart)
+        elif button == 'battery_chart' and agro_id:
+            key_chart = types.InlineKeyboardButton(text='Показать график напряжения',
+                                                   callback_data=f'button:battery_chart,'
+                                                                 f'agro:{agro_id}')
+            keyboard.add(key_chart)
+
+        # Создаёт кнопки выгрузки показаний метеостанции в файл
+        elif button == 'archive_export' and station_id and agro_id:
+            for days, text in ((30, 'Выгрузить показания за 30 дней (CSV)'), (365, 'Выгрузить показания за год (CSV)')):
+                key_export = types.InlineKeyboardButton(text=text,
+                                                        callback_data=f'button:archive_export,'
+                                                                      f'days:{days},'
+                                                                      f'station:{station_id},'
+                                                                      f'agro:{agro_id}')
+                keyboard.add(key_export)
+
         # Возвращает пользователя к выбору метеостанции в меню архива погоды
         elif button == 'back_to_archive_stations' and agro_id:
             key_menu = types.InlineKeyboardButton(text='« Назад к выбору метеостанции',
@@ -391,7 +728,7 @@ def create_button(*args: str,
 
         # Кнопка выбора микрозоны для прогноза погоды по конкретному Агро
         elif button == 'forecast_zones' and agro_id:
-            zones = db.get_zone_id_from_agro(agro_id=agro_id)
+            zones = forecast_index.get_zones(agro_id=agro_id) or db.get_zone_id_from_agro(agro_id=agro_id)
             for zone in zones:
                 key_forecast = types.InlineKeyboardButton(text=f'{zone[1]}',
                                                           callback_data=f'button:forecast_zones,'
@@ -401,7 +738,7 @@ def create_button(*args: str,
 
         # Кнопка выбора даты прогноза погоды по конкретной микрозоне
         elif button == 'forecast_zones_date' and zone_id and agro_id:
-            dates = db.get_forecast_dates(zone_id=zone_id)
+            dates = forecast_index.get_dates(zone_id=zone_id) or db.get_forecast_dates(zone_id=zone_id)
             for date in dates:
                 forecast_date = datetime.strftime(date[0].date(), '%d-%m-%Y')
                 key_forecast_date = types.InlineKeyboardButton(text=f'{forecast_date}',
@@ -462,6 +799,12 @@ def create_button(*args: str,
                                                      url=config.ADMIN_URL)
             keyboard.add(key_contact)
 
+        # Кнопка подписок на уведомления
+        elif button == 'subscriptions':
+            key_subscriptions = types.InlineKeyboardButton(text='Подписки на уведомления',
+                                                           callback_data='button:subs')
+            keyboard.add(key_subscriptions)
+
         # Кнопка на ссылку к меню Wialon
         elif button == 'wialon':
             key_wialon = types.InlineKeyboardButton(text='Меню "Виалона"',
@@ -549,4 +892,22 @@ def create_button(*args: str,
                                                    callback_data='button:admin_menu')
             keyboard.add(key_users)
 
+        # Кнопки профилирования работающего бота в меню администратора
+        elif button == 'admin_profile':
+            key_profile_1 = types.InlineKeyboardButton(text='Профилирование 30 с',
+                                                       callback_data='button:admin_profile,seconds:30')
+            key_profile_2 = types.InlineKeyboardButton(text='Профилирование 120 с',
+                                                       callback_data='button:admin_profile,seconds:120')
+            keyboard.add(key_profile_1, key_profile_2)
+            key_stop = types.InlineKeyboardButton(text='Остановить профилирование',
+                                                  callback_data='button:admin_profile_stop')
+            keyboard.add(key_stop)
+
+        elif button == 'admin_threads':
+            key_threads = types.InlineKeyboardButton(text='Потоки: CPU и стеки',
+                                                     callback_data='button:admin_threads')
+            key_db = types.InlineKeyboardButton(text='Статистика запросов к БД',
+                                                callback_data='button:admin_db')
+            keyboard.add(key_threads, key_db)
+
     return keyboard